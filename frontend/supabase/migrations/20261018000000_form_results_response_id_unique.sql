@@ -0,0 +1,10 @@
+-- python/infer/listener.py and python/infer/rescore.py upsert the results with ON CONFLICT
+-- (response_id), which needs a unique constraint on form_results.response_id. Responses scored
+-- more than once keep their latest result.
+delete from public.form_results a
+  using public.form_results b
+  where a.response_id = b.response_id
+    and (a.created_at, a.id) < (b.created_at, b.id);
+
+alter table public.form_results
+  add constraint form_results_response_id_key unique (response_id);
@@ -0,0 +1,662 @@
+'''
+Exports of the text responses to datasets for Keras.
+'''
+
+import abc
+import glob
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from store import PAGE_SIZE
+
+
+CLASS_NAMES = ['remedial', 'early_dev', 'developing', 'entrustable']
+
+SPLITS = ('train', 'validate', 'test')
+SHARD_SIZE = 10000
+DATASET_METADATA_NAME = 'dataset.json'
+WRITE_WORKERS = 4
+
+
+def assignSplits(ids: Iterable[int], training_split: float = 0.8) -> np.ndarray:
+  '''
+  Assigns rows to the training, validation and testing sets by a hash of their id, so a row is
+  always in the same set whatever the order and the number of rows it is read with. The rows not
+  used for training are shared equally between validation and testing.
+
+  :param ids: The ids of the rows.
+  :type ids: Iterable[int]
+
+  :param training_split: The proportion of rows used for training. Defaults to 0.8.
+  :type training_split: float
+
+  :return: The index in :data:`SPLITS` of the set of each row.
+  :rtype: np.ndarray
+  '''
+  # map the 64-bit hashes to [0, 1)
+  position = pd.util.hash_array(np.asarray(ids, dtype=np.int64)) / 2.0**64
+  return np.searchsorted([training_split, (1 + training_split) / 2], position, side='right')
+
+
+class DatasetWriter(abc.ABC):
+  '''
+  Writes the samples of a dataset split into training, validation and testing sets, on background
+  threads. The samples of each set are buffered up to ``buffer_size`` rows, and each full buffer
+  is written by one of ``max_workers`` threads; :meth:`write` blocks while ``max_pending``
+  buffers are waiting to be written, so the memory used does not depend on the size of the
+  dataset. Subclasses implement :meth:`_writeBuffer` to write a buffer.
+
+  Samples whose level is not in ``classes`` are left out.
+
+  :param destination: The destination folder.
+  :type destination: str
+
+  :param class_names: The names of the classes, indexed by level.
+  Defaults to ``['remedial', 'early_dev', 'developing', 'entrustable']``.
+  :type class_names: list[str] | None
+
+  :param classes: The levels of the classes to write. Defaults to every class.
+  :type classes: Iterable[int] | None
+
+  :param buffer_size: The number of rows of a set written at once. Defaults to 1000.
+  :type buffer_size: int
+
+  :param max_pending: The maximum number of buffers waiting or being written. Defaults to 4.
+  :type max_pending: int
+
+  :param max_workers: The number of threads writing the buffers. Defaults to 4.
+  :type max_workers: int
+
+  :param verbose: If True, print verbose output. Defaults to False.
+  :type verbose: bool
+
+  :param dry_run: If True, only count the samples without writing any files. Defaults to False.
+  :type dry_run: bool
+
+  :param force: If True, write into the destination folder even if it exists. Defaults to False.
+  :type force: bool
+  '''
+
+  def __init__(
+      self,
+      destination: str,
+      class_names: list[str] | None = None,
+      classes: Iterable[int] | None = None,
+      buffer_size: int = PAGE_SIZE,
+      max_pending: int = 4,
+      max_workers: int = WRITE_WORKERS,
+      verbose: bool = False,
+      dry_run: bool = False,
+      force: bool = False,
+  ) -> None:
+    self.destination = destination
+    self.class_names = class_names if class_names is not None else CLASS_NAMES
+    self.classes = sorted(range(len(self.class_names)) if classes is None else classes)
+    self.buffer_size = buffer_size
+    self.verbose = verbose
+    self.dry_run = dry_run
+    self.force = force
+    # the number of samples of each class written to each set
+    self.counts = {split: np.zeros(len(self.class_names), dtype=np.int64) for split in SPLITS}
+
+    self._buffers: dict[str, list[tuple[np.ndarray, np.ndarray]]] = {split: [] for split in SPLITS}
+    self._buffered = dict.fromkeys(SPLITS, 0)
+    self._parts = dict.fromkeys(SPLITS, 0)
+    self._rows = 0
+    self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='writer')
+    self._slots = threading.BoundedSemaphore(max_pending)
+    self._futures = []
+
+    if verbose:
+      print(f'{"Would create" if dry_run else "Creating"} folder {destination}...')
+
+  def __enter__(self) -> 'DatasetWriter':
+    return self
+
+  def __exit__(self, exc_type, exc, tb) -> None:
+    if exc_type is None:
+      self.close()
+    else:
+      self._pool.shutdown(wait=True, cancel_futures=True)
+
+  def write(self, split: str, texts: Iterable[str], levels: Iterable[int]) -> None:
+    '''
+    Adds samples to a set, in a single pass over the rows whatever the number of classes.
+
+    :param split: The set, ``'train'``, ``'validate'`` or ``'test'``.
+    :type split: str
+
+    :param texts: The texts of the samples.
+    :type texts: Iterable[str]
+
+    :param levels: The levels of the samples.
+    :type levels: Iterable[int]
+    '''
+    texts = np.asarray(texts, dtype=object)
+    levels = np.asarray(levels)
+    keep = np.isin(levels, self.classes)
+    texts, levels = texts[keep], levels[keep].astype(np.int64)
+    self.counts[split] += np.bincount(levels, minlength=len(self.class_names))
+
+    self._buffers[split].append((texts, levels))
+    self._buffered[split] += len(texts)
+    if self._buffered[split] >= self.buffer_size:
+      texts = np.concatenate([t for t, _ in self._buffers[split]])
+      levels = np.concatenate([l for _, l in self._buffers[split]])
+      full = len(texts) - len(texts) % self.buffer_size
+      for start in range(0, full, self.buffer_size):
+        self._submit(split, texts[start:start + self.buffer_size],
+                     levels[start:start + self.buffer_size])
+      self._buffers[split] = [(texts[full:], levels[full:])]
+      self._buffered[split] = len(texts) - full
+
+  def close(self) -> None:
+    '''
+    Writes the samples left in the buffers and waits for every buffer to be written.
+
+    :raises Exception: The error of the first buffer that could not be written.
+    '''
+    for split in SPLITS:
+      if self._buffered[split]:
+        self._submit(split, np.concatenate([t for t, _ in self._buffers[split]]),
+                     np.concatenate([l for _, l in self._buffers[split]]))
+      self._buffers[split] = []
+      self._buffered[split] = 0
+
+    self._pool.shutdown(wait=True)
+    errors = [future.exception() for future in self._futures if future.exception() is not None]
+    if errors:
+      raise errors[0]
+
+    if self.verbose:
+      for split in SPLITS:
+        for c in self.classes:
+          print(f'{"Would write" if self.dry_run else "Wrote"} {self.counts[split][c]} {split} '
+                f'samples for class {self.class_names[c]}')
+
+  def _submit(self, split: str, texts: np.ndarray, levels: np.ndarray) -> None:
+    part, start = self._parts[split], self._rows
+    self._parts[split] += 1
+    self._rows += len(texts)
+    if self.dry_run:
+      return
+    self._slots.acquire()
+    future = self._pool.submit(self._writeBuffer, split, part, start, texts, levels)
+    future.add_done_callback(lambda _: self._slots.release())
+    self._futures.append(future)
+
+  @abc.abstractmethod
+  def _writeBuffer(
+      self,
+      split: str,
+      part: int,
+      start: int,
+      texts: np.ndarray,
+      levels: np.ndarray,
+  ) -> None:
+    '''
+    Writes a buffer of samples.
+
+    :param split: The set of the samples.
+    :type split: str
+
+    :param part: The index of the buffer in the set.
+    :type part: int
+
+    :param start: The number of samples in the buffers written before this one, in every set.
+    :type start: int
+
+    :param texts: The texts of the samples.
+    :type texts: np.ndarray
+
+    :param levels: The levels of the samples.
+    :type levels: np.ndarray
+    '''
+
+
+class KerasFolderWriter(DatasetWriter):
+  '''
+  Writes a dataset as a folder of text files, one per sample, in a folder per set and class; see
+  :func:`exportKerasFolder`. The files are numbered in the order the samples are written.
+  '''
+
+  def __init__(self, destination: str, **options) -> None:
+    super().__init__(destination, **options)
+    if not self.dry_run:
+      os.makedirs(destination)
+      for split in SPLITS:
+        for c in self.classes:
+          os.makedirs(os.path.join(destination, split, self.class_names[c]), exist_ok=self.force)
+
+  def _writeBuffer(self, split, part, start, texts, levels) -> None:
+    for i, (text, level) in enumerate(zip(texts, levels), start):
+      path = os.path.join(self.destination, split, self.class_names[level], f'{i}.txt')
+      with open(path, 'w', encoding='utf-8') as f:
+        f.write(str(text))
+
+
+class ShardedDatasetWriter(DatasetWriter):
+  '''
+  Writes a dataset as a folder of Parquet shards of ``shard_size`` rows; see
+  :func:`exportShardedDataset`. The class names and the number of rows and shards of each set are
+  written to ``dataset.json`` by :meth:`close`.
+  '''
+
+  def __init__(self, destination: str, shard_size: int = SHARD_SIZE, **options) -> None:
+    super().__init__(destination, buffer_size=shard_size, **options)
+    # the classes in the order text_dataset_from_directory numbers them
+    self.names = sorted(self.class_names[c] for c in self.classes)
+    self.labels = np.full(len(self.class_names), -1, dtype=np.int32)
+    for c in self.classes:
+      self.labels[c] = self.names.index(self.class_names[c])
+    if not self.dry_run:
+      for split in SPLITS:
+        os.makedirs(os.path.join(destination, split), exist_ok=self.force)
+        # shards left by an earlier export with more rows would be read with the new ones
+        for path in glob.glob(os.path.join(destination, split, 'part-*.parquet')):
+          os.remove(path)
+
+  def close(self) -> None:
+    super().close()
+    splits = {split: {'rows': int(self.counts[split].sum()), 'shards': self._parts[split]}
+              for split in SPLITS}
+
+    if self.verbose:
+      for split in SPLITS:
+        print(f'{"Would write" if self.dry_run else "Wrote"} {splits[split]["rows"]} {split} '
+              f'samples in {splits[split]["shards"]} shards')
+
+    if not self.dry_run:
+      metadata = {'format': 'parquet', 'class_names': self.names, 'splits': splits}
+      with open(os.path.join(self.destination, DATASET_METADATA_NAME), 'w',
+                encoding='utf-8') as f:
+        json.dump(metadata, f, indent=2)
+
+  def _writeBuffer(self, split, part, start, texts, levels) -> None:
+    table = pa.table({
+        'text': pa.array([str(text) for text in texts], pa.string()),
+        'label': pa.array(self.labels[levels], pa.int32()),
+    })
+    pq.write_table(table, os.path.join(self.destination, split, f'part-{part:05d}.parquet'),
+                   compression='zstd')
+
+
+def exportTextResponses(
+    batches: Iterable[pa.RecordBatch],
+    writer: DatasetWriter,
+    training_split: float = 0.8,
+    augment=None,
+    text_col_label: str = 'text',
+    level_col_label: str = 'dev_level',
+    verbose: bool = False,
+) -> None:
+  '''
+  Exports text responses to a dataset in a single pass over record batches, such as the batches of
+  :func:`iterTextResponses`, holding one batch in memory at a time. Each row is assigned to a set
+  by :func:`assignSplits` and written by ``writer``, which is closed at the end.
+
+  :param batches: The record batches, with an ``id``, a text and a level column.
+  :type batches: Iterable[pa.RecordBatch]
+
+  :param writer: The writer of the dataset.
+  :type writer: DatasetWriter
+
+  :param training_split: The proportion of rows used for training. Defaults to 0.8.
+  :type training_split: float
+
+  :param augment: A function augmenting the training rows of a batch, such as
+  :func:`augmentData`. Defaults to None, for no augmentation.
+  :type augment: Callable[[pd.DataFrame], pd.DataFrame] | None
+
+  :param text_col_label: The label of the text column. Defaults to ``'text'``.
+  :type text_col_label: str
+
+  :param level_col_label: The label of the level column. Defaults to ``'dev_level'``.
+  :type level_col_label: str
+
+  :param verbose: If True, print verbose output. Defaults to False.
+  :type verbose: bool
+  '''
+  exported = 0
+  with writer:
+    for batch in batches:
+      df = batch.to_pandas()
+      splits = assignSplits(df['id'], training_split)
+      for i, split in enumerate(SPLITS):
+        split_df = df[splits == i]
+        if split == 'train' and augment is not None:
+          split_df = augment(split_df)
+        writer.write(split, split_df[text_col_label].to_numpy(),
+                     split_df[level_col_label].to_numpy())
+        exported += len(split_df)
+      if verbose:
+        print(f'Exported {exported} samples', end='\r')
+    if verbose:
+      print(f'Exported {exported} samples')
+
+
+def exportKerasFolder(
+    train_df: pd.DataFrame,
+    val_df: pd.DataFrame,
+    test_df: pd.DataFrame,
+    destination: str,
+    text_col_label: str = 'text',
+    level_col_label: str = 'dev_level',
+    class_names: list[str] | None = None,
+    verbose: bool = False,
+    dry_run: bool = False,
+    force: bool = False,
+) -> None:
+  '''
+  Export the DataFrame to a folder in Keras format.
+  The folder will be compatible with ``keras.utils.text_dataset_from_directory``.
+  The directory structure will be as follows: :
+
+    train/
+    ├── remedial/
+    │   ├── 0.txt
+    │   ├── 1.txt
+    │   └── ...
+    ├── early_dev/
+    │   ├── 2.txt
+    │   ├── 3.txt
+    │   └── ...
+    └── ...
+    test/
+    ├── remedial/
+    │   ├── 4.txt
+    │   ├── 5.txt
+    │   └── ...
+    └── ...
+
+  where each class is a folder, and each file is a text file containing the description.
+  The rows are routed to their class in a single pass and the files are written on background
+  threads by a :class:`KerasFolderWriter`.
+
+  :param train_df: The training DataFrame.
+  :type train_df: DataFrame
+
+  :param val_df: The validation DataFrame.
+  :type val_df: DataFrame
+
+  :param test_df: The testing DataFrame.
+  :type test_df: DataFrame
+
+  :param destination: The destination folder.
+  :type destination: str
+
+  :param text_col_label: The label of the text column. Defaults to ``'text'``.
+  :type text_col_label: str
+
+  :param level_col_label: The label of the level column. Defaults to ``'dev_level'``.
+  :type level_col_label: str
+
+  :param class_names: The names of the classes.
+  Defaults to ``['remedial', 'early_dev', 'developing', 'entrustable']``.
+  :type class_names: list[str]
+
+  :param verbose: If True, print verbose output. Defaults to False.
+  :type verbose: bool
+
+  :param dry_run: If True, do not write any files. Defaults to False.
+  :type dry_run: bool
+
+  :param force: If True, force overwrite the destination folder. Defaults to False.
+  :type force: bool
+  '''
+  # if os.path.exists(destination):
+  #   if force:
+  #     if verbose:
+  #       print(f'Removing existing folder {destination}...')
+  #     shutil.rmtree(destination)
+  #   else:
+  #     raise ValueError(
+  #         f'Destination folder {destination} already exists. Use --force to overwrite.')
+
+  writer = KerasFolderWriter(destination, class_names=class_names,
+                             classes=train_df[level_col_label].unique(),
+                             verbose=verbose, dry_run=dry_run, force=force)
+  exportSplits(train_df, val_df, test_df, writer, text_col_label, level_col_label, verbose)
+
+
+def exportShardedDataset(
+    train_df: pd.DataFrame,
+    val_df: pd.DataFrame,
+    test_df: pd.DataFrame,
+    destination: str,
+    text_col_label: str = 'text',
+    level_col_label: str = 'dev_level',
+    class_names: list[str] | None = None,
+    shard_size: int = SHARD_SIZE,
+    verbose: bool = False,
+    dry_run: bool = False,
+    force: bool = False,
+) -> None:
+  '''
+  Export the DataFrames to a folder of Parquet shards, to be read with :func:`loadShardedDataset`.
+  The directory structure will be as follows: :
+
+    dataset.json
+    train/
+    ├── part-00000.parquet
+    ├── part-00001.parquet
+    └── ...
+    validate/
+    └── ...
+    test/
+    └── ...
+
+  where each shard holds up to ``shard_size`` rows with a ``text`` and a ``label`` column,
+  compressed with Zstandard. The labels are numbered like the labels of
+  ``keras.utils.text_dataset_from_directory`` on a folder from :func:`exportKerasFolder`, in the
+  alphabetical order of the class names, which are listed in ``dataset.json``.
+  The shards are written on background threads by a :class:`ShardedDatasetWriter`.
+
+  :param train_df: The training DataFrame.
+  :type train_df: DataFrame
+
+  :param val_df: The validation DataFrame.
+  :type val_df: DataFrame
+
+  :param test_df: The testing DataFrame.
+  :type test_df: DataFrame
+
+  :param destination: The destination folder.
+  :type destination: str
+
+  :param text_col_label: The label of the text column. Defaults to ``'text'``.
+  :type text_col_label: str
+
+  :param level_col_label: The label of the level column. Defaults to ``'dev_level'``.
+  :type level_col_label: str
+
+  :param class_names: The names of the classes.
+  Defaults to ``['remedial', 'early_dev', 'developing', 'entrustable']``.
+  :type class_names: list[str]
+
+  :param shard_size: The maximum number of rows per shard. Defaults to 10000.
+  :type shard_size: int
+
+  :param verbose: If True, print verbose output. Defaults to False.
+  :type verbose: bool
+
+  :param dry_run: If True, do not write any files. Defaults to False.
+  :type dry_run: bool
+
+  :param force: If True, write into the destination folder even if it exists, replacing its
+  shards. Defaults to False.
+  :type force: bool
+  '''
+  # like the folder export, rows of a class that is not in the training set are left out
+  writer = ShardedDatasetWriter(destination, shard_size=shard_size, class_names=class_names,
+                                classes=train_df[level_col_label].unique(),
+                                verbose=verbose, dry_run=dry_run, force=force)
+  exportSplits(train_df, val_df, test_df, writer, text_col_label, level_col_label, verbose)
+
+
+def exportSplits(
+    train_df: pd.DataFrame,
+    val_df: pd.DataFrame,
+    test_df: pd.DataFrame,
+    writer: DatasetWriter,
+    text_col_label: str = 'text',
+    level_col_label: str = 'dev_level',
+    verbose: bool = False,
+) -> None:
+  '''
+  Exports the training, validation and testing DataFrames with a dataset writer, which is closed
+  at the end.
+
+  :param train_df: The training DataFrame.
+  :type train_df: DataFrame
+
+  :param val_df: The validation DataFrame.
+  :type val_df: DataFrame
+
+  :param test_df: The testing DataFrame.
+  :type test_df: DataFrame
+
+  :param writer: The writer of the dataset.
+  :type writer: DatasetWriter
+
+  :param text_col_label: The label of the text column. Defaults to ``'text'``.
+  :type text_col_label: str
+
+  :param level_col_label: The label of the level column. Defaults to ``'dev_level'``.
+  :type level_col_label: str
+
+  :param verbose: If True, print verbose output. Defaults to False.
+  :type verbose: bool
+  '''
+  if verbose:
+    print(f'Exporting {len(train_df)} training, {len(val_df)} validation, and {len(test_df)} '
+          f'testing samples ({len(train_df) + len(val_df) + len(test_df)} total)...')
+
+  with writer:
+    for df, split in zip([train_df, val_df, test_df], SPLITS):
+      writer.write(split, df[text_col_label].to_numpy(), df[level_col_label].to_numpy())
+
+
+def loadShardedDataset(
+    destination: str,
+    split: str,
+    batch_size: int = 32,
+    shuffle: bool = True,
+    seed: int = 42,
+):
+  '''
+  Loads a split of a dataset exported by :func:`exportShardedDataset` as a ``tf.data.Dataset`` of
+  batches of ``(text, label)``, like ``keras.utils.text_dataset_from_directory``.
+
+  The shards are read in parallel, each in record batches, and the next batches are prefetched
+  while the current one is used. Like ``text_dataset_from_directory``, the class names are in the
+  ``class_names`` attribute of the dataset.
+
+  :param destination: The dataset folder.
+  :type destination: str
+
+  :param split: The split to load, ``'train'``, ``'validate'`` or ``'test'``.
+  :type split: str
+
+  :param batch_size: The number of samples per batch. Defaults to 32.
+  :type batch_size: int
+
+  :param shuffle: If True, shuffle the shards and the samples. Defaults to True.
+  :type shuffle: bool
+
+  :param seed: The seed of the shuffling. Defaults to 42.
+  :type seed: int
+
+  :return: The dataset.
+  :rtype: tf.data.Dataset
+  '''
+  # TensorFlow is only installed where the model is trained
+  import tensorflow as tf  # pylint: disable=import-outside-toplevel
+
+  with open(os.path.join(destination, DATASET_METADATA_NAME), 'r', encoding='utf-8') as f:
+    metadata = json.load(f)
+  # only the shards listed in the metadata belong to the dataset
+  count = metadata['splits'].get(split, {}).get('shards', 0)
+  shards = [os.path.join(destination, split, f'part-{shard:05d}.parquet') for shard in range(count)]
+  if not shards:
+    raise ValueError(f'No shards found in {os.path.join(destination, split)}.')
+
+  def readShard(path: bytes):
+    for batch in pq.ParquetFile(path.decode()).iter_batches(batch_size=1024):
+      yield (batch.column('text').to_numpy(zero_copy_only=False).astype(object),
+             batch.column('label').to_numpy())
+
+  signature = (tf.TensorSpec(shape=(None,), dtype=tf.string),
+               tf.TensorSpec(shape=(None,), dtype=tf.int32))
+
+  files = tf.data.Dataset.from_tensor_slices(shards)
+  if shuffle:
+    files = files.shuffle(len(shards), seed=seed)
+
+  dataset = files.interleave(
+      lambda path: tf.data.Dataset.from_generator(readShard, args=(path,),
+                                                  output_signature=signature),
+      cycle_length=min(len(shards), os.cpu_count() or 1),
+      num_parallel_calls=tf.data.AUTOTUNE,
+      deterministic=not shuffle,
+  ).unbatch()
+
+  if shuffle:
+    rows = metadata['splits'].get(split, {}).get('rows', SHARD_SIZE)
+    dataset = dataset.shuffle(buffer_size=max(min(rows, SHARD_SIZE), 1), seed=seed)
+  dataset = dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+  dataset.class_names = metadata['class_names']
+  return dataset
+
+
+def exportDfPickle(
+    df: pd.DataFrame,
+    destination: str,
+    verbose: bool = False,
+    dry_run: bool = False,
+    force: bool = False,
+) -> None:
+  '''
+  Export the DataFrame to a pickle file.
+
+  :param df: The DataFrame to export.
+  :type df: DataFrame
+
+  :param destination: The destination file.
+  :type destination: str
+
+  :param verbose: If True, print verbose output. Defaults to False.
+  :type verbose: bool
+
+  :param dry_run: If True, do not write any files. Defaults to False.
+  :type dry_run: bool
+
+  :param force: If True, force overwrite the destination file. Defaults to False.
+  :type force: bool
+  '''
+
+  if os.path.exists(destination):
+    if force:
+      if verbose:
+        print(f'{"Would remove" if dry_run else "Removing"} existing file {destination}...')
+      if not dry_run:
+        os.remove(destination)
+    else:
+      raise ValueError(
+          f'Destination file {destination} already exists. Use --force to overwrite.')
+
+  if not dry_run:
+    if verbose:
+      print(f'Exporting DataFrame to {destination}...')
+    df.to_pickle(destination)
+  else:
+    if verbose:
+      print(f'Would export DataFrame to {destination}')
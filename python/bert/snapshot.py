@@ -0,0 +1,408 @@
+'''
+Content-addressed snapshots of the local store, shared by the exporters.
+'''
+
+import contextlib
+import functools
+import glob
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from typing import Iterable, Iterator
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from dataset import SHARD_SIZE
+from store import FETCH_WORKERS, PAGE_SIZE, STORE_DIR, iterTextResponses, syncStore
+# found on the path added by the store module
+from parquet_store import (  # pylint: disable=import-error
+    iter_table, read_sync_state, to_store_table, write_atomic, write_part, write_sync_state)
+
+
+SNAPSHOT_DIR = os.path.join('data', 'snapshots')
+SNAPSHOT_FILE_NAME = 'text_responses.parquet'
+SNAPSHOT_MANIFEST_NAME = 'manifest.json'
+SNAPSHOT_LATEST_NAME = 'LATEST'
+# the number of snapshots kept; the oldest ones are removed when a new one is taken
+SNAPSHOT_KEEP = 5
+
+
+@contextlib.contextmanager
+def textResponsesSnapshot(
+    snapshot: str | None = None,
+    verbose: bool = False,
+    full_refresh: bool = False,
+    store_dir: str = STORE_DIR,
+    snapshot_dir: str = SNAPSHOT_DIR,
+    dry_run: bool = False,
+    max_workers: int = FETCH_WORKERS,
+    keep: int = SNAPSHOT_KEEP,
+) -> Iterator[str]:
+  '''
+  Provides a snapshot of the text responses, so that every export of the same data reads the same
+  rows without querying Supabase again.
+
+  Without ``snapshot``, the local store is brought up to date as in :func:`iterTextResponses` and
+  its rows are copied to ``<snapshot_dir>/<digest>/``, where the digest is a hash of their content,
+  together with a manifest. The digest is recorded in the sync state of the store, so while no new
+  rows are fetched the snapshot is reused without reading the store. A snapshot with the same
+  content is also reused instead of being written again. Only the ``keep`` most recent snapshots
+  are kept. With ``snapshot``, an existing snapshot is used and Supabase is not queried at all.
+
+  With ``dry_run``, a new snapshot is written to a temporary folder that is removed on exit.
+
+  :param snapshot: The snapshot to use, ``'latest'`` or a prefix of its digest. Defaults to None,
+  to take a new snapshot.
+  :type snapshot: str | None
+
+  :param verbose: If True, print verbose output. Defaults to False.
+  :type verbose: bool
+
+  :param full_refresh: If True, ignore the local store and fetch every row. Defaults to False.
+  :type full_refresh: bool
+
+  :param store_dir: The folder of the local store. Defaults to ``'data/store'``.
+  :type store_dir: str
+
+  :param snapshot_dir: The folder of the snapshots. Defaults to ``'data/snapshots'``.
+  :type snapshot_dir: str
+
+  :param dry_run: If True, do not update the local store or keep the snapshot. Defaults to False.
+  :type dry_run: bool
+
+  :param max_workers: The number of id ranges fetched at once. Defaults to 4.
+  :type max_workers: int
+
+  :param keep: The number of snapshots kept. Defaults to 5.
+  :type keep: int
+
+  :return: A context manager giving the path of the snapshot folder.
+  :rtype: Iterator[str]
+
+  :raises ValueError: If ``snapshot`` does not match exactly one snapshot.
+  '''
+  if snapshot is not None:
+    path = findSnapshot(snapshot, snapshot_dir)
+    if verbose:
+      manifest = readSnapshotManifest(path)
+      print(f"Using snapshot {manifest['digest']} of {manifest['rows']} rows "
+            f"from {manifest['created_at']}")
+    yield path
+    return
+
+  if dry_run:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      writeSnapshot(tmp_dir, iterTextResponses(verbose=verbose, full_refresh=full_refresh,
+                                               store_dir=store_dir, dry_run=True,
+                                               batch_size=SHARD_SIZE, max_workers=max_workers))
+      yield tmp_dir
+    return
+
+  store_path, _ = syncStore(verbose=verbose, full_refresh=full_refresh, store_dir=store_dir,
+                            max_workers=max_workers)
+  state = read_sync_state(store_dir).get('text_responses', {})
+
+  # the sync state keeps the digest of the last snapshot until new rows are stored
+  path = os.path.join(snapshot_dir, state['snapshot']) if 'snapshot' in state else None
+  if path is not None and os.path.exists(os.path.join(path, SNAPSHOT_MANIFEST_NAME)):
+    if verbose:
+      print(f"Reusing snapshot {state['snapshot']} of {state['rows']} rows")
+  else:
+    path = copySnapshot(iter_table(store_path, batch_size=SHARD_SIZE), snapshot_dir, verbose)
+    state['snapshot'] = os.path.basename(path)
+    write_sync_state(store_dir, {'text_responses': state})
+
+  writeLatest(snapshot_dir, os.path.basename(path))
+  pruneSnapshots(snapshot_dir, keep, exclude=path, verbose=verbose)
+  yield path
+
+
+def copySnapshot(
+    batches: Iterable[pa.RecordBatch],
+    snapshot_dir: str = SNAPSHOT_DIR,
+    verbose: bool = False,
+) -> str:
+  '''
+  Writes record batches to a new snapshot, or finds the snapshot that already has their content.
+
+  :param batches: The record batches, in id order.
+  :type batches: Iterable[pa.RecordBatch]
+
+  :param snapshot_dir: The folder of the snapshots. Defaults to ``'data/snapshots'``.
+  :type snapshot_dir: str
+
+  :param verbose: If True, print verbose output. Defaults to False.
+  :type verbose: bool
+
+  :return: The path of the snapshot folder.
+  :rtype: str
+  '''
+  os.makedirs(snapshot_dir, exist_ok=True)
+  tmp_dir = tempfile.mkdtemp(dir=snapshot_dir, prefix='.tmp-')
+  try:
+    manifest = writeSnapshot(tmp_dir, batches)
+    path = os.path.join(snapshot_dir, manifest['digest'])
+    if os.path.exists(path):
+      if verbose:
+        print(f"Reusing snapshot {manifest['digest']} of {manifest['rows']} rows")
+      shutil.rmtree(tmp_dir)
+    else:
+      if verbose:
+        print(f"Created snapshot {manifest['digest']} of {manifest['rows']} rows")
+      os.replace(tmp_dir, path)
+  except BaseException:
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    raise
+  return path
+
+
+def writeLatest(snapshot_dir: str, digest: str) -> None:
+  '''
+  Records the digest of the snapshot used last, which ``'latest'`` refers to.
+
+  :param snapshot_dir: The folder of the snapshots.
+  :type snapshot_dir: str
+
+  :param digest: The digest of the snapshot.
+  :type digest: str
+  '''
+  def write(path: str) -> None:
+    with open(path, 'w', encoding='utf-8') as f:
+      f.write(digest + '\n')
+
+  write_atomic(os.path.join(snapshot_dir, SNAPSHOT_LATEST_NAME), write)
+
+
+def pruneSnapshots(
+    snapshot_dir: str = SNAPSHOT_DIR,
+    keep: int = SNAPSHOT_KEEP,
+    exclude: str | None = None,
+    verbose: bool = False,
+) -> list[str]:
+  '''
+  Removes the oldest snapshots, keeping the ``keep`` most recent ones.
+
+  :param snapshot_dir: The folder of the snapshots. Defaults to ``'data/snapshots'``.
+  :type snapshot_dir: str
+
+  :param keep: The number of snapshots kept. Defaults to 5.
+  :type keep: int
+
+  :param exclude: The path of a snapshot that is never removed, such as the one in use. Defaults to
+  None.
+  :type exclude: str | None
+
+  :param verbose: If True, print verbose output. Defaults to False.
+  :type verbose: bool
+
+  :return: The paths of the snapshots removed.
+  :rtype: list[str]
+  '''
+  paths = [os.path.dirname(path) for path
+           in glob.glob(os.path.join(snapshot_dir, '*', SNAPSHOT_MANIFEST_NAME))]
+  paths.sort(key=lambda path: readSnapshotManifest(path)['created_at'], reverse=True)
+
+  removed = []
+  for path in paths[keep:]:
+    if exclude is not None and os.path.samefile(path, exclude):
+      continue
+    if verbose:
+      print(f'Removing old snapshot {os.path.basename(path)}...')
+    shutil.rmtree(path)
+    removed.append(path)
+  return removed
+
+
+def writeSnapshot(path: str, batches: Iterable[pa.RecordBatch]) -> dict:
+  '''
+  Writes record batches to a snapshot folder as a single Parquet file, hashing their content as
+  they are written, and writes the manifest of the snapshot.
+
+  :param path: The snapshot folder.
+  :type path: str
+
+  :param batches: The record batches, in id order.
+  :type batches: Iterable[pa.RecordBatch]
+
+  :return: The manifest of the snapshot.
+  :rtype: dict
+  '''
+  digest = hashlib.blake2b(digest_size=16)
+
+  def hashPages() -> Iterator[pa.Table]:
+    for batch in batches:
+      table = to_store_table([pa.Table.from_batches([batch])])
+      # hash row by row, so the digest does not depend on how the rows are batched
+      df = table.to_pandas()
+      digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+      yield table
+
+  file_path = os.path.join(path, SNAPSHOT_FILE_NAME)
+  rows, last_id = write_part(file_path, hashPages())
+
+  files = {}
+  if rows:
+    file_digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+      for chunk in iter(functools.partial(f.read, 1 << 20), b''):
+        file_digest.update(chunk)
+    files[SNAPSHOT_FILE_NAME] = {'size': os.path.getsize(file_path),
+                                 'sha256': file_digest.hexdigest()}
+    columns = pq.read_schema(file_path).names
+  else:
+    columns = []
+  digest.update(json.dumps(columns).encode())
+
+  manifest = {
+      'digest': digest.hexdigest(),
+      'table': 'text_responses',
+      'created_at': pd.Timestamp.now(tz='UTC').isoformat(),
+      'rows': rows,
+      'last_id': last_id,
+      'columns': columns,
+      'files': files,
+  }
+
+  def write(manifest_path: str) -> None:
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+      json.dump(manifest, f, indent=2)
+
+  write_atomic(os.path.join(path, SNAPSHOT_MANIFEST_NAME), write)
+  return manifest
+
+
+def findSnapshot(snapshot: str, snapshot_dir: str = SNAPSHOT_DIR) -> str:
+  '''
+  Finds a snapshot folder from its digest.
+
+  :param snapshot: ``'latest'`` for the snapshot used last, or a prefix of the digest.
+  :type snapshot: str
+
+  :param snapshot_dir: The folder of the snapshots. Defaults to ``'data/snapshots'``.
+  :type snapshot_dir: str
+
+  :return: The path of the snapshot folder.
+  :rtype: str
+
+  :raises ValueError: If the digest does not match exactly one snapshot.
+  '''
+  latest_path = os.path.join(snapshot_dir, SNAPSHOT_LATEST_NAME)
+  if snapshot == 'latest' and os.path.exists(latest_path):
+    with open(latest_path, 'r', encoding='utf-8') as f:
+      snapshot = f.read().strip()
+
+  pattern = '*' if snapshot == 'latest' else f'{glob.escape(snapshot)}*'
+  paths = [os.path.dirname(path) for path
+           in glob.glob(os.path.join(snapshot_dir, pattern, SNAPSHOT_MANIFEST_NAME))]
+  if not paths:
+    raise ValueError(f'No snapshot matching {snapshot} found in {snapshot_dir}.')
+  if snapshot == 'latest':
+    return max(paths, key=lambda path: readSnapshotManifest(path)['created_at'])
+  if len(paths) > 1:
+    raise ValueError(f'Several snapshots match {snapshot}; give more of the digest.')
+  return paths[0]
+
+
+def readSnapshotManifest(path: str) -> dict:
+  '''
+  Reads the manifest of a snapshot.
+
+  :param path: The snapshot folder.
+  :type path: str
+
+  :return: The manifest, with the ``'digest'``, ``'created_at'``, ``'rows'``, ``'last_id'``,
+  ``'columns'`` and the ``'size'`` and ``'sha256'`` of the ``'files'`` of the snapshot.
+  :rtype: dict
+  '''
+  with open(os.path.join(path, SNAPSHOT_MANIFEST_NAME), 'r', encoding='utf-8') as f:
+    return json.load(f)
+
+
+def readSnapshot(path: str, columns: list[str] | None = None) -> pd.DataFrame:
+  '''
+  Reads the rows of a snapshot, loading only the columns requested.
+
+  :param path: The snapshot folder.
+  :type path: str
+
+  :param columns: The columns to read. Defaults to every column.
+  :type columns: list[str] | None
+
+  :return: The rows of the snapshot.
+  :rtype: pd.DataFrame
+  '''
+  file_path = os.path.join(path, SNAPSHOT_FILE_NAME)
+  if not os.path.exists(file_path):
+    return pd.DataFrame(columns=columns)
+  return pd.read_parquet(file_path, columns=columns)
+
+
+def iterSnapshot(
+    path: str,
+    columns: list[str] | None = None,
+    batch_size: int = PAGE_SIZE,
+) -> Iterator[pa.RecordBatch]:
+  '''
+  Reads the rows of a snapshot in record batches, holding one batch in memory at a time.
+
+  :param path: The snapshot folder.
+  :type path: str
+
+  :param columns: The columns to read. Defaults to every column.
+  :type columns: list[str] | None
+
+  :param batch_size: The maximum number of rows per batch. Defaults to 1000.
+  :type batch_size: int
+
+  :return: An iterator over the record batches.
+  :rtype: Iterator[pa.RecordBatch]
+  '''
+  file_path = os.path.join(path, SNAPSHOT_FILE_NAME)
+  if os.path.exists(file_path):
+    yield from pq.ParquetFile(file_path).iter_batches(batch_size=batch_size, columns=columns)
+
+
+def prepareDestination(
+    destination: str,
+    verbose: bool = False,
+    dry_run: bool = False,
+    force: bool = False,
+) -> bool:
+  '''
+  Checks whether an export has to be written. Exports are named after the snapshot they are built
+  from, so an existing destination already holds the same data and is kept unless ``force`` is set,
+  in which case it is removed.
+
+  :param destination: The destination file or folder.
+  :type destination: str
+
+  :param verbose: If True, print verbose output. Defaults to False.
+  :type verbose: bool
+
+  :param dry_run: If True, do not remove anything. Defaults to False.
+  :type dry_run: bool
+
+  :param force: If True, remove an existing destination. Defaults to False.
+  :type force: bool
+
+  :return: True if the export has to be written.
+  :rtype: bool
+  '''
+  if not os.path.exists(destination):
+    return True
+  if not force:
+    print(f'{destination} already exists. Use --force to overwrite.')
+    return False
+
+  if verbose:
+    print(f'{"Would remove" if dry_run else "Removing"} existing {destination}...')
+  if not dry_run:
+    if os.path.isdir(destination):
+      shutil.rmtree(destination)
+    else:
+      os.remove(destination)
+  return True
@@ -0,0 +1,323 @@
+'''
+The local Parquet store of the text responses, kept up to date with the Supabase database.
+'''
+
+import os
+import queue
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+
+import pandas as pd
+import pyarrow as pa
+
+from dotenv import load_dotenv
+from supabase import Client, create_client
+
+# the Parquet store is shared with the SVM training data, see python/parquet_store.py
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# pylint: disable=wrong-import-position,import-error
+from parquet_store import (SchemaChangedError, append_part, iter_table, read_sync_state,
+                           replace_table, to_store_table, write_sync_state)
+# pylint: enable=wrong-import-position,import-error
+
+
+STORE_DIR = os.path.join('data', 'store')
+
+# the default row limit of PostgREST; larger pages come back cut to the limit of the server
+PAGE_SIZE = 1000
+FETCH_WORKERS = 4
+# pages fetched ahead of the consumer per id range, which bounds the memory of a fetch
+PAGES_AHEAD = 2
+
+
+def querySupabase(
+    verbose: bool = False,
+    full_refresh: bool = False,
+    store_dir: str = STORE_DIR,
+    dry_run: bool = False,
+    max_workers: int = FETCH_WORKERS,
+) -> pd.DataFrame:
+  '''
+  Queries the Supabase database for text responses and returns the data as a pandas DataFrame.
+
+  The responses are kept in a local Parquet store in ``store_dir`` together with the highest id
+  fetched, and only the rows added since the last query are fetched and added to it. Rows are
+  assumed to be immutable once inserted; use ``full_refresh`` after rows were edited or deleted.
+
+  The rows are read by :func:`iterTextResponses`; use it directly to process them in batches
+  without loading the whole table.
+
+  :param verbose: If True, print verbose output. Defaults to False.
+  :type verbose: bool
+
+  :param full_refresh: If True, ignore the local store and fetch every row. Defaults to False.
+  :type full_refresh: bool
+
+  :param store_dir: The folder of the local store. Defaults to ``'data/store'``.
+  :type store_dir: str
+
+  :param dry_run: If True, do not update the local store. Defaults to False.
+  :type dry_run: bool
+
+  :param max_workers: The number of id ranges fetched at once. Defaults to 4.
+  :type max_workers: int
+
+  :return: A pandas DataFrame containing the text responses.
+  :rtype: pd.DataFrame
+
+  :raises ValueError: If the Supabase URL or key is not found in the environment variables.
+  '''
+  batches = iterTextResponses(verbose=verbose, full_refresh=full_refresh, store_dir=store_dir,
+                              dry_run=dry_run, max_workers=max_workers)
+  table = to_store_table([pa.Table.from_batches([batch]) for batch in batches])
+  return table.to_pandas() if table is not None else pd.DataFrame()
+
+
+def iterTextResponses(
+    verbose: bool = False,
+    full_refresh: bool = False,
+    store_dir: str = STORE_DIR,
+    dry_run: bool = False,
+    columns: list[str] | None = None,
+    batch_size: int = PAGE_SIZE,
+    max_workers: int = FETCH_WORKERS,
+) -> Iterator[pa.RecordBatch]:
+  '''
+  Queries the Supabase database for text responses and yields them in record batches, in id order.
+
+  Like :func:`querySupabase`, only the rows added since the last query are fetched. The pages of
+  new rows are written to the local store as they arrive, and the table is then read back from the
+  store one batch at a time, so the memory used does not depend on the number of rows. With
+  ``dry_run``, the stored rows are followed by the new pages, which are not stored.
+
+  :param verbose: If True, print verbose output. Defaults to False.
+  :type verbose: bool
+
+  :param full_refresh: If True, ignore the local store and fetch every row. Defaults to False.
+  :type full_refresh: bool
+
+  :param store_dir: The folder of the local store. Defaults to ``'data/store'``.
+  :type store_dir: str
+
+  :param dry_run: If True, do not update the local store. Defaults to False.
+  :type dry_run: bool
+
+  :param columns: The columns to read. Defaults to every column.
+  :type columns: list[str] | None
+
+  :param batch_size: The maximum number of rows per batch. Defaults to 1000.
+  :type batch_size: int
+
+  :param max_workers: The number of id ranges fetched at once. Defaults to 4.
+  :type max_workers: int
+
+  :return: An iterator over the record batches.
+  :rtype: Iterator[pa.RecordBatch]
+
+  :raises ValueError: If the Supabase URL or key is not found in the environment variables.
+  '''
+  store_path, pages = syncStore(verbose=verbose, full_refresh=full_refresh, store_dir=store_dir,
+                                dry_run=dry_run, max_workers=max_workers)
+  if store_path is not None:
+    yield from iter_table(store_path, columns, batch_size)
+  for page in pages:
+    table = to_store_table([page])
+    yield from table.select(columns if columns is not None else table.column_names) \
+                    .to_batches(max_chunksize=batch_size)
+
+
+def syncStore(
+    verbose: bool = False,
+    full_refresh: bool = False,
+    store_dir: str = STORE_DIR,
+    dry_run: bool = False,
+    max_workers: int = FETCH_WORKERS,
+) -> tuple[str | None, Iterator[pa.Table]]:
+  '''
+  Brings the text responses of the local store up to date, fetching only the rows added since the
+  last query and writing the pages to the store as they arrive. If the new rows have a column the
+  store does not, every row is fetched again.
+
+  With ``dry_run``, the store is left as it is and the new pages are returned instead, to be
+  fetched as they are read.
+
+  :param verbose: If True, print verbose output. Defaults to False.
+  :type verbose: bool
+
+  :param full_refresh: If True, ignore the local store and fetch every row. Defaults to False.
+  :type full_refresh: bool
+
+  :param store_dir: The folder of the local store. Defaults to ``'data/store'``.
+  :type store_dir: str
+
+  :param dry_run: If True, do not update the local store. Defaults to False.
+  :type dry_run: bool
+
+  :param max_workers: The number of id ranges fetched at once. Defaults to 4.
+  :type max_workers: int
+
+  :return: The path of the table in the store, or None if it has no rows to read, and the new
+  pages that were not stored, which are only left with ``dry_run``.
+  :rtype: tuple[str | None, Iterator[pa.Table]]
+
+  :raises ValueError: If the Supabase URL or key is not found in the environment variables.
+  '''
+
+  # Load environment variables from .env file
+  load_dotenv()
+  url: str = os.environ.get("SUPABASE_URL", "")
+  key: str = os.environ.get("SUPABASE_SERVICE_ROLE_KEY", "")
+
+  if url == "" or key == "":
+    raise ValueError("Supabase URL or key not found in environment variables.")
+
+  supabase: Client = create_client(url, key)
+
+  store_path = os.path.join(store_dir, 'text_responses')
+  state = {} if full_refresh else read_sync_state(store_dir)
+
+  stored = 'text_responses' in state and os.path.isdir(store_path)
+  after = state['text_responses']['id'] if stored else None
+
+  if verbose:
+    if after is None:
+      print("Querying Supabase database...")
+    else:
+      print(f"Querying Supabase database for rows after id {after}...")
+
+  def countPages(pages: Iterator[pa.Table]) -> Iterator[pa.Table]:
+    fetched = 0
+    for page in pages:
+      fetched += len(page)
+      if verbose:
+        print(f'Loaded {fetched} rows', end='\r')
+      yield page
+    if verbose:
+      print(f'Loaded {fetched} rows')
+
+  pages = countPages(textResponsePages(supabase, after, max_workers=max_workers))
+
+  if dry_run:
+    return store_path if stored else None, pages
+
+  os.makedirs(store_dir, exist_ok=True)
+  try:
+    fetched, last_id = (append_part if stored else replace_table)(store_path, pages)
+  except SchemaChangedError as e:
+    print(f"{e}, querying every row again")
+    pages.close()
+    stored = False
+    pages = countPages(textResponsePages(supabase, max_workers=max_workers))
+    fetched, last_id = replace_table(store_path, pages)
+  total = fetched + (state['text_responses']['rows'] if stored else 0)
+  if fetched > 0 or not stored:
+    write_sync_state(store_dir, {'text_responses': {'id': last_id, 'rows': total}})
+
+  if verbose and stored:
+    print(f'{total} rows in the local store')
+
+  return store_path, iter(())
+
+
+def textResponsePages(
+    supabase: Client,
+    after: int | None = None,
+    page_size: int = PAGE_SIZE,
+    max_workers: int = FETCH_WORKERS,
+) -> Iterator[pa.Table]:
+  '''
+  Yields the text responses in pages ordered by id.
+
+  The ids up to the highest one when the fetch starts are split into ``max_workers`` ranges that
+  are fetched at once, each with keyset pagination on the last id of its previous page until a
+  page comes back empty, so no rows are lost when ``page_size`` is above the row limit of the
+  server. Rows added while fetching are left for the next query, and no row is skipped or fetched
+  twice. Pages are yielded as soon as they and every page before them have arrived, and each range
+  fetches at most ``PAGES_AHEAD`` pages ahead of the caller, so memory does not grow with the
+  table.
+
+  :param supabase: The Supabase client.
+  :type supabase: Client
+
+  :param after: If set, only rows with a greater id are fetched. Defaults to None.
+  :type after: int | None
+
+  :param page_size: The number of rows fetched per request. Defaults to 1000.
+  :type page_size: int
+
+  :param max_workers: The number of id ranges fetched at once. Defaults to 4.
+  :type max_workers: int
+
+  :return: An iterator over the pages, as Arrow tables.
+  :rtype: Iterator[pa.Table]
+  '''
+  first = textResponsesQuery(supabase, after).limit(1).execute().data
+  if not first:
+    return
+  last = (supabase.schema("trainingdata").table("text_responses")
+          .select("id").order("id", desc=True).limit(1).execute().data)
+
+  low, high = first[0]['id'] - 1, last[0]['id']
+  step = -(-(high - low) // max(max_workers, 1))
+  ranges = [(start, min(start + step, high)) for start in range(low, high, step)]
+
+  stop = threading.Event()
+
+  def putPage(pages: queue.Queue, item) -> bool:
+    # waits for room in the queue, giving up once the caller stops
+    while not stop.is_set():
+      try:
+        pages.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        continue
+    return False
+
+  def fetchRange(start: int, end: int, pages: queue.Queue) -> None:
+    try:
+      while not stop.is_set():
+        rows = textResponsesQuery(supabase, start).lte("id", end).limit(page_size).execute().data
+        # a short page does not end the range, since the server caps pages at its own row limit
+        if not rows:
+          break
+        if not putPage(pages, pa.Table.from_pylist(rows)):
+          return
+        start = rows[-1]['id']
+      putPage(pages, None)
+    except Exception as e:  # pylint: disable=broad-exception-caught
+      putPage(pages, e)
+
+  with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+    queues = [queue.Queue(maxsize=PAGES_AHEAD) for _ in ranges]
+    try:
+      for (start, end), pages in zip(ranges, queues):
+        pool.submit(fetchRange, start, end, pages)
+      for pages in queues:
+        while (page := pages.get()) is not None:
+          if isinstance(page, Exception):
+            raise page
+          yield page
+    finally:
+      # stop the other ranges if the caller stops early or a range failed
+      stop.set()
+
+
+def textResponsesQuery(supabase: Client, after: int | None = None):
+  '''
+  Builds a query for the text responses ordered by id.
+
+  :param supabase: The Supabase client.
+  :type supabase: Client
+
+  :param after: If set, only rows with a greater id are selected. Defaults to None.
+  :type after: int | None
+
+  :return: The query builder.
+  :rtype: SyncSelectRequestBuilder
+  '''
+  query = supabase.schema("trainingdata").table("text_responses").select("*")
+  if after is not None:
+    query = query.gt("id", after)
+  return query.order("id")
@@ -5,9 +5,11 @@ Converts a Supabase table to a pandas DataFrame
 import os
 
 import argparse
-import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 
-from utils import querySupabase
+from snapshot import (iterSnapshot, prepareDestination, readSnapshotManifest,
+                      textResponsesSnapshot)
 
 
 def main(args: argparse.Namespace) -> None:
@@ -24,46 +26,37 @@ def main(args: argparse.Namespace) -> None:
   force = args.force
   verbose = args.verbose
 
-  dataset_name = args.ds_name
-  if dataset_name is None:
-    yymmdd = pd.Timestamp.now().strftime('%y%m%d')
-    dataset_name = f'{yymmdd}-full'
-
-  # Handle if dataset already exists
-  if os.path.exists(os.path.join(folder_path, dataset_name) + '.csv'):
-    if not force:
-      suffix = 1
-      new_dataset_name = f"{dataset_name}_{suffix}"
-      while os.path.exists(os.path.join(folder_path, new_dataset_name) + '.csv'):
-        suffix += 1
-        new_dataset_name = f"{dataset_name}_{suffix}"
-      dataset_name = new_dataset_name
-    else:
-      if verbose:
-        print(f'Removing existing file {os.path.join(folder_path, dataset_name)}...')
-      os.remove(os.path.join(folder_path, dataset_name) + '.csv')
-
-  if verbose:
-    print(f'Creating dataset {dataset_name}...')
-
   # Get samples
-  df = querySupabase(verbose=verbose)
-  if verbose:
-    print(f'Retrieved {len(df)} samples.')
+  with textResponsesSnapshot(args.snapshot, verbose=verbose, full_refresh=args.full_refresh,
+                             dry_run=args.dry_run) as snapshot:
+    # the default name is the digest of the snapshot, so the same data is only exported once
+    dataset_name = args.ds_name
+    if dataset_name is None:
+      dataset_name = readSnapshotManifest(snapshot)['digest'][:12]
 
-  df = df[['text', 'dev_level']]
-  df.rename(columns={'text': 'text', 'dev_level': 'label'}, inplace=True)
+    csv_path = os.path.join(folder_path, f'{dataset_name}.csv')
+    if not prepareDestination(csv_path, verbose=verbose, dry_run=args.dry_run, force=force):
+      return
 
-  csv_path = os.path.join(folder_path, f'{dataset_name}.csv')
-
-  if not args.dry_run:
-    if verbose:
-      print(f'Exporting {len(df)} samples to {csv_path}...')
-    df.to_csv(csv_path, index=False)
-  else:
     if verbose:
-      print(f'Would export {len(df)} samples to {csv_path}')
+      print(f'Creating dataset {dataset_name}...')
+      print(f'{"Would export" if args.dry_run else "Exporting"} samples to {csv_path}...')
+
+    # a batch at a time
+    schema = pa.schema([('text', pa.string()), ('label', pa.int8())])
+    rows = 0
+    writer = pacsv.CSVWriter(csv_path, schema) if not args.dry_run else None
+    try:
+      for batch in iterSnapshot(snapshot, columns=['text', 'dev_level']):
+        rows += batch.num_rows
+        if writer is not None:
+          writer.write_batch(pa.record_batch(batch.columns, schema=schema))
+    finally:
+      if writer is not None:
+        writer.close()
 
+  if verbose:
+    print(f'{"Would export" if args.dry_run else "Exported"} {rows} samples to {csv_path}')
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser(description='''
@@ -77,8 +70,13 @@ if __name__ == '__main__':
                       help='verbose output')
 
   parser.add_argument('--ds_name', type=str, default=None,
-                      help='custom dataset name; default is <yymmdd>-<split>[-aug][-eq]')
+                      help='custom dataset name; default is the digest of the snapshot')
   parser.add_argument('--dry-run', action='store_true',
                       help='run through the program without writing any files')
+  parser.add_argument('--full-refresh', action='store_true',
+                      help='fetch every row again instead of only rows added since the last run')
+  parser.add_argument('--snapshot', type=str, default=None,
+                      help='export an existing snapshot without querying Supabase: "latest" or '
+                           'the start of its digest; default is a new snapshot')
 
   main(parser.parse_args())
@@ -5,9 +5,10 @@ Converts a Supabase table to a pandas DataFrame
 import os
 
 import argparse
-import pandas as pd
 
-from utils import exportDfPickle, querySupabase
+from dataset import exportDfPickle
+from snapshot import (prepareDestination, readSnapshot, readSnapshotManifest,
+                      textResponsesSnapshot)
 
 
 def main(args: argparse.Namespace) -> None:
@@ -24,30 +25,26 @@ def main(args: argparse.Namespace) -> None:
   force = args.force
   verbose = args.verbose
 
-  dataset_name = args.ds_name
-  if dataset_name is None:
-    yymmdd = pd.Timestamp.now().strftime('%y%m%d')
-    dataset_name = f'{yymmdd}-full'
+  # Get samples
+  with textResponsesSnapshot(args.snapshot, verbose=verbose, full_refresh=args.full_refresh,
+                             dry_run=args.dry_run) as snapshot:
+    # the default name is the digest of the snapshot, so the same data is only exported once
+    dataset_name = args.ds_name
+    if dataset_name is None:
+      dataset_name = readSnapshotManifest(snapshot)['digest'][:12]
 
-  # Handle if dataset already exists
-  if os.path.exists(os.path.join(folder_path, dataset_name)) and not force:
-    suffix = 1
-    new_dataset_name = f"{dataset_name}_{suffix}"
-    while os.path.exists(os.path.join(folder_path, new_dataset_name)):
-      suffix += 1
-      new_dataset_name = f"{dataset_name}_{suffix}"
-    dataset_name = new_dataset_name
+    pickle_path = os.path.join(folder_path, f'{dataset_name}.pkl')
+    if not prepareDestination(pickle_path, verbose=verbose, dry_run=args.dry_run, force=force):
+      return
 
-  if verbose:
-    print(f'Creating dataset {dataset_name}...')
+    if verbose:
+      print(f'Creating dataset {dataset_name}...')
 
-  # Get samples
-  df = querySupabase(verbose=verbose)
-  if verbose:
-    print(f'Retrieved {len(df)} samples.')
+    df = readSnapshot(snapshot)
+    if verbose:
+      print(f'Retrieved {len(df)} samples.')
 
-  pickle_path = os.path.join(folder_path, f'{dataset_name}.pkl')
-  exportDfPickle(df, pickle_path, verbose=verbose, dry_run=args.dry_run, force=force)
+    exportDfPickle(df, pickle_path, verbose=verbose, dry_run=args.dry_run, force=force)
 
 
 if __name__ == '__main__':
@@ -62,8 +59,13 @@ if __name__ == '__main__':
                       help='verbose output')
 
   parser.add_argument('--ds_name', type=str, default=None,
-                      help='custom dataset name; default is <yymmdd>-<split>[-aug][-eq]')
+                      help='custom dataset name; default is the digest of the snapshot')
   parser.add_argument('--dry-run', action='store_true',
                       help='run through the program without writing any files')
+  parser.add_argument('--full-refresh', action='store_true',
+                      help='fetch every row again instead of only rows added since the last run')
+  parser.add_argument('--snapshot', type=str, default=None,
+                      help='export an existing snapshot without querying Supabase: "latest" or '
+                           'the start of its digest; default is a new snapshot')
 
   main(parser.parse_args())
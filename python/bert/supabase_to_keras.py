@@ -2,24 +2,82 @@
 Converts the supabase dataset to a keras dataset.
 '''
 
+import contextlib
+import functools
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 import argparse
-import pandas as pd
 
-from utils import augmentData, equalizeClasses, exportKerasFolder, querySupabase
+from dataset import (SHARD_SIZE, KerasFolderWriter, ShardedDatasetWriter, exportKerasFolder,
+                     exportShardedDataset, exportTextResponses)
+from snapshot import (iterSnapshot, prepareDestination, readSnapshot, readSnapshotManifest,
+                      textResponsesSnapshot)
+from utils import AUGMENT_CACHE_PATH, augmentData, equalizeClasses
 
-def getDatasetName(name: str, training_split: float, augment_count: int, equalize: bool) -> str:
+def getDatasetName(name: str, digest: str, training_split: float, augment_count: int,
+                   equalize: bool, stream: bool, fmt: str) -> str:
   dataset_name = name
   if dataset_name is None:
-    yymmdd = pd.Timestamp.now().strftime('%y%m%d')
-    dataset_name = f'{yymmdd}-{training_split * 100:.0f}'
-    if args.augment_count > 0:
+    # named after the snapshot and the options, so the same dataset is only exported once
+    dataset_name = f'{digest[:12]}-{training_split * 100:.0f}'
+    if augment_count > 0:
       dataset_name += f'-aug-{augment_count}'
-    if args.equalize:
+    if equalize:
       dataset_name += '-eq'
+    if stream:
+      dataset_name += '-stream'
+    if fmt == 'parquet':
+      dataset_name += '-parquet'
   return dataset_name
 
+def exportDataset(args: argparse.Namespace, snapshot: str, destination: str,
+                  training_split: float) -> None:
+  verbose = args.verbose
+  augment_count = args.augment_count
+  cache_path = None if args.no_augment_cache else args.augment_cache
+
+  if args.stream:
+    batches = iterSnapshot(snapshot, columns=['id', 'text', 'dev_level'], batch_size=SHARD_SIZE)
+    writer_class = ShardedDatasetWriter if args.format == 'parquet' else KerasFolderWriter
+    writer = writer_class(destination, verbose=verbose, dry_run=args.dry_run, force=args.force)
+    with contextlib.ExitStack() as stack:
+      augment = None
+      if augment_count > 0:
+        # one pool for every batch, so that WordNet is loaded once per process
+        workers = args.augment_workers or os.cpu_count() or 1
+        pool = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+        augment = functools.partial(augmentData, samples=augment_count, max_workers=workers,
+                                    cache_path=cache_path, dry_run=args.dry_run, pool=pool)
+      exportTextResponses(batches, writer, training_split, augment=augment, verbose=verbose)
+    return
+
+  # Get samples
+  df = readSnapshot(snapshot)
+  if verbose:
+    print(f'Retrieved {len(df)} samples.')
+
+  if args.equalize:
+    df = equalizeClasses(df, verbose=verbose)
+    if verbose:
+      print(f'Equalized to {len(df)} samples.')
+
+  df = df.sample(frac=1, random_state=42)  # shuffle
+  train_size = int(len(df) * training_split)
+  rest_size = int(len(df) * (1 - training_split) / 2)
+  train_df = df.iloc[:train_size]
+  val_df = df.iloc[train_size:train_size + rest_size]
+  test_df = df.iloc[train_size + rest_size:]
+
+  if augment_count > 0:
+    train_df = augmentData(train_df, samples=augment_count, verbose=verbose,
+                           max_workers=args.augment_workers, cache_path=cache_path,
+                           dry_run=args.dry_run)
+
+  export = exportShardedDataset if args.format == 'parquet' else exportKerasFolder
+  export(train_df, val_df, test_df, destination,
+         verbose=verbose, dry_run=args.dry_run, force=args.force)
+
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(description='''
       Convert Supabase training data to Keras dataset.
@@ -35,14 +93,38 @@ if __name__ == "__main__":
 
   parser.add_argument('--augment-count', type=int, default=0,
                       help='number of augmented samples to generate using synonyms')
+  parser.add_argument('--augment-cache', type=str, default=AUGMENT_CACHE_PATH,
+                      help='path of the cache of augmented samples; default is '
+                           f'{AUGMENT_CACHE_PATH}')
+  parser.add_argument('--augment-workers', type=int, default=None,
+                      help='number of processes to augment the samples in; default is the '
+                           'number of CPUs')
   parser.add_argument('--ds_name', type=str, default=None,
-                      help='custom dataset name; default is <yymmdd>-<split>[-aug][-eq]')
+                      help='custom dataset name; default is '
+                           '<digest>-<split>[-aug-<n>][-eq][-stream][-parquet]')
   parser.add_argument('--dry-run', action='store_true',
                       help='run through the program without writing any files')
   parser.add_argument('--equalize', action='store_true',
                       help='equalize the number of samples in each class')
+  parser.add_argument('--format', choices=['folder', 'parquet'], default='folder',
+                      help='folder: one text file per sample, for text_dataset_from_directory; '
+                           'parquet: compressed Parquet shards, for dataset.loadShardedDataset; '
+                           'default is folder')
+  parser.add_argument('--full-refresh', action='store_true',
+                      help='fetch every row again instead of only rows added since the last run')
+  parser.add_argument('--no-augment-cache', action='store_true',
+                      help='generate every augmented sample again without using the cache')
+  parser.add_argument('--snapshot', type=str, default=None,
+                      help='export an existing snapshot without querying Supabase: "latest" or '
+                           'the start of its digest; default is a new snapshot')
+  parser.add_argument('--stream', action='store_true',
+                      help='export the samples in batches from the snapshot instead of loading '
+                           'them all; samples are split by a hash of their id and every class '
+                           'is exported')
 
   args = parser.parse_args()
+  if args.stream and args.equalize:
+    parser.error('--equalize needs every sample at once and cannot be used with --stream')
 
   folder_path = os.path.join(os.getcwd(), 'data', 'keras')
 
@@ -56,53 +138,29 @@ if __name__ == "__main__":
   if not 0 < training_split < 1:
     raise ValueError("Training split must be between 0 and 1.")
 
-  # Construct dataset name
-  dataset_name = getDatasetName(args.ds_name, training_split, augment_count, equalize)
-
-  # Handle if dataset already exists
-  if os.path.exists(os.path.join(folder_path, dataset_name)) and not force:
-    suffix = 1
-    new_dataset_name = f"{dataset_name}_{suffix}"
-    while os.path.exists(os.path.join(folder_path, new_dataset_name)):
-      suffix += 1
-      new_dataset_name = f"{dataset_name}_{suffix}"
-    dataset_name = new_dataset_name
-
   # Adjust training split if augmenting to account for augmented samples
   # n = augment_count, s = training_split, x = adjusted training split
   # (1+n)x/(1-x) = s/(1-s)  =>  x = s/(1+n-sn)
+  adjusted_split = training_split
   if augment_count > 0:
-    training_split = training_split / (1 + augment_count - training_split * augment_count)
-
-  if verbose:
-    print(f'Creating dataset {dataset_name}...')
-
-  # Get samples
-  df = querySupabase(verbose=verbose)
-  if verbose:
-    print(f'Retrieved {len(df)} samples.')
-
-  if equalize:
-    df = equalizeClasses(df, verbose=verbose)
-    if verbose:
-      print(f'Equalized to {len(df)} samples.')
-
-  df = df.sample(frac=1, random_state=42)  # shuffle
-  train_size = int(len(df) * training_split)
-  rest_size = int(len(df) * (1 - training_split) / 2)
-  train_df = df.iloc[:train_size]
-  val_df = df.iloc[train_size:train_size + rest_size]
-  test_df = df.iloc[train_size + rest_size:]
-
-  if augment_count > 0:
-    train_df = augmentData(train_df, samples=augment_count, verbose=verbose)
-
-  keras_directory = os.path.join(folder_path, dataset_name)
-  exportKerasFolder(train_df, val_df, test_df, keras_directory,
-                    verbose=verbose, dry_run=args.dry_run, force=force)
-
-  if verbose:
-    if args.dry_run:
-      print(f'Dataset {dataset_name} would be created at {keras_directory}')
-    else:
-      print(f'Dataset {dataset_name} created at {keras_directory}')
+    adjusted_split = training_split / (1 + augment_count - training_split * augment_count)
+
+  with textResponsesSnapshot(args.snapshot, verbose=verbose, full_refresh=args.full_refresh,
+                             dry_run=args.dry_run) as snapshot:
+    # Construct dataset name
+    dataset_name = getDatasetName(args.ds_name, readSnapshotManifest(snapshot)['digest'],
+                                  training_split, augment_count, equalize, args.stream,
+                                  args.format)
+    keras_directory = os.path.join(folder_path, dataset_name)
+
+    if prepareDestination(keras_directory, verbose=verbose, dry_run=args.dry_run, force=force):
+      if verbose:
+        print(f'Creating dataset {dataset_name}...')
+
+      exportDataset(args, snapshot, keras_directory, adjusted_split)
+
+      if verbose:
+        if args.dry_run:
+          print(f'Dataset {dataset_name} would be created at {keras_directory}')
+        else:
+          print(f'Dataset {dataset_name} created at {keras_directory}')
@@ -0,0 +1,477 @@
+'''Unit tests for the BERT data scripts.'''
+
+import contextlib
+import glob
+import importlib.util
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import dataset  # pylint: disable=import-error
+import snapshot  # pylint: disable=import-error
+import store  # pylint: disable=import-error
+# found on the path added by the store module
+import parquet_store  # pylint: disable=import-error,wrong-import-order
+import utils  # pylint: disable=import-error
+
+
+def make_rows(ids: list[int]) -> list[dict]:
+  '''Returns text responses with the given ids, as returned by Supabase.'''
+  return [{'id': i, 'text': f'text {i}', 'dev_level': i % 4,
+           'created_at': '2025-03-01T12:00:00+00:00', 'user_id': None} for i in ids]
+
+
+class FakeQuery:
+  '''A query builder over a list of rows, with the filters used by the store.'''
+
+  def __init__(self, client: 'FakeClient') -> None:
+    self.client = client
+    self.rows = client.rows
+    self.columns = '*'
+    self.count = None
+
+  def schema(self, _name: str) -> 'FakeQuery':
+    '''Selects the schema, which holds the only table.'''
+    return self
+
+  def table(self, _name: str) -> 'FakeQuery':
+    '''Selects the table, which is the only one.'''
+    return self
+
+  def select(self, columns: str) -> 'FakeQuery':
+    '''Selects the columns, either every column or the ids.'''
+    self.columns = columns
+    return self
+
+  def gt(self, column: str, value) -> 'FakeQuery':
+    '''Keeps the rows with a greater value.'''
+    self.rows = [row for row in self.rows if row[column] > value]
+    return self
+
+  def lte(self, column: str, value) -> 'FakeQuery':
+    '''Keeps the rows with a lower or equal value.'''
+    self.rows = [row for row in self.rows if row[column] <= value]
+    return self
+
+  def order(self, column: str, desc: bool = False) -> 'FakeQuery':
+    '''Sorts the rows.'''
+    self.rows = sorted(self.rows, key=lambda row: row[column], reverse=desc)
+    return self
+
+  def limit(self, count: int) -> 'FakeQuery':
+    '''Limits the number of rows returned, to at most the row limit of the client.'''
+    self.count = min(count, self.client.max_rows)
+    return self
+
+  def execute(self):
+    '''Returns a response with the rows selected.'''
+    with self.client.lock:
+      self.client.requests += 1
+    rows = self.rows[:self.count] if self.count is not None else self.rows
+    if self.columns == 'id':
+      rows = [{'id': row['id']} for row in rows]
+
+    class Response:  # pylint: disable=too-few-public-methods
+      '''A response with the rows as data.'''
+      data = rows
+    return Response()
+
+
+class FakeClient:  # pylint: disable=too-few-public-methods
+  '''A Supabase client over the rows of the text_responses table.'''
+
+  def __init__(self, rows: list[dict], max_rows: int = 1000) -> None:
+    self.rows = rows
+    self.max_rows = max_rows
+    self.requests = 0
+    self.lock = threading.Lock()
+
+  def schema(self, name: str) -> FakeQuery:
+    '''Starts a query.'''
+    return FakeQuery(self).schema(name)
+
+
+class SupabaseTestCase(unittest.TestCase):
+  '''Runs the store against a fake client in a temporary data folder.'''
+
+  def setUp(self):
+    self.client = FakeClient(make_rows([i for i in range(1, 300) if i % 7]))
+    self.folder = tempfile.mkdtemp()
+    self.store_dir = os.path.join(self.folder, 'store')
+    self.snapshot_dir = os.path.join(self.folder, 'snapshots')
+
+    patches = [patch('store.create_client', return_value=self.client),
+               patch('store.load_dotenv'),
+               patch.dict(os.environ, {'SUPABASE_URL': 'url', 'SUPABASE_SERVICE_ROLE_KEY': 'key'})]
+    for p in patches:
+      p.start()
+      self.addCleanup(p.stop)
+    self.addCleanup(shutil.rmtree, self.folder)
+
+  def stored_ids(self) -> list[int]:
+    '''Returns the ids read back from the local store.'''
+    path = os.path.join(self.store_dir, 'text_responses')
+    return [i for batch in parquet_store.iter_table(path, ['id'])
+            for i in batch.column('id').to_pylist()]
+
+
+class TestStore(SupabaseTestCase):
+  '''Test cases for the store module.'''
+
+  def test_text_response_pages_in_order(self):
+    '''Test the id ranges are yielded in order, without gaps or duplicates.'''
+    pages = list(store.textResponsePages(self.client, page_size=7, max_workers=3))
+
+    ids = [i for page in pages for i in page['id'].to_pylist()]
+    self.assertEqual(ids, [row['id'] for row in self.client.rows])
+    self.assertTrue(all(len(page) <= 7 for page in pages))
+
+  def test_text_response_pages_after(self):
+    '''Test only the rows after the given id are fetched.'''
+    pages = list(store.textResponsePages(self.client, after=250, page_size=10, max_workers=4))
+
+    ids = [i for page in pages for i in page['id'].to_pylist()]
+    self.assertEqual(ids, [row['id'] for row in self.client.rows if row['id'] > 250])
+
+  def test_text_response_pages_above_server_limit(self):
+    '''Test pages cut short by the row limit of the server do not end a range.'''
+    self.client.max_rows = 6
+    pages = list(store.textResponsePages(self.client, page_size=10, max_workers=2))
+
+    ids = [i for page in pages for i in page['id'].to_pylist()]
+    self.assertEqual(ids, [row['id'] for row in self.client.rows])
+
+  def test_text_response_pages_bounded(self):
+    '''Test each range fetches only a few pages ahead, and stops when the caller stops.'''
+    pages = store.textResponsePages(self.client, page_size=5, max_workers=2)
+    next(pages)
+    threading.Event().wait(0.3)
+
+    # the first and last id, then for each range the pages queued and one waiting to be queued
+    self.assertLessEqual(self.client.requests, 2 + 2 * (store.PAGES_AHEAD + 2))
+    pages.close()
+
+  def test_text_response_pages_empty(self):
+    '''Test nothing is yielded when there are no new rows.'''
+    self.assertEqual(list(store.textResponsePages(self.client, after=1000)), [])
+
+  def test_to_store_table_promotes_null(self):
+    '''Test a column without values on a page takes the type of the other pages.'''
+    first = pa.Table.from_pylist(make_rows([1, 2]))
+    second = pa.Table.from_pylist([{**row, 'user_id': 'user'} for row in make_rows([3])])
+    self.assertEqual(first.schema.field('user_id').type, pa.null())
+
+    table = parquet_store.to_store_table([first, second])
+    self.assertEqual(table.schema.field('user_id').type, pa.string())
+    self.assertEqual(table.schema.field('dev_level').type, pa.int8())
+    self.assertEqual(table['user_id'].to_pylist(), [None, None, 'user'])
+
+  def test_write_part_null_first_page(self):
+    '''Test a column without values on the first page takes its type from the store layout.'''
+    path = os.path.join(self.folder, 'part.parquet')
+    pages = [pa.Table.from_pylist(make_rows([1])),
+             pa.Table.from_pylist([{**row, 'user_id': 'user'} for row in make_rows([2])])]
+
+    self.assertEqual(parquet_store.write_part(path, pages), (2, 2))
+    self.assertEqual(pq.read_schema(path).field('user_id').type, pa.string())
+
+  def test_query_supabase_incremental(self):
+    '''Test a second query only fetches and stores the rows added since the first.'''
+    df = store.querySupabase(store_dir=self.store_dir)
+    self.assertEqual(df['id'].tolist(), [row['id'] for row in self.client.rows])
+
+    self.client.rows = self.client.rows + make_rows([400, 401])
+    df = store.querySupabase(store_dir=self.store_dir)
+
+    self.assertEqual(len(df), len(self.client.rows))
+    self.assertEqual(parquet_store.read_sync_state(self.store_dir),
+                     {'text_responses': {'id': 401, 'rows': len(self.client.rows)}})
+    self.assertEqual(len(glob.glob(os.path.join(self.store_dir, 'text_responses', '*'))), 2)
+
+  def test_query_supabase_new_column_refetches(self):
+    '''Test a column added after the first query makes the next one fetch every row again.'''
+    store.querySupabase(store_dir=self.store_dir)
+    self.client.rows = [{**row, 'source': 'form'} for row in self.client.rows + make_rows([400])]
+
+    with contextlib.redirect_stdout(io.StringIO()):
+      df = store.querySupabase(store_dir=self.store_dir)
+
+    self.assertEqual(df['source'].tolist(), ['form'] * len(self.client.rows))
+    self.assertEqual(os.listdir(os.path.join(self.store_dir, 'text_responses')),
+                     ['part-00000.parquet'])
+    self.assertEqual(parquet_store.read_sync_state(self.store_dir),
+                     {'text_responses': {'id': 400, 'rows': len(self.client.rows)}})
+
+  def test_iter_store_drops_interrupted_append(self):
+    '''Test rows stored again by an interrupted run are only read once.'''
+    store.querySupabase(store_dir=self.store_dir)
+    self.client.rows = self.client.rows + make_rows([400, 401])
+    store.querySupabase(store_dir=self.store_dir)
+
+    # an append whose sync state was never written is fetched and stored again
+    path = os.path.join(self.store_dir, 'text_responses')
+    shutil.copy(os.path.join(path, 'part-00001.parquet'), os.path.join(path, 'part-00002.parquet'))
+
+    self.assertEqual(self.stored_ids(), [row['id'] for row in self.client.rows])
+
+  def test_iter_text_responses_batches(self):
+    '''Test the rows are read back in batches of the requested columns.'''
+    batches = list(store.iterTextResponses(store_dir=self.store_dir, columns=['id', 'text'],
+                                           batch_size=50))
+
+    self.assertTrue(all(batch.num_rows <= 50 for batch in batches))
+    self.assertEqual(batches[0].schema.names, ['id', 'text'])
+    self.assertEqual(sum(batch.num_rows for batch in batches), len(self.client.rows))
+
+  def test_iter_text_responses_dry_run(self):
+    '''Test a dry run reads the new rows without storing them.'''
+    store.querySupabase(store_dir=self.store_dir)
+    self.client.rows = self.client.rows + make_rows([400])
+
+    batches = list(store.iterTextResponses(store_dir=self.store_dir, dry_run=True))
+
+    self.assertEqual(sum(batch.num_rows for batch in batches), len(self.client.rows))
+    self.assertEqual(parquet_store.read_sync_state(self.store_dir)['text_responses']['id'], 299)
+
+
+class FakeAugmenter:  # pylint: disable=too-few-public-methods
+  '''An augmenter that replaces a word with one of a few synonyms.'''
+
+  def __init__(self, synonyms: int = 3) -> None:
+    self.synonyms = synonyms
+    self.calls = 0
+
+  def augment(self, text: str, n: int = 1) -> list[str]:
+    '''Returns ``n`` samples of the text, which may repeat.'''
+    self.calls += 1
+    return [f'{text} {np.random.randint(self.synonyms)}' for _ in range(n)]
+
+
+class TestAugment(unittest.TestCase):
+  '''Test cases for the augmentation in the utils module.'''
+
+  def setUp(self):
+    self.df = pd.DataFrame({'text': ['a b', 'c d', 'a b'], 'dev_level': [0, 1, 0]})
+    self.folder = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.folder)
+
+  def test_augment_data_is_reproducible(self):
+    '''Test a text always gets the same samples.'''
+    with patch('utils.synonymAugmenter', return_value=FakeAugmenter(synonyms=1000)):
+      first = utils.augmentData(self.df, samples=2, max_workers=1)
+      second = utils.augmentData(self.df.iloc[::-1], samples=2, max_workers=1)
+
+    self.assertEqual(len(first), 9)
+    self.assertEqual(sorted(first['text']), sorted(second['text']))
+
+  def test_augment_data_drops_repeated_samples(self):
+    '''Test samples repeating the text or another sample of it are left out.'''
+    with patch('utils.synonymAugmenter', return_value=FakeAugmenter(synonyms=1)):
+      df = utils.augmentData(self.df, samples=4, max_workers=1)
+
+    self.assertEqual(df['text'].tolist(), ['a b', 'c d', 'a b', 'a b 0', 'c d 0', 'a b 0'])
+
+  def test_augment_data_cache(self):
+    '''Test samples in the cache are not generated again.'''
+    cache_path = os.path.join(self.folder, 'augment.sqlite')
+    augmenter = FakeAugmenter(synonyms=1000)
+    with patch('utils.synonymAugmenter', return_value=augmenter):
+      first = utils.augmentData(self.df, samples=2, max_workers=1, cache_path=cache_path)
+      self.assertEqual(augmenter.calls, 4)
+
+      second = utils.augmentData(self.df, samples=3, max_workers=1, cache_path=cache_path)
+      self.assertEqual(augmenter.calls, 6)
+
+    self.assertTrue(set(first['text']) <= set(second['text']))
+
+  def test_augment_data_dry_run_cache(self):
+    '''Test a dry run does not add samples to the cache.'''
+    cache_path = os.path.join(self.folder, 'augment.sqlite')
+    with patch('utils.synonymAugmenter', return_value=FakeAugmenter()):
+      utils.augmentData(self.df, samples=2, max_workers=1, cache_path=cache_path, dry_run=True)
+
+    self.assertEqual(utils.readAugmentCache(cache_path, ['x'], 42, 2), {})
+
+
+class TestDataset(unittest.TestCase):
+  '''Test cases for the dataset module.'''
+
+  def setUp(self):
+    self.folder = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.folder)
+    self.texts = [f'text {i}' for i in range(25)]
+    self.levels = [i % 4 for i in range(25)]
+
+  def test_assign_splits(self):
+    '''Test rows are split by their id, whatever the batch they are read in.'''
+    ids = np.arange(20000)
+    splits = dataset.assignSplits(ids, 0.8)
+
+    np.testing.assert_array_equal(splits[100:200], dataset.assignSplits(ids[100:200], 0.8))
+    proportions = np.bincount(splits, minlength=3) / len(ids)
+    np.testing.assert_allclose(proportions, [0.8, 0.1, 0.1], atol=0.02)
+
+  def test_keras_folder_writer(self):
+    '''Test each sample is written once to the folder of its set and class.'''
+    destination = os.path.join(self.folder, 'keras')
+    with dataset.KerasFolderWriter(destination, classes=[0, 1, 2], buffer_size=4) as writer:
+      writer.write('train', self.texts, self.levels)
+      writer.write('test', ['last'], [1])
+
+    files = glob.glob(os.path.join(destination, '*', '*', '*.txt'))
+    self.assertEqual(len(files), 20)
+    self.assertEqual(len(os.listdir(os.path.join(destination, 'train', 'early_dev'))), 6)
+    self.assertFalse(os.path.exists(os.path.join(destination, 'train', 'entrustable')))
+    with open(os.path.join(destination, 'test', 'early_dev', '19.txt'), encoding='utf-8') as f:
+      self.assertEqual(f.read(), 'last')
+    self.assertEqual(writer.counts['train'].tolist(), [7, 6, 6, 0])
+
+  def test_sharded_dataset_writer(self):
+    '''Test the samples are written in shards with the labels of text_dataset_from_directory.'''
+    destination = os.path.join(self.folder, 'sharded')
+    with dataset.ShardedDatasetWriter(destination, shard_size=10) as writer:
+      writer.write('train', self.texts, self.levels)
+
+    with open(os.path.join(destination, dataset.DATASET_METADATA_NAME), encoding='utf-8') as f:
+      metadata = json.load(f)
+    self.assertEqual(metadata['class_names'], sorted(dataset.CLASS_NAMES))
+    self.assertEqual(metadata['splits']['train'], {'rows': 25, 'shards': 3})
+
+    table = pq.read_table(sorted(glob.glob(os.path.join(destination, 'train', '*.parquet'))))
+    self.assertEqual(table['text'].to_pylist(), self.texts)
+    names = [metadata['class_names'][label] for label in table['label'].to_pylist()]
+    self.assertEqual(names, [dataset.CLASS_NAMES[level] for level in self.levels])
+
+  def test_sharded_dataset_force_removes_old_shards(self):
+    '''Test an export over an earlier, larger one leaves only its own shards.'''
+    destination = os.path.join(self.folder, 'sharded')
+    df = pd.DataFrame({'text': self.texts, 'dev_level': self.levels})
+    with contextlib.redirect_stdout(io.StringIO()):
+      dataset.exportShardedDataset(df, df, df, destination, shard_size=5)
+      dataset.exportShardedDataset(df[:5], df[:5], df[:5], destination, shard_size=5, force=True)
+
+    self.assertEqual(os.listdir(os.path.join(destination, 'train')), ['part-00000.parquet'])
+
+  def test_writer_raises_write_error(self):
+    '''Test an error writing a buffer is raised when the writer is closed.'''
+    writer = dataset.KerasFolderWriter(os.path.join(self.folder, 'keras'), buffer_size=5)
+    with patch.object(writer, '_writeBuffer', side_effect=OSError('disk full')):
+      with self.assertRaises(OSError):
+        with writer:
+          writer.write('train', self.texts, self.levels)
+
+  def test_export_text_responses(self):
+    '''Test record batches are exported in one pass, augmenting only the training rows.'''
+    table = pa.Table.from_pylist(make_rows(range(1, 101))).select(['id', 'text', 'dev_level'])
+
+    def augment(df: pd.DataFrame) -> pd.DataFrame:
+      '''Adds one sample of each row.'''
+      return pd.concat([df, df.assign(text=df['text'] + ' augmented')], ignore_index=True)
+
+    writer = dataset.ShardedDatasetWriter(os.path.join(self.folder, 'sharded'), shard_size=30)
+    dataset.exportTextResponses(table.to_batches(max_chunksize=16), writer, augment=augment)
+
+    splits = np.bincount(dataset.assignSplits(range(1, 101)), minlength=3)
+    self.assertEqual([int(writer.counts[split].sum()) for split in dataset.SPLITS],
+                     [splits[0] * 2, splits[1], splits[2]])
+
+  def test_load_sharded_dataset_reads_listed_shards(self):
+    '''Test only the shards listed in the metadata are loaded.'''
+    if importlib.util.find_spec('tensorflow') is None:
+      self.skipTest('TensorFlow is not installed')
+
+    destination = os.path.join(self.folder, 'sharded')
+    with dataset.ShardedDatasetWriter(destination, shard_size=10) as writer:
+      writer.write('train', self.texts, self.levels)
+    shutil.copy(os.path.join(destination, 'train', 'part-00000.parquet'),
+                os.path.join(destination, 'train', 'part-00007.parquet'))
+
+    loaded = dataset.loadShardedDataset(destination, 'train', shuffle=False)
+    self.assertEqual(sum(int(texts.shape[0]) for texts, _ in loaded), 25)
+    self.assertEqual(loaded.class_names, sorted(dataset.CLASS_NAMES))
+
+
+class TestSnapshot(SupabaseTestCase):
+  '''Test cases for the snapshot module.'''
+
+  def take_snapshot(self, **options) -> str:
+    '''Takes a snapshot of the fake table and returns its path.'''
+    with snapshot.textResponsesSnapshot(store_dir=self.store_dir, snapshot_dir=self.snapshot_dir,
+                                        **options) as path:
+      return path
+
+  def test_digest_does_not_depend_on_batches(self):
+    '''Test the same rows give the same digest however they are batched.'''
+    table = pa.Table.from_pylist(make_rows(range(1, 101)))
+    digests = []
+    for batch_size in [7, 100]:
+      path = os.path.join(self.folder, str(batch_size))
+      os.makedirs(path)
+      manifest = snapshot.writeSnapshot(path, table.to_batches(max_chunksize=batch_size))
+      digests.append(manifest['digest'])
+
+    self.assertEqual(digests[0], digests[1])
+    self.assertEqual(manifest['rows'], 100)
+    self.assertEqual(manifest['last_id'], 100)
+
+  def test_snapshot_reused_while_store_unchanged(self):
+    '''Test an unchanged store reuses the last snapshot without copying the store.'''
+    path = self.take_snapshot()
+    self.assertEqual(snapshot.readSnapshot(path)['id'].tolist(),
+                     [row['id'] for row in self.client.rows])
+
+    with patch('snapshot.copySnapshot') as copy:
+      self.assertEqual(self.take_snapshot(), path)
+    copy.assert_not_called()
+
+    self.client.rows = self.client.rows + make_rows([400])
+    new_path = self.take_snapshot()
+    self.assertNotEqual(new_path, path)
+    self.assertEqual(snapshot.findSnapshot('latest', self.snapshot_dir), new_path)
+
+  def test_snapshot_same_content_after_full_refresh(self):
+    '''Test a full refresh of the same rows gives the same snapshot.'''
+    path = self.take_snapshot()
+    self.assertEqual(self.take_snapshot(full_refresh=True), path)
+    self.assertEqual(len(os.listdir(self.snapshot_dir)), 2)  # the snapshot and LATEST
+
+  def test_snapshot_given_does_not_query(self):
+    '''Test an existing snapshot is used without querying Supabase.'''
+    path = self.take_snapshot()
+    requests = self.client.requests
+
+    self.assertEqual(self.take_snapshot(snapshot=os.path.basename(path)[:6]), path)
+    self.assertEqual(self.client.requests, requests)
+    with self.assertRaises(ValueError):
+      self.take_snapshot(snapshot='not-a-digest')
+
+  def test_old_snapshots_pruned(self):
+    '''Test only the most recent snapshots are kept.'''
+    paths = []
+    for i in range(4):
+      self.client.rows = self.client.rows + make_rows([400 + i])
+      paths.append(self.take_snapshot(keep=2))
+
+    kept = sorted(os.path.dirname(path) for path
+                  in glob.glob(os.path.join(self.snapshot_dir, '*', 'manifest.json')))
+    self.assertEqual(kept, sorted(paths[-2:]))
+
+  def test_dry_run_snapshot_removed(self):
+    '''Test a dry run leaves no snapshot behind.'''
+    path = self.take_snapshot(dry_run=True)
+    self.assertFalse(os.path.exists(path))
+    self.assertFalse(os.path.exists(self.snapshot_dir))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -2,71 +2,23 @@
 Utility functions for the BERT model.
 '''
 
+import contextlib
+import functools
+import hashlib
 import os
+import random
+import sqlite3
+from concurrent.futures import Executor, ProcessPoolExecutor
 
+import nlpaug
 import nlpaug.augmenter.word as naw
+import numpy as np
 import pandas as pd
 
-from dotenv import load_dotenv
-from postgrest.types import CountMethod
-from supabase import Client, create_client
 
-
-def querySupabase(verbose: bool = False) -> pd.DataFrame:
-  '''
-  Queries the Supabase database for text responses and returns the data as a pandas DataFrame.
-
-  :param verbose: If True, print verbose output. Defaults to False.
-  :type verbose: bool
-
-  :return: A pandas DataFrame containing the text responses.
-  :rtype: pd.DataFrame
-
-  :raises ValueError: If the Supabase URL or key is not found in the environment variables.
-  '''
-
-  # Load environment variables from .env file
-  load_dotenv()
-  url: str = os.environ.get("SUPABASE_URL", "")
-  key: str = os.environ.get("SUPABASE_SERVICE_ROLE_KEY", "")
-
-  if url == "" or key == "":
-    raise ValueError("Supabase URL or key not found in environment variables.")
-
-  supabase: Client = create_client(url, key)
-
-  if verbose:
-    print("Querying Supabase database...")
-
-  # queries are limited to 1000 rows
-  response = (
-      supabase.schema("trainingdata")
-      .table("text_responses")
-      .select("*", count=CountMethod.exact)
-      .execute()
-  )
-
-  df = pd.DataFrame(response.data)
-  count = response.count
-
-  if count is None:
-    raise ValueError("Supabase response count is None.")
-
-  # loop until all rows are loaded
-  while len(df) < count:
-    response = (
-        supabase.schema("trainingdata")
-        .table("text_responses")
-        .select("*")
-        .range(len(df), len(df) + 1000)
-        .execute()
-    )
-    df = pd.concat([df, pd.DataFrame(response.data)])
-
-  if verbose:
-    print(f'Loaded {len(df)} rows out of {count}')
-
-  return df
+AUGMENT_CACHE_PATH = os.path.join('data', 'cache', 'augment.sqlite')
+# identifies the augmenter in the augmentation cache, as another nlpaug version may differ
+AUGMENTER_CONFIG = f"SynonymAug(aug_src='wordnet')/nlpaug-{getattr(nlpaug, '__version__', '')}"
 
 
 def augmentData(
@@ -74,11 +26,28 @@ def augmentData(
     text_col_label: str = 'text',
     level_col_label: str = 'dev_level',
     samples: int = 0,
-    verbose: bool = False
+    verbose: bool = False,
+    max_workers: int | None = None,
+    seed: int = 42,
+    cache_path: str | None = None,
+    dry_run: bool = False,
+    pool: Executor | None = None,
 ) -> pd.DataFrame:
   '''
   Augments the data to create more samples.
 
+  Each augmented sample is generated on its own, with the random generators seeded from ``seed``,
+  the text and the index of the sample, so a text always gets the same samples. Samples that
+  repeat the text or an earlier sample of it are left out, like ``augment(text, n=samples)``
+  does. The texts are
+  split into chunks that are augmented in a pool of ``max_workers`` processes, and each process
+  keeps the WordNet synonyms of the words it has already looked up. Pass a ``pool`` to augment
+  several DataFrames in the same processes, keeping their synonyms from one call to the next.
+
+  With ``cache_path``, the samples are kept in a SQLite cache keyed by the hash of the text, the
+  augmenter, the seed and the index of the sample, and only the samples not in the cache are
+  generated.
+
   :param df: The DataFrame to augment.
   :type df: DataFrame
 
@@ -91,8 +60,24 @@ def augmentData(
   :param level_col_label: The label of the level column. Defaults to ``'dev_level'``.
   :type level_col_label: str
 
-  :param synonym: The number of augmented samples to generate. Defaults to 0.
-  :type synonym: int
+  :param samples: The number of augmented samples to generate per row. Defaults to 0.
+  :type samples: int
+
+  :param max_workers: The number of processes. Defaults to the number of CPUs.
+  :type max_workers: int | None
+
+  :param seed: The seed of the augmentation. Defaults to 42.
+  :type seed: int
+
+  :param cache_path: The path of the augmentation cache. Defaults to None, for no cache.
+  :type cache_path: str | None
+
+  :param dry_run: If True, do not add the new samples to the cache. Defaults to False.
+  :type dry_run: bool
+
+  :param pool: A process pool of ``max_workers`` processes to augment the texts in. Defaults to
+  None, for a new pool that is shut down before returning.
+  :type pool: Executor | None
 
   :return: The augmented DataFrame.
   :rtype: DataFrame
@@ -107,31 +92,71 @@ def augmentData(
   if level_col_label not in df.columns:
     raise ValueError(f"The DataFrame must have a column labeled '{level_col_label}'.")
 
-  if samples == 0:
+  if samples == 0 or df.empty:
     return df
 
-  # Augmentation setups
-  synonym_aug = naw.SynonymAug(aug_src='wordnet')
-
-  # Create a DataFrame to hold augmented rows
-  augmented_rows = []
-
   if verbose:
     print(f"Generating {samples} augmented samples per sample...")
 
-  # Iterate through each row in the DataFrame
-  for _, row in df.iterrows():
-    original_text = row[text_col_label]
-    level = row[level_col_label]
-
-    # Apply synonym replacement if enabled
-    if samples and synonym_aug:
-      augmented_texts = synonym_aug.augment(original_text, n=samples)
-      for aug_text in augmented_texts:
-        augmented_rows.append({text_col_label: aug_text, level_col_label: level})
-
-  # Convert the augmented rows into a DataFrame
-  augmented_df = pd.DataFrame(augmented_rows)
+  texts = df[text_col_label].tolist()
+  hashes = [hashlib.sha256(str(text).encode()).hexdigest() for text in texts]
+  unique = dict(zip(hashes, texts))
+
+  variations = readAugmentCache(cache_path, list(unique), seed, samples) if cache_path else {}
+  # the texts with samples to generate, and the indices of these samples
+  missing = []
+  for text_hash, text in unique.items():
+    indices = [i for i in range(samples) if i not in variations.get(text_hash, {})]
+    if indices:
+      missing.append((text_hash, text, indices))
+
+  if verbose and cache_path:
+    cached = len(unique) * samples - sum(len(indices) for _, _, indices in missing)
+    print(f"Found {cached} of {len(unique) * samples} samples in the augmentation cache.")
+
+  if missing:
+    max_workers = min(max_workers or os.cpu_count() or 1, len(missing))
+    # a few chunks per process, so that a process with slow texts does not hold up the others
+    bounds = np.linspace(0, len(missing), min(max_workers * 4, len(missing)) + 1, dtype=int)
+    chunks = [([(text, indices) for _, text, indices in missing[start:end]], seed)
+              for start, end in zip(bounds, bounds[1:])]
+
+    if pool is not None:
+      results = list(pool.map(augmentChunk, chunks))
+    elif max_workers > 1:
+      with ProcessPoolExecutor(max_workers=max_workers) as new_pool:
+        results = list(new_pool.map(augmentChunk, chunks))
+    else:
+      results = [augmentChunk(chunk) for chunk in chunks]
+
+    generated = []
+    text_results = (result for chunk_results in results for result in chunk_results)
+    for (text_hash, _, indices), result in zip(missing, text_results):
+      for i, variation in zip(indices, result):
+        variations.setdefault(text_hash, {})[i] = variation
+        generated.append((text_hash, i, variation))
+
+    if cache_path and not dry_run:
+      writeAugmentCache(cache_path, generated, seed)
+
+  # at most `samples` variations per row; fewer when a text has no synonyms to replace, or when
+  # separate samples of a text with few synonyms come out the same and are kept once
+  augmented_texts = np.empty(len(texts) * samples, dtype=object)
+  augmented_levels = np.empty(len(texts) * samples, dtype=df[level_col_label].dtype)
+  levels = df[level_col_label].to_numpy()
+  filled = 0
+  for text, text_hash, level in zip(texts, hashes, levels):
+    seen = {str(text)}
+    for i in range(samples):
+      variation = variations[text_hash][i]
+      if variation is not None and variation not in seen:
+        seen.add(variation)
+        augmented_texts[filled] = variation
+        augmented_levels[filled] = level
+        filled += 1
+
+  augmented_df = pd.DataFrame({text_col_label: augmented_texts[:filled],
+                               level_col_label: augmented_levels[:filled]})
 
   if verbose:
     print(f"Generated {len(augmented_df)} augmented samples.")
@@ -142,6 +167,123 @@ def augmentData(
   return result_df
 
 
+_synonym_aug = None
+
+
+def synonymAugmenter() -> naw.SynonymAug:
+  '''
+  Returns the WordNet synonym augmenter of the current process, creating it on the first call.
+  The synonyms of each word and part of speech are looked up in WordNet once per process.
+
+  :return: The augmenter.
+  :rtype: naw.SynonymAug
+  '''
+  global _synonym_aug  # pylint: disable=global-statement
+  if _synonym_aug is None:
+    augmenter = naw.SynonymAug(aug_src='wordnet')
+    lookup = augmenter.model.predict
+    cached = functools.lru_cache(maxsize=None)(lambda word, pos: tuple(lookup(word, pos=pos)))
+    # the augmenter filters the synonyms it gets, so it is given a new list each time
+    augmenter.model.predict = lambda word, pos=None: list(cached(word, pos))
+    _synonym_aug = augmenter
+  return _synonym_aug
+
+
+def augmentChunk(chunk: tuple[list[tuple[str, list[int]]], int]) -> list[list[str | None]]:
+  '''
+  Augments a chunk of texts, in a worker process of :func:`augmentData`.
+
+  :param chunk: The texts with the indices of the samples to generate for each, and the seed.
+  :type chunk: tuple[list[tuple[str, list[int]]], int]
+
+  :return: The sample of each index of each text, or None if the text could not be augmented.
+  :rtype: list[list[str | None]]
+  '''
+  texts, seed = chunk
+  augmenter = synonymAugmenter()
+
+  variations = []
+  for text, indices in texts:
+    text_variations = []
+    for i in indices:
+      sample_seed = int.from_bytes(hashlib.sha256(f'{seed}:{i}:{text}'.encode()).digest()[:4])
+      random.seed(sample_seed)
+      np.random.seed(sample_seed)
+      augmented = augmenter.augment(text, n=1)
+      text_variations.append(augmented[0] if augmented else None)
+    variations.append(text_variations)
+  return variations
+
+
+def readAugmentCache(
+    cache_path: str,
+    hashes: list[str],
+    seed: int,
+    samples: int,
+) -> dict[str, dict[int, str | None]]:
+  '''
+  Reads the cached samples of the given texts.
+
+  :param cache_path: The path of the augmentation cache.
+  :type cache_path: str
+
+  :param hashes: The SHA-256 hashes of the texts.
+  :type hashes: list[str]
+
+  :param seed: The seed of the augmentation.
+  :type seed: int
+
+  :param samples: The number of samples per text.
+  :type samples: int
+
+  :return: A dictionary mapping the hashes of the texts to dictionaries mapping the indices of
+    their cached samples to the samples.
+  :rtype: dict[str, dict[int, str | None]]
+  '''
+  if not os.path.exists(cache_path):
+    return {}
+
+  variations = {}
+  with contextlib.closing(sqlite3.connect(cache_path)) as connection:
+    # SQLite limits the number of parameters of a query
+    for start in range(0, len(hashes), 500):
+      batch = hashes[start:start + 500]
+      rows = connection.execute(
+          'SELECT text_hash, sample, text FROM augmentations WHERE augmenter = ? AND seed = ? '
+          f'AND sample < ? AND text_hash IN ({", ".join("?" * len(batch))})',
+          [AUGMENTER_CONFIG, seed, samples, *batch])
+      for text_hash, i, text in rows:
+        variations.setdefault(text_hash, {})[i] = text
+  return variations
+
+
+def writeAugmentCache(
+    cache_path: str,
+    generated: list[tuple[str, int, str | None]],
+    seed: int,
+) -> None:
+  '''
+  Adds samples to the augmentation cache.
+
+  :param cache_path: The path of the augmentation cache.
+  :type cache_path: str
+
+  :param generated: The hash of the text, the index and the sample of each new sample.
+  :type generated: list[tuple[str, int, str | None]]
+
+  :param seed: The seed of the augmentation.
+  :type seed: int
+  '''
+  os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+  with contextlib.closing(sqlite3.connect(cache_path)) as connection, connection:
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS augmentations (text_hash TEXT, augmenter TEXT, seed INTEGER, '
+        'sample INTEGER, text TEXT, PRIMARY KEY (text_hash, augmenter, seed, sample))')
+    connection.executemany(
+        'INSERT OR REPLACE INTO augmentations VALUES (?, ?, ?, ?, ?)',
+        [(text_hash, AUGMENTER_CONFIG, seed, i, text) for text_hash, i, text in generated])
+
+
 def equalizeClasses(
     df: pd.DataFrame,
     level_col_label: str = 'dev_level',
@@ -171,157 +313,3 @@ def equalizeClasses(
 
   # equalize the number of samples in each class
   return df.groupby(level_col_label).apply(lambda x: x.sample(min_rows, random_state=42))
-
-
-def exportKerasFolder(
-    train_df: pd.DataFrame,
-    val_df: pd.DataFrame,
-    test_df: pd.DataFrame,
-    destination: str,
-    text_col_label: str = 'text',
-    level_col_label: str = 'dev_level',
-    class_names: list[str] | None = None,
-    verbose: bool = False,
-    dry_run: bool = False,
-    force: bool = False,
-) -> None:
-  '''
-  Export the DataFrame to a folder in Keras format.
-  The folder will be compatible with ``keras.utils.text_dataset_from_directory``.
-  The directory structure will be as follows: :
-
-    train/
-    ├── remedial/
-    │   ├── 0.txt
-    │   ├── 1.txt
-    │   └── ...
-    ├── early_dev/
-    │   ├── 2.txt
-    │   ├── 3.txt
-    │   └── ...
-    └── ...
-    test/
-    ├── remedial/
-    │   ├── 4.txt
-    │   ├── 5.txt
-    │   └── ...
-    └── ...
-
-  where each class is a folder, and each file is a text file containing the description.
-
-  :param train_df: The training DataFrame.
-  :type train_df: DataFrame
-
-  :param val_df: The validation DataFrame.
-  :type val_df: DataFrame
-
-  :param test_df: The testing DataFrame.
-  :type test_df: DataFrame
-
-  :param destination: The destination folder.
-  :type destination: str
-
-  :param text_col_label: The label of the text column. Defaults to ``'text'``.
-  :type text_col_label: str
-
-  :param level_col_label: The label of the level column. Defaults to ``'dev_level'``.
-  :type level_col_label: str
-
-  :param class_names: The names of the classes.
-  Defaults to ``['remedial', 'early_dev', 'developing', 'entrustable']``.
-  :type class_names: list[str]
-
-  :param verbose: If True, print verbose output. Defaults to False.
-  :type verbose: bool
-
-  :param dry_run: If True, do not write any files. Defaults to False.
-  :type dry_run: bool
-
-  :param force: If True, force overwrite the destination folder. Defaults to False.
-  :type force: bool
-  '''
-  if class_names is None:
-    class_names = ['remedial', 'early_dev', 'developing', 'entrustable']
-  classes = train_df[level_col_label].unique()
-
-  # if os.path.exists(destination):
-  #   if force:
-  #     if verbose:
-  #       print(f'Removing existing folder {destination}...')
-  #     shutil.rmtree(destination)
-  #   else:
-  #     raise ValueError(
-  #         f'Destination folder {destination} already exists. Use --force to overwrite.')
-
-  if not dry_run:
-    if verbose:
-      print(f'Creating folder {destination}...')
-    os.makedirs(destination)
-    for c in classes:
-      os.makedirs(os.path.join(destination, 'train', class_names[c]), exist_ok=force)
-      os.makedirs(os.path.join(destination, 'validate', class_names[c]), exist_ok=force)
-      os.makedirs(os.path.join(destination, 'test', class_names[c]), exist_ok=force)
-  else:
-    if verbose:
-      print(f'Would create folder {destination}...')
-
-  if verbose:
-    print(f'Exporting {len(train_df)} training, {len(val_df)} validation, and {len(test_df)} '
-          f'testing samples ({len(train_df) + len(val_df) + len(test_df)} total)...')
-
-  for df, split in [(train_df, 'train'), (val_df, 'validate'), (test_df, 'test')]:
-    for c in classes:
-      class_df = df[df[level_col_label] == c]
-      if dry_run:
-        if verbose:
-          print(f'Would write {len(class_df)} {split} samples for class {class_names[c]}')
-      else:
-        if verbose:
-          print(f'Writing {len(class_df)} {split} samples for class {class_names[c]}')
-        for i, row in class_df.iterrows():
-          with open(os.path.join(destination, split, class_names[c], f'{i}.txt'), 'w') as f:
-            f.write(str(row[text_col_label]))
-
-
-def exportDfPickle(
-    df: pd.DataFrame,
-    destination: str,
-    verbose: bool = False,
-    dry_run: bool = False,
-    force: bool = False,
-) -> None:
-  '''
-  Export the DataFrame to a pickle file.
-
-  :param df: The DataFrame to export.
-  :type df: DataFrame
-
-  :param destination: The destination file.
-  :type destination: str
-
-  :param verbose: If True, print verbose output. Defaults to False.
-  :type verbose: bool
-
-  :param dry_run: If True, do not write any files. Defaults to False.
-  :type dry_run: bool
-
-  :param force: If True, force overwrite the destination file. Defaults to False.
-  :type force: bool
-  '''
-
-  if os.path.exists(destination):
-    if force:
-      if verbose:
-        print(f'Removing existing file {destination}...')
-      os.remove(destination)
-    else:
-      raise ValueError(
-          f'Destination file {destination} already exists. Use --force to overwrite.')
-
-  if not dry_run:
-    if verbose:
-      print(f'Exporting DataFrame to {destination}...')
-    df.to_pickle(destination)
-  else:
-    if verbose:
-      print(f'Would export DataFrame to {destination}')
@@ -0,0 +1,145 @@
+'''
+LRU cache with a time-to-live for inference results.
+
+Raters often resubmit forms and many answers are short and repeated, so the inference functions
+look up each sentence and each MCQ answer here before running a model. Keys include the model
+version, so results of a replaced model are never served and simply age out.
+'''
+
+import hashlib
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class InferenceCache:
+  '''
+  A thread-safe LRU cache whose entries expire ``ttl`` seconds after they were stored.
+
+  :param maxsize: The maximum number of entries; the least recently used entry is evicted first.
+  :type maxsize: int
+
+  :param ttl: The time an entry stays valid, in seconds.
+  :type ttl: float
+  '''
+
+  def __init__(self, maxsize: int = 10000, ttl: float = 3600) -> None:
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+
+    self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self) -> int:
+    with self._lock:
+      return len(self._entries)
+
+  def get(self, key: Hashable) -> Any | None:
+    '''
+    Returns the value stored for a key and marks it as recently used.
+
+    :param key: The key to look up.
+    :type key: Hashable
+
+    :return: The stored value, or None if the key is missing or expired.
+    :rtype: Any | None
+    '''
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None and entry[0] < time.monotonic():
+        del self._entries[key]
+        entry = None
+
+      if entry is None:
+        self.misses += 1
+        return None
+
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return entry[1]
+
+  def put(self, key: Hashable, value: Any) -> None:
+    '''
+    Stores a value, evicting the least recently used entries beyond ``maxsize``.
+
+    :param key: The key to store the value under.
+    :type key: Hashable
+
+    :param value: The value to store.
+    :type value: Any
+    '''
+    with self._lock:
+      self._entries[key] = (time.monotonic() + self.ttl, value)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.maxsize:
+        self._entries.popitem(last=False)
+
+  def stats(self) -> dict[str, float]:
+    '''
+    Returns the hit and miss counters of the cache.
+
+    :return: A dictionary with the ``'hits'``, ``'misses'``, ``'hit_rate'`` and ``'size'``.
+    :rtype: dict[str, float]
+    '''
+    with self._lock:
+      lookups = self.hits + self.misses
+      return {'hits': self.hits, 'misses': self.misses,
+              'hit_rate': self.hits / lookups if lookups else 0.0,
+              'size': len(self._entries)}
+
+
+def normalize_text(text: str) -> str:
+  '''
+  Normalizes a sentence for use as a cache key: Unicode compatibility form, case-folded, with
+  runs of whitespace collapsed. The BERT preprocessing is uncased, so this does not change the
+  prediction.
+
+  :param text: The sentence to normalize.
+  :type text: str
+
+  :return: The normalized sentence.
+  :rtype: str
+  '''
+  return ' '.join(unicodedata.normalize('NFKC', text).casefold().split())
+
+
+def text_key(text: str, model_version: Hashable) -> tuple:
+  '''
+  Returns the cache key of a sentence for a given version of the BERT model.
+
+  :param text: The sentence.
+  :type text: str
+
+  :param model_version: The version of the model.
+  :type model_version: Hashable
+
+  :return: The cache key.
+  :rtype: tuple
+  '''
+  digest = hashlib.blake2b(normalize_text(text).encode(), digest_size=16).digest()
+  return ('bert', model_version, digest)
+
+
+def mcq_key(kf: str, response: list[bool], model_version: Hashable) -> tuple:
+  '''
+  Returns the cache key of the MCQ answers of a key function for a given version of the SVM
+  models.
+
+  :param kf: The key function.
+  :type kf: str
+
+  :param response: The MCQ answers.
+  :type response: list[bool]
+
+  :param model_version: The version of the models.
+  :type model_version: Hashable
+
+  :return: The cache key.
+  :rtype: tuple
+  '''
+  bits = ''.join('1' if answer else '0' for answer in response)
+  return ('svm', model_version, kf, bits)
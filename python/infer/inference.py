@@ -1,22 +1,58 @@
 '''
 Inference module for BERT model to classify sentences.
 This module loads a pre-trained BERT model and predicts the class for each sentence
+
+TensorFlow is only imported once a BERT model is loaded, so SVM-only tooling does not pay for it.
 '''
 
+import json
+import mmap
 import os
 import pickle
 import re
+import struct
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Hashable, NamedTuple
 
-import tensorflow as tf
-import tensorflow_text as text  # pylint: disable=unused-import
+import numpy as np
 
 from supabase import Client
 
+from cache import InferenceCache, mcq_key, text_key
+
+if TYPE_CHECKING:
+  import tensorflow as tf
+
+SVM_MODELS_DIR = "svm-models"
+
+# ETag of each object as of its last download, see download_svm_models
+SVM_DOWNLOAD_STATE_NAME = ".download-state.json"
+
+# Layout of the SVM model bundle written by svm/util.py:
+#   magic (8 bytes) | version (uint32) | header length (uint32) | JSON header | array data
+# The header maps each model name to the offset, dtype and shape of its arrays, with offsets
+# relative to the start of the array data. Since version 2 each model also has a "scheme", "ovo"
+# for SVC models and "ovr" for one-vs-rest linear models; version 1 bundles only hold SVC models.
+SVM_BUNDLE_NAME = "svm-models.bundle"
+SVM_BUNDLE_MAGIC = b"CCCSVMB\0"
+SVM_BUNDLE_VERSION = 2
+
 
-def bert_infer(model: tf.keras.Model, data: dict[str, list[str]]) -> dict[str, int]:  # pylint: disable=no-member
+def bert_infer(
+    model: 'tf.keras.Model',  # pylint: disable=no-member
+    data: dict[str, list[str]],
+    batched: bool = True
+) -> dict[str, int]:
   '''
   Loads a pre-trained BERT model and predicts the class for each sentence.
 
+  In batched mode, the sentences of every key function are flattened into a single input so that
+  the model runs one forward pass per call. The logits are then split back out per key function
+  using an offsets index before summing and taking the argmax. Otherwise, the model is called
+  once per key function.
+
   :param model: The pre-trained BERT model to use for inference.
   :type model: tf.keras.Model
 
@@ -24,6 +60,9 @@ def bert_infer(model: tf.keras.Model, data: dict[str, list[str]]) -> dict[str, i
   be classified.
   :type input: dict[str, list[str]]
 
+  :param batched: If True, run a single predict call over all key functions. Defaults to True.
+  :type batched: bool
+
   :return: A dictionary where keys are sentence identifiers and values are the predicted class
   indices.
   :rtype: dict[str, int]
@@ -35,7 +74,88 @@ def bert_infer(model: tf.keras.Model, data: dict[str, list[str]]) -> dict[str, i
     summed_prediction = [sum(x) for x in zip(*prediction)]
     return summed_prediction.index(max(summed_prediction))
 
-  return {k: get_class(v) for k, v in data.items()}
+  if not batched:
+    return {k: get_class(v) for k, v in data.items()}
+
+  return bert_infer_many(model, [data])[0]
+
+
+def bert_infer_many(
+    model: 'tf.keras.Model',  # pylint: disable=no-member
+    batch: list[dict[str, list[str]]],
+    cache: InferenceCache | None = None,
+    model_version: Hashable = None
+) -> list[dict[str, int]]:
+  '''
+  Predicts the class for each key function of several responses with a single forward pass.
+
+  The sentences of every key function of every response are flattened into one input, and the
+  logits are split back out using an offsets index before summing and taking the argmax.
+
+  With a cache, the logits of each sentence are looked up by its normalized text and the model
+  version first, and only the distinct sentences that miss are run through the model.
+
+  :param model: The pre-trained BERT model to use for inference.
+  :type model: tf.keras.Model
+
+  :param batch: A list of dictionaries, one per response, where keys are key functions and values
+  are the sentences to be classified.
+  :type batch: list[dict[str, list[str]]]
+
+  :param cache: The cache of sentence logits. Defaults to None, which disables caching.
+  :type cache: InferenceCache | None
+
+  :param model_version: The version of the model, part of every cache key.
+  :type model_version: Hashable
+
+  :return: A list of dictionaries, one per response, where keys are key functions and values are
+  the predicted class indices.
+  :rtype: list[dict[str, int]]
+  '''
+  keys = [(i, kf) for i, data in enumerate(batch) for kf in data.keys()]
+  if not keys:
+    return [{} for _ in batch]
+
+  sentences = [sentence for i, kf in keys for sentence in batch[i][kf]]
+
+  # offsets[j]:offsets[j + 1] is the slice of the logits belonging to keys[j]
+  offsets = np.cumsum([0] + [len(batch[i][kf]) for i, kf in keys])
+  if cache is None:
+    logits = np.asarray(model.predict(sentences))
+  else:
+    logits = _cached_logits(model, sentences, cache, model_version)
+
+  results = [{} for _ in batch]
+  for j, (i, kf) in enumerate(keys):
+    results[i][kf] = int(np.argmax(logits[offsets[j]:offsets[j + 1]].sum(axis=0)))
+  return results
+
+
+def _cached_logits(
+    model: 'tf.keras.Model',  # pylint: disable=no-member
+    sentences: list[str],
+    cache: InferenceCache,
+    model_version: Hashable
+) -> np.ndarray:
+  '''
+  Returns the logits of each sentence, running only the distinct sentences missing from the cache
+  through the model and storing their logits.
+  '''
+  keys = [text_key(sentence, model_version) for sentence in sentences]
+  rows = [cache.get(key) for key in keys]
+
+  missing: dict[tuple, str] = {}
+  for key, sentence, row in zip(keys, sentences, rows):
+    if row is None:
+      missing.setdefault(key, sentence)
+
+  if missing:
+    predicted = dict(zip(missing, np.asarray(model.predict(list(missing.values())))))
+    for key, row in predicted.items():
+      cache.put(key, row)
+    rows = [predicted[key] if row is None else row for key, row in zip(keys, rows)]
+
+  return np.stack(rows)
 
 
 def svm_infer(models: dict[str, any], data: dict[str, list[bool]]) -> dict[str, int]:
@@ -59,9 +179,343 @@ def svm_infer(models: dict[str, any], data: dict[str, list[bool]]) -> dict[str,
     kf = 'mcq_kf' + re.sub(r'\.', '_', kf)
     return models[kf].predict([response])[0]
 
+  if isinstance(models, CompiledSVM):
+    return _svm_infer_uncached(models, [data])[0]
+
   return {k: get_class(k, v) for k, v in data.items()}
 
 
+def svm_infer_many(
+    models: dict[str, any],
+    batch: list[dict[str, list[bool]]],
+    cache: InferenceCache | None = None,
+    model_version: Hashable = None
+) -> list[dict[str, int]]:
+  '''
+  Predicts the class for each key function of several responses.
+
+  The responses of all key functions are grouped by key function so that each SVM model is
+  called once with every row that needs it, instead of once per response.
+
+  If the models have been compiled with :func:`compile_svm_models`, every key function of every
+  response is scored at once with a few matrix operations instead.
+
+  With a cache, the class of each key function is looked up by its MCQ answers and the model
+  version first, and only the answers that miss are scored.
+
+  :param models: A dictionary where keys are model names and values are the loaded SVM models,
+  or the compiled models.
+  :type models: dict[str, any] | CompiledSVM
+
+  :param batch: A list of dictionaries, one per response, where keys are key functions and values
+  are the responses to be classified.
+  :type batch: list[dict[str, list[bool]]]
+
+  :param cache: The cache of predicted classes. Defaults to None, which disables caching.
+  :type cache: InferenceCache | None
+
+  :param model_version: The version of the models, part of every cache key.
+  :type model_version: Hashable
+
+  :return: A list of dictionaries, one per response, where keys are key functions and values are
+  the predicted class indices. Key functions without a model are left out.
+  :rtype: list[dict[str, int]]
+  '''
+  print("Running inference on SVM models...")
+
+  if cache is None:
+    return _svm_infer_uncached(models, batch)
+
+  results: list[dict[str, int]] = [{} for _ in batch]
+  missing: list[dict[str, list[bool]]] = [{} for _ in batch]
+  for i, data in enumerate(batch):
+    for kf, response in data.items():
+      cached = cache.get(mcq_key(kf, response, model_version))
+      if cached is None:
+        missing[i][kf] = response
+      else:
+        results[i][kf] = cached
+
+  if any(missing):
+    for i, predicted in enumerate(_svm_infer_uncached(models, missing)):
+      for kf, prediction in predicted.items():
+        cache.put(mcq_key(kf, missing[i][kf], model_version), prediction)
+        results[i][kf] = prediction
+
+  # keep the key functions in the order of the response
+  return [{kf: results[i][kf] for kf in data if kf in results[i]} for i, data in enumerate(batch)]
+
+
+def _svm_infer_uncached(
+    models: dict[str, any],
+    batch: list[dict[str, list[bool]]]
+) -> list[dict[str, int]]:
+  '''
+  Predicts the class for each key function of several responses. See :func:`svm_infer_many`.
+  '''
+  if isinstance(models, CompiledSVM):
+    return _svm_infer_compiled(models, batch)
+
+  grouped: dict[str, list[tuple[int, list[bool]]]] = {}
+  for i, data in enumerate(batch):
+    for kf, response in data.items():
+      grouped.setdefault(kf, []).append((i, response))
+
+  unknown = [kf for kf in grouped if 'mcq_kf' + re.sub(r'\.', '_', kf) not in models]
+  if unknown:
+    print(f"No SVM model for key functions {', '.join(unknown)}, skipping them.")
+
+  results = [{} for _ in batch]
+  for kf, rows in grouped.items():
+    if kf in unknown:
+      continue
+    model = models['mcq_kf' + re.sub(r'\.', '_', kf)]
+    predictions = model.predict([response for _, response in rows])
+    for (i, _), prediction in zip(rows, predictions):
+      results[i][kf] = prediction
+  return results
+
+
+class CompiledSVM(NamedTuple):
+  '''
+  The linear SVM models of every key function packed into dense arrays.
+
+  Each model contributes a block of features (its MCQ options) and a block of pairwise
+  classifiers. The feature vectors of all key functions are concatenated so that every pairwise
+  decision value of every model comes out of a single matrix product with the block-diagonal
+  ``weights``. Following libsvm, a positive decision value votes for the first class of the pair
+  and any other value votes for the second, and the class with the most votes wins, ties going to
+  the class that comes first.
+
+  One-vs-rest models, such as ``LinearSVC`` and ``SGDClassifier``, have no pairwise classifiers.
+  Their decision value for each class comes out of ``ovr_weights`` instead and takes the place of
+  the votes, so the class with the highest decision value wins.
+
+  :ivar index: Model name to position in the packed arrays.
+  :ivar feature_offsets: ``(n_models + 1,)`` start of each model's features in the input.
+  :ivar weights: ``(n_features, n_pairs)`` block-diagonal weights of every pairwise classifier.
+  :ivar intercepts: ``(n_pairs,)`` intercept of every pairwise classifier.
+  :ivar pos_votes: ``(n_pairs, n_slots)`` one-hot class voted for by a positive decision value.
+  :ivar neg_votes: ``(n_pairs, n_slots)`` one-hot class voted for otherwise.
+  :ivar class_slots: ``(n_models, max_classes)`` vote column of each class of each model, padded
+    with ``n_slots``.
+  :ivar classes: ``(n_models, max_classes)`` label of each class of each model.
+  :ivar ovr_weights: ``(n_features, n_slots)`` block-diagonal weights of every one-vs-rest class.
+  :ivar ovr_intercepts: ``(n_slots,)`` intercept of every one-vs-rest class.
+  '''
+  index: dict[str, int]
+  feature_offsets: np.ndarray
+  weights: np.ndarray
+  intercepts: np.ndarray
+  pos_votes: np.ndarray
+  neg_votes: np.ndarray
+  class_slots: np.ndarray
+  classes: np.ndarray
+  ovr_weights: np.ndarray
+  ovr_intercepts: np.ndarray
+
+
+def extract_svm_layout(model) -> dict[str, np.ndarray]:
+  '''
+  Extracts the coefficients, intercepts and classes of a linear SVM model.
+
+  For a linear-kernel ``SVC`` these are the pairwise classifiers, oriented the way libsvm votes,
+  with a positive decision value voting for the first class of the pair. scikit-learn flips the
+  sign of ``coef_`` and ``intercept_`` for binary models, so they are flipped back.
+
+  Other linear models, such as ``LinearSVC`` and ``SGDClassifier``, are one-vs-rest and have one
+  classifier per class. A binary model has a single classifier for the second class, so a
+  classifier that always decides 0 is added for the first.
+
+  :param model: A fitted ``sklearn.svm.SVC`` with a linear kernel, or a linear classifier.
+  :type model: sklearn.svm.SVC | sklearn.svm.LinearSVC | sklearn.linear_model.SGDClassifier
+
+  :return: A dictionary with the ``'coef'``, ``'intercept'`` and ``'classes'`` arrays, and the
+  ``'scheme'``.
+  :rtype: dict[str, np.ndarray]
+  '''
+  # only libsvm models, that is SVC, have dual coefficients
+  scheme = 'ovo' if hasattr(model, 'dual_coef_') else 'ovr'
+  return orient_svm_layout(model.coef_, model.intercept_, model.classes_, scheme)
+
+
+def orient_svm_layout(coef, intercept, classes, scheme: str = 'ovo') -> dict[str, np.ndarray]:
+  '''
+  Orients the ``coef_``, ``intercept_`` and ``classes_`` of a linear SVM model for
+  :func:`pack_svm_layouts`. See :func:`extract_svm_layout`.
+
+  :param scheme: ``'ovo'`` for a one-vs-one ``SVC``, ``'ovr'`` for a one-vs-rest linear model.
+  :type scheme: str
+
+  :return: A dictionary with the ``'coef'``, ``'intercept'`` and ``'classes'`` arrays, and the
+  ``'scheme'``.
+  :rtype: dict[str, np.ndarray]
+
+  :raises ValueError: If the scheme is unknown.
+  '''
+  coef = np.asarray(coef, dtype=np.float64)
+  intercept = np.asarray(intercept, dtype=np.float64)
+  classes = np.asarray(classes)
+
+  if scheme == 'ovo':
+    if len(classes) == 2:
+      coef, intercept = -coef, -intercept
+  elif scheme == 'ovr':
+    if len(classes) == 2:
+      # scikit-learn predicts the second class for a positive decision value only, which is
+      # what an argmax with a constant 0 for the first class does, ties going to the first
+      coef = np.vstack([np.zeros_like(coef), coef])
+      intercept = np.concatenate([np.zeros_like(intercept), intercept])
+  else:
+    raise ValueError(f"Unknown SVM scheme '{scheme}'.")
+
+  return {'coef': coef, 'intercept': intercept, 'classes': classes, 'scheme': scheme}
+
+
+def compile_svm_models(models: dict[str, any]) -> CompiledSVM:
+  '''
+  Compiles the loaded SVM models into packed arrays that score every key function at once.
+
+  :param models: A dictionary where keys are model names and values are the loaded SVM models.
+  :type models: dict[str, any]
+
+  :return: The compiled models.
+  :rtype: CompiledSVM
+  '''
+  return pack_svm_layouts({name: extract_svm_layout(model) for name, model in models.items()})
+
+
+def pack_svm_layouts(layouts: dict[str, dict[str, np.ndarray]]) -> CompiledSVM:
+  '''
+  Packs the coefficients, intercepts and classes of several models into a :class:`CompiledSVM`.
+
+  :param layouts: A dictionary where keys are model names and values are the layouts returned by
+  :func:`extract_svm_layout`.
+  :type layouts: dict[str, dict[str, np.ndarray]]
+
+  :return: The compiled models.
+  :rtype: CompiledSVM
+  '''
+  names = sorted(layouts)
+  ovr = [layouts[name].get('scheme', 'ovo') == 'ovr' for name in names]
+
+  n_features = [layouts[name]['coef'].shape[1] for name in names]
+  n_pairs = [0 if is_ovr else layouts[name]['coef'].shape[0] for name, is_ovr in zip(names, ovr)]
+  n_classes = [len(layouts[name]['classes']) for name in names]
+
+  feature_offsets = np.cumsum([0] + n_features)
+  pair_offsets = np.cumsum([0] + n_pairs)
+  class_offsets = np.cumsum([0] + n_classes)
+  n_class_slots = int(class_offsets[-1])
+
+  weights = np.zeros((feature_offsets[-1], pair_offsets[-1]))
+  intercepts = np.zeros(pair_offsets[-1])
+  pos_votes = np.zeros((pair_offsets[-1], n_class_slots))
+  neg_votes = np.zeros((pair_offsets[-1], n_class_slots))
+  class_slots = np.full((len(names), max(n_classes, default=0)), n_class_slots)
+  classes = np.zeros(class_slots.shape, dtype=np.int64)
+  ovr_weights = np.zeros((feature_offsets[-1], n_class_slots))
+  ovr_intercepts = np.zeros(n_class_slots)
+
+  for k, name in enumerate(names):
+    layout = layouts[name]
+    f0, f1 = feature_offsets[k], feature_offsets[k + 1]
+    p0, p1 = pair_offsets[k], pair_offsets[k + 1]
+    c0 = class_offsets[k]
+
+    class_slots[k, :n_classes[k]] = np.arange(c0, c0 + n_classes[k])
+    classes[k, :n_classes[k]] = layout['classes']
+
+    if ovr[k]:
+      if layout['coef'].shape[0] != n_classes[k]:
+        raise ValueError(f"Model '{name}' has {layout['coef'].shape[0]} one-vs-rest classifiers, "
+                         f"expected {n_classes[k]}.")
+      ovr_weights[f0:f1, c0:c0 + n_classes[k]] = layout['coef'].T
+      ovr_intercepts[c0:c0 + n_classes[k]] = layout['intercept']
+      continue
+
+    weights[f0:f1, p0:p1] = layout['coef'].T
+    intercepts[p0:p1] = layout['intercept']
+
+    # libsvm orders the pairwise classifiers (0, 1), (0, 2), ..., (1, 2), ...
+    pairs = [(i, j) for i in range(n_classes[k]) for j in range(i + 1, n_classes[k])]
+    if len(pairs) != n_pairs[k]:
+      raise ValueError(f"Model '{name}' has {n_pairs[k]} pairwise classifiers, expected "
+                       f"{len(pairs)} for {n_classes[k]} classes.")
+    for p, (i, j) in enumerate(pairs):
+      pos_votes[p0 + p, c0 + i] = 1
+      neg_votes[p0 + p, c0 + j] = 1
+
+  return CompiledSVM(index={name: k for k, name in enumerate(names)},
+                     feature_offsets=feature_offsets, weights=weights, intercepts=intercepts,
+                     pos_votes=pos_votes, neg_votes=neg_votes,
+                     class_slots=class_slots, classes=classes,
+                     ovr_weights=ovr_weights, ovr_intercepts=ovr_intercepts)
+
+
+def _svm_infer_compiled(
+    compiled: CompiledSVM,
+    batch: list[dict[str, list[bool]]]
+) -> list[dict[str, int]]:
+  '''
+  Scores every key function of several responses with the compiled models.
+
+  :param compiled: The compiled models.
+  :type compiled: CompiledSVM
+
+  :param batch: A list of dictionaries, one per response, where keys are key functions and values
+  are the responses to be classified.
+  :type batch: list[dict[str, list[bool]]]
+
+  :return: A list of dictionaries, one per response, where keys are key functions and values are
+  the predicted class indices. Key functions without a model are left out.
+  :rtype: list[dict[str, int]]
+  '''
+  offsets = compiled.feature_offsets
+  x = np.zeros((len(batch), offsets[-1]))
+  names = {kf: 'mcq_kf' + re.sub(r'\.', '_', kf) for data in batch for kf in data}
+
+  unknown = [kf for kf, name in names.items() if name not in compiled.index]
+  if unknown:
+    print(f"No SVM model for key functions {', '.join(unknown)}, skipping them.")
+
+  for i, data in enumerate(batch):
+    for kf, response in data.items():
+      if kf in unknown:
+        continue
+      k = compiled.index[names[kf]]
+      if len(response) != offsets[k + 1] - offsets[k]:
+        raise ValueError(f"Response for {kf} has {len(response)} features, expected "
+                         f"{offsets[k + 1] - offsets[k]}.")
+      x[i, offsets[k]:offsets[k + 1]] = response
+
+  positive = (x @ compiled.weights + compiled.intercepts) > 0
+  votes = positive @ compiled.pos_votes + ~positive @ compiled.neg_votes
+  # the slots of one-vs-rest models get no votes, only their decision values
+  votes += x @ compiled.ovr_weights + compiled.ovr_intercepts
+
+  # the padding slot never wins
+  votes = np.hstack([votes, np.full((len(batch), 1), -np.inf)])
+  winners = votes[:, compiled.class_slots].argmax(axis=-1)
+  labels = compiled.classes[np.arange(len(compiled.index)), winners].tolist()
+
+  return [{kf: labels[i][compiled.index[names[kf]]] for kf in data if kf not in unknown}
+          for i, data in enumerate(batch)]
+
+
+def import_tensorflow():
+  '''
+  Imports TensorFlow, along with the TensorFlow Text ops that the BERT model depends on.
+  Python caches the modules, so only the first call pays the import time.
+
+  :return: The ``tensorflow`` module.
+  '''
+  # pylint: disable=import-outside-toplevel
+  import tensorflow as tf  # pylint: disable=redefined-outer-name
+  import tensorflow_text as text  # pylint: disable=unused-import,unused-variable
+  return tf
+
+
 def load_bert_model(model_path: str):
   '''
   Loads a pre-trained BERT model from the specified path.
@@ -75,6 +529,8 @@ def load_bert_model(model_path: str):
   if not os.path.exists(model_path):
     raise FileNotFoundError(f"The model path '{model_path}' does not exist.")
 
+  tf = import_tensorflow()  # pylint: disable=redefined-outer-name
+
   print(f"Loading BERT model from {model_path}...", end=" ")
   # pylint: disable=no-member
   model = tf.keras.models.load_model(model_path, compile=False)
@@ -82,28 +538,146 @@ def load_bert_model(model_path: str):
   return model
 
 
-def download_svm_models(supabase: Client) -> None:
+def warm_up_bert_model(
+    model: 'tf.keras.Model',  # pylint: disable=no-member
+    batch_size: int = 16
+) -> None:
+  '''
+  Runs a dummy batch through the BERT model so that the one-off graph tracing happens now rather
+  than on the first real response.
+
+  :param model: The loaded BERT model.
+  :type model: tf.keras.Model
+
+  :param batch_size: The number of dummy sentences. Defaults to 16.
+  :type batch_size: int
+  '''
+  print("Warming up BERT model...", end=" ")
+  model.predict(["The student meets expectations."] * batch_size, verbose=0)
+  print("BERT model warmed up.")
+
+
+def prepare_bert_model(model_path: str, warm_up_batch_size: int = 16):
+  '''
+  Imports TensorFlow, loads the BERT model and warms it up, reporting the time of each step.
+
+  :param model_path: The path to the pre-trained BERT model.
+  :type model_path: str
+
+  :param warm_up_batch_size: The number of dummy sentences to warm up with; 0 skips the warm-up.
+  Defaults to 16.
+  :type warm_up_batch_size: int
+
+  :return: The loaded BERT model.
+  :rtype: tf.keras.Model
+  '''
+  start = time.perf_counter()
+  import_tensorflow()
+  imported = time.perf_counter()
+  model = load_bert_model(model_path)
+  loaded = time.perf_counter()
+  if warm_up_batch_size > 0:
+    warm_up_bert_model(model, batch_size=warm_up_batch_size)
+  warmed_up = time.perf_counter()
+
+  print(f"BERT model ready: import {imported - start:.2f}s, load {loaded - imported:.2f}s, "
+        f"warm-up {warmed_up - loaded:.2f}s.")
+  return model
+
+
+def download_svm_models(supabase: Client, max_workers: int = 4) -> list[str]:
   '''
   Downloads the pre-trained SVM models from the remote server.
+
+  Objects are downloaded concurrently. An object is skipped when the ETag recorded for it by a
+  previous download matches the bucket metadata and the local file still exists. Files are
+  written to a temporary file and renamed into place, so a reader never sees a partial model.
+
+  :param supabase: The Supabase client.
+  :type supabase: Client
+
+  :param max_workers: The maximum number of concurrent downloads. Defaults to 4.
+  :type max_workers: int
+
+  :return: The names of the objects that were downloaded.
+  :rtype: list[str]
   '''
 
   # Ensure the "svm-models" directory exists
-  if not os.path.exists("svm-models"):
-    os.makedirs("svm-models")
+  os.makedirs(SVM_MODELS_DIR, exist_ok=True)
 
   print("Downloading SVM models from Supabase...")
   bucket_name = "svm-models"
   bucket = supabase.storage.from_(bucket_name)
-  models = bucket.list()
-  for model in models:
+  state_path = os.path.join(SVM_MODELS_DIR, SVM_DOWNLOAD_STATE_NAME)
+
+  state = {}
+  if os.path.exists(state_path):
+    with open(state_path, "r", encoding="utf-8") as f:
+      state = json.load(f)
+
+  def download(model: dict) -> bool:
     model_name = model['name']
-    print(f"Downloading {model_name}...", end=" ")
-    file_path = f"svm-models/{model_name}"
-    with open(file_path, "wb") as f:
-      response = bucket.download(model_name)
-      f.write(response)
-    print(f"to svm-models/{model_name}")
-  print("All SVM models downloaded successfully.")
+    file_path = os.path.join(SVM_MODELS_DIR, model_name)
+    version = object_version(model)
+
+    if version is not None and state.get(model_name) == version and os.path.exists(file_path):
+      print(f"{model_name} is up to date.")
+      return False
+
+    write_atomic(file_path, bucket.download(model_name))
+    print(f"Downloaded {model_name} to {file_path}")
+    return True
+
+  # folder placeholders have no id
+  models = [model for model in bucket.list() if model.get('id') is not None]
+  with ThreadPoolExecutor(max_workers=max_workers) as pool:
+    downloaded = list(pool.map(download, models))
+
+  new_state = {model['name']: object_version(model) for model in models}
+  if new_state != state:
+    write_atomic(state_path, json.dumps(new_state, indent=2).encode())
+
+  names = [model['name'] for model, was_downloaded in zip(models, downloaded) if was_downloaded]
+  print(f"All SVM models downloaded successfully ({len(names)} of {len(models)} updated).")
+  return names
+
+
+def object_version(model: dict) -> str | None:
+  '''
+  Returns the version of a storage object from its listing: the ETag if the bucket reports one,
+  otherwise the last update time.
+
+  :param model: An object of a storage bucket listing.
+  :type model: dict
+
+  :return: The version of the object, or None if the listing has neither.
+  :rtype: str | None
+  '''
+  metadata = model.get('metadata') or {}
+  return metadata.get('eTag') or model.get('updated_at')
+
+
+def write_atomic(path: str, data: bytes) -> None:
+  '''
+  Writes data to a file through a temporary file in the same directory and a rename, so that the
+  file is either fully written or left untouched.
+
+  :param path: The path of the file to write.
+  :type path: str
+
+  :param data: The data to write.
+  :type data: bytes
+  '''
+  fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".",
+                                  prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+  try:
+    with os.fdopen(fd, "wb") as f:
+      f.write(data)
+    os.replace(tmp_path, path)
+  except BaseException:
+    os.remove(tmp_path)
+    raise
 
 
 def load_svm_models() -> dict[str, any]:
@@ -126,3 +700,65 @@ def load_svm_models() -> dict[str, any]:
 
   print("All SVM models loaded successfully.")
   return svm_models
+
+
+def load_svm_bundle(path: str) -> dict[str, dict[str, np.ndarray]]:
+  '''
+  Memory-maps an SVM model bundle written by ``svm/util.py``.
+
+  The arrays are views into the mapped file, so loading is near-instant and processes that load
+  the same bundle share one copy of the weights through the page cache.
+
+  :param path: The path to the bundle file.
+  :type path: str
+
+  :return: A dictionary where keys are model names and values are layouts as returned by
+  :func:`extract_svm_layout`.
+  :rtype: dict[str, dict[str, np.ndarray]]
+
+  :raises ValueError: If the file is not an SVM model bundle or has an unsupported version.
+  '''
+  print(f"Loading SVM model bundle from {path}...", end=" ")
+
+  with open(path, "rb") as f:
+    buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+  prefix = len(SVM_BUNDLE_MAGIC)
+  if buffer[:prefix] != SVM_BUNDLE_MAGIC:
+    raise ValueError(f"'{path}' is not an SVM model bundle.")
+
+  version, header_length = struct.unpack_from("<II", buffer, prefix)
+  if not 1 <= version <= SVM_BUNDLE_VERSION:
+    raise ValueError(f"Unsupported SVM model bundle version {version} in '{path}'.")
+
+  header_start = prefix + struct.calcsize("<II")
+  data_start = header_start + header_length
+  header = json.loads(buffer[header_start:data_start])
+
+  def view(array: dict) -> np.ndarray:
+    dtype = np.dtype(array['dtype'])
+    count = int(np.prod(array['shape']))
+    return (np.frombuffer(buffer, dtype=dtype, count=count, offset=data_start + array['offset'])
+            .reshape(array['shape']))
+
+  layouts = {name: orient_svm_layout(view(entry['coef']), view(entry['intercept']),
+                                     view(entry['classes']), entry.get('scheme', 'ovo'))
+             for name, entry in header['models'].items()}
+
+  print(f"{len(layouts)} models loaded successfully.")
+  return layouts
+
+
+def load_compiled_svm_models() -> CompiledSVM:
+  '''
+  Loads the pre-trained SVM models from the local "svm-models" directory and compiles them.
+
+  The model bundle is used if it is present, otherwise the per-KF pickles are loaded.
+
+  :return: The compiled models.
+  :rtype: CompiledSVM
+  '''
+  bundle_path = os.path.join(SVM_MODELS_DIR, SVM_BUNDLE_NAME)
+  if os.path.exists(bundle_path):
+    return pack_svm_layouts(load_svm_bundle(bundle_path))
+  return compile_svm_models(load_svm_models())
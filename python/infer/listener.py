@@ -1,20 +1,83 @@
 '''
 This script connects to the Supabase Realtime server and listens for new form responses.
 When a new response is inserted into the "form_responses" table, it processes the response using
-BERT and SVM models, and then stores the results in the "form_results" table.
+BERT and SVM models, and then upserts the results into the "form_results" table.
+
+New responses are put on a queue by the realtime callback and scored in micro-batches by a worker,
+so that a burst of submissions runs one combined BERT pass and one combined SVM pass.
 
 It requires the following environment variables to be set:
 - SUPABASE_URL: The URL of the Supabase project.
 - SUPABASE_SERVICE_ROLE_KEY: The service role key for the Supabase project.
+
+Scoring runs in an executor pool so that the event loop keeps accepting realtime events and
+heartbeats while earlier batches are still being scored, and results are written with the async
+client.
+
+The following optional environment variables tune the micro-batching and the executor:
+- INFER_MAX_BATCH_SIZE: The maximum number of responses scored together (default: 16).
+- INFER_MAX_WAIT_MS: The maximum time to wait for a batch to fill, in milliseconds (default: 50).
+- INFER_EXECUTOR: Either "thread" or "process" (default: "thread").
+- INFER_WORKERS: The number of executor workers (default: 2).
+- INFER_MAX_IN_FLIGHT: The maximum number of batches being scored at once (default: 4).
+- INFER_MAX_QUEUE_SIZE: The maximum number of responses waiting to be scored; responses received
+  while the queue is full are dropped with an error and can be scored later with rescore.py
+  (default: 1000).
+- INFER_DOWNLOAD_WORKERS: The number of concurrent model downloads (default: 4).
+- INFER_WARM_UP_BATCH_SIZE: The number of dummy sentences run through a newly loaded BERT model
+  to trigger graph tracing before it scores real responses; 0 disables the warm-up (default: 16).
+- INFER_CACHE_SIZE: The maximum number of entries of each inference cache; 0 disables caching
+  (default: 10000).
+- INFER_CACHE_TTL: The time an inference cache entry stays valid, in seconds (default: 3600).
+- INFER_CACHE_STATS_INTERVAL: The minimum time between two prints of the inference cache
+  statistics by a worker, in seconds; 0 disables them (default: 300).
+- INFER_RELOAD_INTERVAL: The time between checks for new models in the bucket and in the local
+  model directories, in seconds; 0 disables hot-reloading (default: 60).
 '''
 
 import asyncio
+import itertools
+import multiprocessing
 import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Callable, NamedTuple
 
 from supabase import AClient, Client, acreate_client, create_client
 from dotenv import load_dotenv
 
-from inference import bert_infer, download_svm_models, load_bert_model, load_svm_models, svm_infer
+from inference import (SVM_MODELS_DIR, bert_infer_many, download_svm_models,
+                       load_compiled_svm_models, prepare_bert_model, svm_infer_many)
+from cache import InferenceCache
+from registry import ModelRegistry, files_signature
+
+BERT_MODEL_PATH = "bert-model/cb-250401-80_7114_model"
+
+# Models loaded by each worker of a process pool, see init_worker
+_worker_models: dict[str, any] = {}
+
+# The time the inference cache statistics were last printed by this process, see print_cache_stats
+_cache_stats_printed: dict[str, float] = {}
+
+
+class Caches(NamedTuple):
+  '''
+  The inference caches of the BERT sentence logits and of the SVM predictions, and the minimum
+  time between two prints of their statistics, in seconds.
+  '''
+  bert: InferenceCache
+  svm: InferenceCache
+  stats_interval: float = 300
+
+
+class Backend(NamedTuple):
+  '''
+  A loaded version of the models: the executor that runs inference and the function to submit to
+  it. See :func:`create_backend_loader`.
+  '''
+  executor: Executor
+  score: Callable
 
 
 async def main() -> None:
@@ -34,15 +97,44 @@ async def main() -> None:
   if url == "" or key == "":
     raise ValueError("Supabase URL or key not found in environment variables.")
 
+  max_batch_size = int(os.environ.get("INFER_MAX_BATCH_SIZE", "16"))
+  max_wait = int(os.environ.get("INFER_MAX_WAIT_MS", "50")) / 1000
+  executor_kind = os.environ.get("INFER_EXECUTOR", "thread")
+  workers = int(os.environ.get("INFER_WORKERS", "2"))
+  max_in_flight = int(os.environ.get("INFER_MAX_IN_FLIGHT", "4"))
+  max_queue_size = int(os.environ.get("INFER_MAX_QUEUE_SIZE", "1000"))
+  download_workers = int(os.environ.get("INFER_DOWNLOAD_WORKERS", "4"))
+  reload_interval = float(os.environ.get("INFER_RELOAD_INTERVAL", "60"))
+  warm_up_batch_size = int(os.environ.get("INFER_WARM_UP_BATCH_SIZE", "16"))
+  cache_size = int(os.environ.get("INFER_CACHE_SIZE", "10000"))
+  cache_ttl = float(os.environ.get("INFER_CACHE_TTL", "3600"))
+  cache_stats_interval = float(os.environ.get("INFER_CACHE_STATS_INTERVAL", "300"))
+
   print("Environment variables loaded.")
 
   supabase: Client = create_client(url, key)
   asupabase: AClient = await acreate_client(url, key)
 
-  download_svm_models(supabase)
-
-  bert_model = load_bert_model("bert-model/cb-250401-80_7114_model")
-  svm_models = load_svm_models()
+  load, release = create_backend_loader(executor_kind, workers,
+                                        warm_up_batch_size=warm_up_batch_size,
+                                        cache_size=cache_size, cache_ttl=cache_ttl,
+                                        cache_stats_interval=cache_stats_interval)
+  registry = ModelRegistry(
+      load=load,
+      signature=partial(files_signature, SVM_MODELS_DIR, BERT_MODEL_PATH),
+      release=release,
+      refresh=partial(download_svm_models, supabase, max_workers=download_workers))
+  registry.reload_if_changed()
+
+  if reload_interval > 0:
+    watcher = asyncio.create_task(  # pylint: disable=unused-variable
+        registry.watch(reload_interval))
+
+  queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue_size)
+  worker = asyncio.create_task(  # pylint: disable=unused-variable
+      batch_worker(queue, registry, asupabase,
+                   max_batch_size=max_batch_size, max_wait=max_wait,
+                   max_in_flight=max_in_flight))
 
   print("Connecting to Supabase Realtime server...")
 
@@ -52,8 +144,7 @@ async def main() -> None:
          .channel("form_responses_insert")
          .on_postgres_changes("INSERT",
                               schema="public", table="form_responses",
-                              callback=lambda payload:
-                              handle_new_response(payload, bert_model, svm_models, supabase))
+                              callback=partial(enqueue_payload, queue))
          .subscribe())
 
   await asupabase.realtime.listen()
@@ -64,16 +155,346 @@ async def main() -> None:
     await asyncio.sleep(1)
 
 
-def handle_new_response(payload, bert_model, svm_models, supabase) -> None:
+def enqueue_payload(queue: asyncio.Queue, payload) -> bool:
   '''
-  Handles the insert event from the Supabase Realtime server.
+  Puts a realtime payload on the queue of the batch worker. The realtime callback cannot wait for
+  room on the queue, so a payload received while the queue is full is dropped and reported.
+
+  :param queue: The queue of realtime payloads.
+  :type queue: asyncio.Queue
 
   :param payload: The payload received from the Supabase Realtime server.
   :type payload: dict
 
+  :return: True if the payload was queued, False if it was dropped.
+  :rtype: bool
+  '''
+  try:
+    queue.put_nowait(payload)
+    return True
+  except asyncio.QueueFull:
+    record = payload.get('data', {}).get('record', {}) if isinstance(payload, dict) else {}
+    print(f"Error: the queue is full ({queue.maxsize} responses), dropping response "
+          f"{record.get('response_id')}; score it later with rescore.py")
+    return False
+
+
+async def collect_batch(queue: asyncio.Queue, max_batch_size: int, max_wait: float) -> list:
+  '''
+  Waits for the next item on the queue, then keeps collecting items until either the batch is full
+  or the maximum wait time has elapsed since the first item was received.
+
+  :param queue: The queue to collect items from.
+  :type queue: asyncio.Queue
+
+  :param max_batch_size: The maximum number of items in a batch.
+  :type max_batch_size: int
+
+  :param max_wait: The maximum time to wait for the batch to fill, in seconds.
+  :type max_wait: float
+
+  :return: A list of at least one and at most ``max_batch_size`` items.
+  :rtype: list
+  '''
+  loop = asyncio.get_running_loop()
+
+  batch = [await queue.get()]
+  deadline = loop.time() + max_wait
+
+  while len(batch) < max_batch_size:
+    if not queue.empty():
+      batch.append(queue.get_nowait())
+      continue
+    timeout = deadline - loop.time()
+    if timeout <= 0:
+      break
+    try:
+      batch.append(await asyncio.wait_for(queue.get(), timeout))
+    except asyncio.TimeoutError:
+      break
+
+  return batch
+
+
+def create_backend_loader(
+    kind: str,
+    workers: int,
+    warm_up_batch_size: int = 16,
+    cache_size: int = 10000,
+    cache_ttl: float = 3600,
+    cache_stats_interval: float = 300
+) -> tuple[Callable[[], Backend], Callable[[Backend], None] | None]:
+  '''
+  Creates the functions that load a new version of the models into a :class:`Backend`, and that
+  release a version once it has been replaced.
+
+  In thread mode, the models are loaded in the current process and shared by every thread of a
+  single pool. In process mode, each version gets a new pool whose worker processes load their
+  own copy of the models; the previous pool is shut down once the registry no longer holds it for
+  any batch.
+
+  In thread mode, the inference caches are shared by every version and each version gets a new
+  number that is part of its cache keys. In process mode, each worker has its own caches.
+
+  :param kind: Either ``'thread'`` or ``'process'``.
+  :type kind: str
+
+  :param workers: The number of workers in the pool.
+  :type workers: int
+
+  :param warm_up_batch_size: The number of dummy sentences used to warm up each BERT model.
+  :type warm_up_batch_size: int
+
+  :param cache_size: The maximum number of entries of each inference cache; 0 disables caching.
+  :type cache_size: int
+
+  :param cache_ttl: The time an inference cache entry stays valid, in seconds.
+  :type cache_ttl: float
+
+  :param cache_stats_interval: The minimum time between two prints of the cache statistics, in
+  seconds; 0 disables them.
+  :type cache_stats_interval: float
+
+  :return: A tuple of the load function and the release function.
+  :rtype: tuple[Callable[[], Backend], Callable[[Backend], None] | None]
+
+  :raises ValueError: If the executor kind is unknown.
+  '''
+  if kind == "thread":
+    executor = ThreadPoolExecutor(max_workers=workers)
+    caches = create_caches(cache_size, cache_ttl, cache_stats_interval)
+    versions = itertools.count(1)
+
+    def load_thread() -> Backend:
+      bert_model = prepare_bert_model(BERT_MODEL_PATH, warm_up_batch_size=warm_up_batch_size)
+      svm_models = load_compiled_svm_models()
+      return Backend(executor,
+                     partial(score_responses, bert_model=bert_model, svm_models=svm_models,
+                             caches=caches, model_version=next(versions)))
+
+    return load_thread, None
+
+  if kind == "process":
+    def load_process() -> Backend:
+      # TensorFlow does not survive a fork, so workers are started from a fresh interpreter
+      executor = ProcessPoolExecutor(max_workers=workers,
+                                     mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=init_worker,
+                                     initargs=(BERT_MODEL_PATH, warm_up_batch_size,
+                                               cache_size, cache_ttl, cache_stats_interval))
+      # start every worker so that the models are loaded before the pool is swapped in
+      for future in [executor.submit(os.getpid) for _ in range(workers)]:
+        future.result()
+      return Backend(executor, score_in_worker)
+
+    def release_process(backend: Backend) -> None:
+      backend.executor.shutdown(wait=False)
+
+    return load_process, release_process
+
+  raise ValueError(f"Unknown executor kind '{kind}'. Expected 'thread' or 'process'.")
+
+
+def create_caches(
+    cache_size: int,
+    cache_ttl: float,
+    stats_interval: float = 300
+) -> Caches | None:
+  '''
+  Creates the inference caches.
+
+  :param cache_size: The maximum number of entries of each cache; 0 disables caching.
+  :type cache_size: int
+
+  :param cache_ttl: The time a cache entry stays valid, in seconds.
+  :type cache_ttl: float
+
+  :param stats_interval: The minimum time between two prints of the cache statistics, in
+  seconds; 0 disables them.
+  :type stats_interval: float
+
+  :return: The caches, or None if caching is disabled.
+  :rtype: Caches | None
+  '''
+  if cache_size <= 0:
+    return None
+  return Caches(InferenceCache(cache_size, cache_ttl), InferenceCache(cache_size, cache_ttl),
+                stats_interval)
+
+
+def init_worker(
+    bert_model_path: str,
+    warm_up_batch_size: int = 16,
+    cache_size: int = 10000,
+    cache_ttl: float = 3600,
+    cache_stats_interval: float = 300
+) -> None:
+  '''
+  Loads the models into a worker process of the executor pool.
+
+  :param bert_model_path: The path to the pre-trained BERT model.
+  :type bert_model_path: str
+
+  :param warm_up_batch_size: The number of dummy sentences used to warm up the BERT model.
+  :type warm_up_batch_size: int
+
+  :param cache_size: The maximum number of entries of each inference cache; 0 disables caching.
+  :type cache_size: int
+
+  :param cache_ttl: The time an inference cache entry stays valid, in seconds.
+  :type cache_ttl: float
+
+  :param cache_stats_interval: The minimum time between two prints of the cache statistics, in
+  seconds; 0 disables them.
+  :type cache_stats_interval: float
+  '''
+  _worker_models['bert'] = prepare_bert_model(bert_model_path,
+                                              warm_up_batch_size=warm_up_batch_size)
+  _worker_models['svm'] = load_compiled_svm_models()
+  _worker_models['caches'] = create_caches(cache_size, cache_ttl, cache_stats_interval)
+
+
+def score_in_worker(flats: list[dict[str, dict]]) -> list[dict[str, float]]:
+  '''
+  Scores flattened responses with the models loaded by :func:`init_worker`.
+
+  :param flats: The flattened responses, as returned by :func:`parse_response`.
+  :type flats: list[dict[str, dict]]
+
+  :return: The weighted development levels of each response.
+  :rtype: list[dict[str, float]]
+  '''
+  return score_responses(flats, _worker_models['bert'], _worker_models['svm'],
+                         caches=_worker_models['caches'])
+
+
+async def batch_worker(
+    queue: asyncio.Queue,
+    registry: ModelRegistry,
+    asupabase: AClient,
+    max_batch_size: int = 16,
+    max_wait: float = 0.05,
+    max_in_flight: int = 4
+) -> None:
+  '''
+  Scores the responses put on the queue by the realtime callback in micro-batches.
+
+  Each batch is handed to the executor and the worker goes straight back to collecting the next
+  one, so at most ``max_in_flight`` batches are being scored at any time. Every batch holds the
+  version of the models that was current when it started with :meth:`ModelRegistry.acquire`, so a
+  replaced version is only released once its last batch is done.
+
+  :param queue: The queue of realtime payloads.
+  :type queue: asyncio.Queue
+
+  :param registry: The registry holding the current :class:`Backend`.
+  :type registry: ModelRegistry
+
+  :param asupabase: The async Supabase client used to store the results.
+  :type asupabase: AClient
+
+  :param max_batch_size: The maximum number of responses scored together.
+  :type max_batch_size: int
+
+  :param max_wait: The maximum time to wait for a batch to fill, in seconds.
+  :type max_wait: float
+
+  :param max_in_flight: The maximum number of batches being scored at once.
+  :type max_in_flight: int
+
+  :return: None
+  '''
+  in_flight = asyncio.Semaphore(max_in_flight)
+  tasks: set[asyncio.Task] = set()
+
+  def done(task: asyncio.Task, size: int) -> None:
+    tasks.discard(task)
+    in_flight.release()
+    for _ in range(size):
+      queue.task_done()
+
+  async def process(batch: list) -> None:
+    with registry.acquire() as backend:
+      await process_batch(batch, backend, asupabase)
+
+  while True:
+    batch = await collect_batch(queue, max_batch_size, max_wait)
+    await in_flight.acquire()
+    task = asyncio.create_task(process(batch))
+    tasks.add(task)
+    task.add_done_callback(partial(done, size=len(batch)))
+
+
+async def process_batch(payloads: list, backend: Backend, asupabase: AClient) -> None:
+  '''
+  Scores a batch of insert events from the Supabase Realtime server in the executor pool and
+  stores the results with a single upsert, so that a response delivered twice, or also scored by
+  rescore.py, keeps one result.
+
+  Payloads that cannot be parsed are reported and skipped. If scoring the batch fails, its
+  responses are scored one by one so that a single bad response does not lose the others, and
+  every response that was scored is stored.
+
+  :param payloads: The payloads received from the Supabase Realtime server.
+  :type payloads: list[dict]
+
+  :param backend: The version of the models to score the batch with.
+  :type backend: Backend
+
+  :param asupabase: The async Supabase client used to store the results.
+  :type asupabase: AClient
+
   :return: None
   '''
+  parsed = []
+  for payload in payloads:
+    try:
+      parsed.append(parse_response(payload))
+    except (KeyError, TypeError, AttributeError) as e:
+      print(f"Skipping payload: malformed response ({e!r})")
+
+  if not parsed:
+    return
+
+  loop = asyncio.get_running_loop()
+  try:
+    results = await loop.run_in_executor(backend.executor, backend.score,
+                                         [flat for _, flat in parsed])
+  except Exception as e:  # pylint: disable=broad-exception-caught
+    print(f"Error scoring batch of {len(parsed)} responses: {e}")
+    if len(parsed) == 1:
+      return
+    results = []
+    for response_id, flat in parsed:
+      try:
+        results.extend(await loop.run_in_executor(backend.executor, backend.score, [flat]))
+      except Exception as error:  # pylint: disable=broad-exception-caught
+        print(f"Error scoring response {response_id}: {error}")
+        results.append(None)
+
+  rows = [{"response_id": response_id, "results": res}
+          for (response_id, _), res in zip(parsed, results) if res is not None]
+  print(f'Scored {len(rows)} responses')
+  if not rows:
+    return
+
+  try:
+    await asupabase.table("form_results").upsert(rows, on_conflict="response_id").execute()
+  except Exception as e:  # pylint: disable=broad-exception-caught
+    print(f"Error storing the results of {len(rows)} responses: {e}")
+
+
+def parse_response(payload) -> tuple[str, dict[str, dict]]:
+  '''
+  Extracts the response ID and the flattened key function answers from a realtime payload.
 
+  :param payload: The payload received from the Supabase Realtime server.
+  :type payload: dict
+
+  :return: A tuple of the response ID and a dictionary where keys are key functions and values
+  are dictionaries with the ``'bert'`` sentences and the ``'svm'`` MCQ answers.
+  :rtype: tuple[str, dict[str, dict]]
+  '''
   record = payload['data']['record']
 
   print('New response received:', record['response_id'])
@@ -82,23 +503,104 @@ def handle_new_response(payload, bert_model, svm_models, supabase) -> None:
 
   print("Processing response", response)
 
+  return record['response_id'], flatten_response(response)
+
+
+def flatten_response(response: dict[str, dict]) -> dict[str, dict]:
+  '''
+  Flattens the EPA -> key function answers of a form response into the key function answers.
+
+  :param response: The ``response`` of a form response, keyed by EPA.
+  :type response: dict[str, dict]
+
+  :return: A dictionary where keys are key functions and values are dictionaries with the
+  ``'bert'`` sentences and the ``'svm'`` MCQ answers.
+  :rtype: dict[str, dict]
+  '''
   ds = [kf for kf in response.values()]
-  flat = {k: {
+  return {k: {
       'bert': v['text'],
       'svm': [vv for kk, vv in v.items() if kk != 'text']
   } for d in ds for k, v in d.items()}
 
-  bert_res = bert_infer(bert_model, {k: v['bert'] for k, v in flat.items()})
-  svms_res = svm_infer(svm_models, {k: v['svm'] for k, v in flat.items()})
+
+def score_responses(
+    flats: list[dict[str, dict]],
+    bert_model,
+    svm_models,
+    caches: Caches | None = None,
+    model_version: int = 0
+) -> list[dict[str, float]]:
+  '''
+  Scores several flattened responses with one combined BERT pass and one combined SVM pass.
+
+  :param flats: The flattened responses, as returned by :func:`parse_response`.
+  :type flats: list[dict[str, dict]]
+
+  :param caches: The inference caches. Defaults to None, which disables caching.
+  :type caches: Caches | None
+
+  :param model_version: The version of the models, part of every cache key.
+  :type model_version: int
+
+  :return: A list of dictionaries, one per response, where keys are key functions and values are
+  the weighted development levels.
+  :rtype: list[dict[str, float]]
+  '''
+  bert_cache, svm_cache = (caches.bert, caches.svm) if caches is not None else (None, None)
+
+  bert_res = bert_infer_many(bert_model, [{k: v['bert'] for k, v in flat.items()}
+                                          for flat in flats],
+                             cache=bert_cache, model_version=model_version)
+  svms_res = svm_infer_many(svm_models, [{k: v['svm'] for k, v in flat.items()}
+                                         for flat in flats],
+                            cache=svm_cache, model_version=model_version)
+
+  if caches is not None:
+    print_cache_stats(caches)
 
   def weighted_average(bert: float, svm: float) -> float:
     return bert * 0.25 + svm * 0.75
 
-  res = {k: weighted_average(bert=v, svm=svms_res[k]) for k, v in bert_res.items()}
+  # a key function without an SVM model is scored by BERT alone
+  return [{k: weighted_average(bert=v, svm=svm[k]) if k in svm else v for k, v in bert.items()}
+          for bert, svm in zip(bert_res, svms_res)]
+
+
+def print_cache_stats(caches: Caches) -> None:
+  '''
+  Prints the statistics of the inference caches, at most once every ``caches.stats_interval``
+  seconds in each process.
+
+  :param caches: The inference caches.
+  :type caches: Caches
+  '''
+  now = time.monotonic()
+  printed = _cache_stats_printed.get('time')
+  if caches.stats_interval <= 0 or (printed is not None
+                                    and now - printed < caches.stats_interval):
+    return
+  _cache_stats_printed['time'] = now
+  print(f"Cache stats: BERT {caches.bert.stats()}, SVM {caches.svm.stats()}")
+
+
+def handle_new_response(payload, bert_model, svm_models, supabase) -> None:
+  '''
+  Handles the insert event from the Supabase Realtime server.
+
+  :param payload: The payload received from the Supabase Realtime server.
+  :type payload: dict
+
+  :return: None
+  '''
+
+  response_id, flat = parse_response(payload)
+
+  res = score_responses([flat], bert_model, svm_models)[0]
   print('res', res)
 
   (supabase.table("form_results")
-   .insert({"response_id": record['response_id'], "results": res})
+   .upsert({"response_id": response_id, "results": res}, on_conflict="response_id")
    .execute())
 
 
@@ -0,0 +1,165 @@
+'''
+Model registry that hot-reloads the inference models without restarting the listener.
+
+The registry watches a signature of the model files, loads a new version in the background when
+the signature changes, and swaps it in atomically. Callers hold a version with
+:meth:`ModelRegistry.acquire` for the length of each batch, so batches already in flight finish on
+the version they started with, and a replaced version is only released once the last of them is
+done.
+'''
+
+import asyncio
+import contextlib
+import os
+import threading
+from typing import Any, Callable, Iterator
+
+
+class ModelRegistry:
+  '''
+  Holds the current version of the loaded models and swaps in new versions as they appear.
+
+  :param load: Loads the models from disk and returns them.
+  :type load: Callable[[], Any]
+
+  :param signature: Returns a value that changes whenever the model files change.
+  :type signature: Callable[[], Any]
+
+  :param release: Called with the previous models after a new version has been swapped in and no
+  caller holds them any more.
+  :type release: Callable[[Any], None] | None
+
+  :param refresh: Called before each check, for example to download new models from the bucket.
+  :type refresh: Callable[[], Any] | None
+  '''
+
+  def __init__(
+      self,
+      load: Callable[[], Any],
+      signature: Callable[[], Any],
+      release: Callable[[Any], None] | None = None,
+      refresh: Callable[[], Any] | None = None
+  ) -> None:
+    self._load = load
+    self._signature = signature
+    self._release = release
+    self._refresh = refresh
+
+    self._lock = threading.RLock()
+    self._reload_lock = threading.Lock()
+    self._current = None
+    self._current_signature = None
+    self._holders: dict[int, int] = {}
+    self.version = 0
+
+  def current(self) -> Any:
+    '''
+    Returns the current models.
+
+    :return: The models returned by the last successful load.
+    :rtype: Any
+
+    :raises RuntimeError: If no models have been loaded yet.
+    '''
+    with self._lock:
+      if self._current is None:
+        raise RuntimeError("No models have been loaded yet.")
+      return self._current
+
+  @contextlib.contextmanager
+  def acquire(self) -> Iterator[Any]:
+    '''
+    Holds the current models until the context exits. Models replaced by a new version while they
+    are held are released when the last holder exits.
+
+    :return: The models returned by the last successful load.
+    :rtype: Iterator[Any]
+
+    :raises RuntimeError: If no models have been loaded yet.
+    '''
+    with self._lock:
+      models = self.current()
+      self._holders[id(models)] = self._holders.get(id(models), 0) + 1
+    try:
+      yield models
+    finally:
+      with self._lock:
+        self._holders[id(models)] -= 1
+        retired = self._holders[id(models)] == 0 and models is not self._current
+        if self._holders[id(models)] == 0:
+          del self._holders[id(models)]
+      if retired and self._release is not None:
+        self._release(models)
+
+  def reload_if_changed(self) -> bool:
+    '''
+    Loads and swaps in the models if their signature changed since the last load.
+
+    :return: True if a new version was swapped in.
+    :rtype: bool
+    '''
+    with self._reload_lock:
+      if self._refresh is not None:
+        self._refresh()
+
+      signature = self._signature()
+      if signature == self._current_signature:
+        return False
+
+      models = self._load()
+
+      with self._lock:
+        previous, self._current = self._current, models
+        self._current_signature = signature
+        self.version += 1
+        # a version still held is released by its last holder, see acquire
+        held = id(previous) in self._holders
+
+      print(f"Swapped in model version {self.version}.")
+
+    if previous is not None and not held and self._release is not None:
+      self._release(previous)
+    return True
+
+  async def watch(self, interval: float) -> None:
+    '''
+    Checks for new models every ``interval`` seconds, loading them in a background thread.
+
+    :param interval: The time between checks, in seconds.
+    :type interval: float
+    '''
+    while True:
+      await asyncio.sleep(interval)
+      try:
+        await asyncio.to_thread(self.reload_if_changed)
+      except Exception as e:  # pylint: disable=broad-exception-caught
+        print(f"Error reloading models, keeping version {self.version}: {e}")
+
+
+def files_signature(*paths: str) -> tuple:
+  '''
+  Returns the path, size and modification time of every file under the given paths, so that
+  replacing any model file changes the signature. Hidden files, such as the download state and
+  temporary files of downloads in progress, are ignored.
+
+  :param paths: Files or directories to include. Missing paths are ignored.
+  :type paths: str
+
+  :return: A sorted tuple of ``(path, size, mtime_ns)`` tuples.
+  :rtype: tuple
+  '''
+  files = []
+  for path in paths:
+    if os.path.isfile(path):
+      files.append(path)
+    for root, _, names in os.walk(path):
+      files.extend(os.path.join(root, name) for name in names if not name.startswith('.'))
+
+  signature = []
+  for file in files:
+    try:
+      stat = os.stat(file)
+    except FileNotFoundError:
+      continue
+    signature.append((file, stat.st_size, stat.st_mtime_ns))
+  return tuple(sorted(signature))
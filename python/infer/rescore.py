@@ -0,0 +1,275 @@
+'''
+This script re-scores every existing row of the "form_responses" table with the current BERT and
+SVM models, and upserts the results into the "form_results" table.
+
+Responses are read with keyset pagination on ``response_id``, each page is scored as one batch
+and upserted with one request, and up to ``--concurrency`` pages are scored at once. The last
+``response_id`` whose page and every page before it have been stored is written to a checkpoint
+file, so an interrupted run resumes where it stopped.
+
+The upsert relies on the unique constraint on "form_results.response_id", added by the migration
+frontend/supabase/migrations/20261018000000_form_results_response_id_unique.sql; the run stops
+with an error if it is missing.
+
+It requires the following environment variables to be set:
+- SUPABASE_URL: The URL of the Supabase project.
+- SUPABASE_SERVICE_ROLE_KEY: The service role key for the Supabase project.
+'''
+
+import argparse
+import json
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+from dotenv import load_dotenv
+from postgrest.exceptions import APIError
+from supabase import Client, create_client
+
+from inference import (download_svm_models, load_compiled_svm_models, prepare_bert_model,
+                       write_atomic)
+from listener import BERT_MODEL_PATH, flatten_response, score_responses
+
+# The Postgres error raised when no unique constraint matches the ON CONFLICT columns
+NO_UNIQUE_CONSTRAINT = '42P10'
+
+
+def main(args: argparse.Namespace) -> None:
+  '''
+  Loads the models and re-scores every form response.
+
+  :param args: The command-line arguments.
+  :type args: argparse.Namespace
+  '''
+
+  print("Loading environment variables...")
+
+  load_dotenv()
+
+  url: str = os.environ.get("SUPABASE_URL", "")
+  key: str = os.environ.get("SUPABASE_SERVICE_ROLE_KEY", "")
+
+  if url == "" or key == "":
+    raise ValueError("Supabase URL or key not found in environment variables.")
+
+  print("Environment variables loaded.")
+
+  supabase: Client = create_client(url, key)
+
+  if not args.no_download:
+    download_svm_models(supabase)
+
+  bert_model = prepare_bert_model(args.bert_model)
+  svm_models = load_compiled_svm_models()
+
+  def score(flats: list[dict[str, dict]]) -> list[dict[str, float]]:
+    return score_responses(flats, bert_model, svm_models)
+
+  if args.restart and os.path.exists(args.checkpoint):
+    os.remove(args.checkpoint)
+
+  rescore(supabase, score,
+          page_size=args.page_size,
+          concurrency=args.concurrency,
+          checkpoint=args.checkpoint,
+          dry_run=args.dry_run)
+
+
+def rescore(
+    supabase: Client,
+    score: Callable[[list[dict[str, dict]]], list[dict[str, float]]],
+    page_size: int = 500,
+    concurrency: int = 2,
+    checkpoint: str = 'rescore-checkpoint.json',
+    dry_run: bool = False
+) -> int:
+  '''
+  Re-scores every form response after the one recorded in the checkpoint.
+
+  Pages are fetched in order on the calling thread while up to ``concurrency`` pages are scored
+  and upserted in a thread pool. The checkpoint only advances past a page once that page and every
+  page before it have been stored.
+
+  :param supabase: The Supabase client.
+  :type supabase: Client
+
+  :param score: The function that scores a list of flattened responses.
+  :type score: Callable
+
+  :param page_size: The number of responses fetched, scored and upserted together.
+  :type page_size: int
+
+  :param concurrency: The maximum number of pages being scored at once.
+  :type concurrency: int
+
+  :param checkpoint: The path of the checkpoint file.
+  :type checkpoint: str
+
+  :param dry_run: If True, score the responses without storing results or advancing the
+  checkpoint.
+  :type dry_run: bool
+
+  :return: The number of responses scored by this run.
+  :rtype: int
+  '''
+  state = read_checkpoint(checkpoint)
+  after = state['last_response_id']
+  if after is not None:
+    print(f"Resuming after response {after} ({state['scored']} already scored).")
+
+  pending: deque[tuple[str, Future]] = deque()
+  scored = 0
+
+  def finish_oldest() -> None:
+    nonlocal scored
+    last_id, future = pending.popleft()
+    scored += future.result()
+    state['scored'] += future.result()
+    state['last_response_id'] = last_id
+    if not dry_run:
+      write_atomic(checkpoint, json.dumps(state).encode())
+    print(f"Scored {scored} responses, up to {last_id}.")
+
+  with ThreadPoolExecutor(max_workers=concurrency) as pool:
+    while True:
+      rows = fetch_page(supabase, after, page_size)
+      if not rows:
+        break
+
+      after = rows[-1]['response_id']
+      pending.append((after, pool.submit(score_page, supabase, rows, score, dry_run)))
+
+      # bound the pages in flight; the oldest page is the one the checkpoint waits for
+      while len(pending) >= concurrency:
+        finish_oldest()
+
+      if len(rows) < page_size:
+        break
+
+    while pending:
+      finish_oldest()
+
+  print(f"Done: {scored} responses re-scored.")
+  return scored
+
+
+def fetch_page(supabase: Client, after: str | None, page_size: int) -> list[dict]:
+  '''
+  Fetches the next page of form responses ordered by ``response_id``.
+
+  :param supabase: The Supabase client.
+  :type supabase: Client
+
+  :param after: The last ``response_id`` of the previous page, or None for the first page.
+  :type after: str | None
+
+  :param page_size: The maximum number of responses to fetch.
+  :type page_size: int
+
+  :return: The ``response_id`` and ``response`` of each form response.
+  :rtype: list[dict]
+  '''
+  query = (supabase.table("form_responses")
+           .select("response_id, response")
+           .order("response_id")
+           .limit(page_size))
+  if after is not None:
+    query = query.gt("response_id", after)
+  return query.execute().data
+
+
+def score_page(
+    supabase: Client,
+    rows: list[dict],
+    score: Callable[[list[dict[str, dict]]], list[dict[str, float]]],
+    dry_run: bool = False
+) -> int:
+  '''
+  Scores a page of form responses as one batch and upserts the results with one request.
+  Responses that cannot be parsed are reported and skipped.
+
+  :param supabase: The Supabase client.
+  :type supabase: Client
+
+  :param rows: The form responses.
+  :type rows: list[dict]
+
+  :param score: The function that scores a list of flattened responses.
+  :type score: Callable
+
+  :param dry_run: If True, do not store the results.
+  :type dry_run: bool
+
+  :return: The number of responses scored.
+  :rtype: int
+
+  :raises RuntimeError: If "form_results.response_id" has no unique constraint.
+  '''
+  parsed = []
+  for row in rows:
+    try:
+      parsed.append((row['response_id'], flatten_response(row['response']['response'])))
+    except (KeyError, TypeError, AttributeError) as e:
+      print(f"Skipping response {row.get('response_id')}: malformed response ({e!r})")
+
+  if not parsed:
+    return 0
+
+  results = score([flat for _, flat in parsed])
+
+  if not dry_run:
+    try:
+      (supabase.table("form_results")
+       .upsert([{"response_id": response_id, "results": res}
+                for (response_id, _), res in zip(parsed, results)],
+               on_conflict="response_id")
+       .execute())
+    except APIError as e:
+      if e.code == NO_UNIQUE_CONSTRAINT:
+        raise RuntimeError(
+            'The upsert needs a unique constraint on "form_results.response_id"; apply '
+            'frontend/supabase/migrations/20261018000000_form_results_response_id_unique.sql'
+        ) from e
+      raise
+
+  return len(parsed)
+
+
+def read_checkpoint(path: str) -> dict:
+  '''
+  Reads the checkpoint of a previous run.
+
+  :param path: The path of the checkpoint file.
+  :type path: str
+
+  :return: A dictionary with the ``'last_response_id'`` stored and the number ``'scored'``.
+  :rtype: dict
+  '''
+  if not os.path.exists(path):
+    return {'last_response_id': None, 'scored': 0}
+  with open(path, 'r', encoding='utf-8') as f:
+    return json.load(f)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+      description="Re-score every form response with the current models.")
+
+  parser.add_argument('--bert-model', type=str, default=BERT_MODEL_PATH,
+                      help=f"Path to the BERT model (default: {BERT_MODEL_PATH}).")
+  parser.add_argument('--checkpoint', type=str, default='rescore-checkpoint.json',
+                      help="Path to the checkpoint file (default: rescore-checkpoint.json).")
+  parser.add_argument('--concurrency', type=int, default=2,
+                      help="Maximum number of pages being scored at once (default: 2).")
+  parser.add_argument('--dry-run', action='store_true',
+                      help="Score the responses without storing the results.")
+  parser.add_argument('--no-download', action='store_true',
+                      help="Skip downloading the SVM models and use the local ones.")
+  parser.add_argument('--page-size', type=int, default=500,
+                      help="Number of responses fetched, scored and upserted together "
+                           "(default: 500).")
+  parser.add_argument('--restart', action='store_true',
+                      help="Ignore the checkpoint and re-score every response.")
+
+  main(parser.parse_args())
@@ -2,17 +2,46 @@
 
 '''Unit tests for the inference module.'''
 
+import asyncio
+import json
+import os
 import pickle
-# import os
+import struct
+import subprocess
+import sys
+import tempfile
 import unittest
-from unittest.mock import MagicMock, patch, mock_open
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from unittest.mock import AsyncMock, MagicMock, patch, mock_open
 
 import numpy as np
+from sklearn.linear_model import SGDClassifier
+from sklearn.svm import SVC, LinearSVC
 
 # import tensorflow as tf
 
+import cache
 import inference
 import listener
+import registry
+import rescore
+
+
+def write_svm_bundle(path: str, models: dict) -> None:
+  '''Writes SVM models in the bundle format produced by svm/util.py.'''
+  entries, data = {}, b""
+  for name, model in models.items():
+    entries[name] = {} if isinstance(model, SVC) else {"scheme": "ovr"}
+    for key, array in [("coef", np.asarray(model.coef_, "<f8")),
+                       ("intercept", np.asarray(model.intercept_, "<f8")),
+                       ("classes", np.asarray(model.classes_, "<i8"))]:
+      entries[name][key] = {"offset": len(data), "dtype": array.dtype.str, "shape": array.shape}
+      data += array.tobytes()
+  header = json.dumps({"models": entries}).encode()
+  with open(path, "wb") as f:
+    f.write(inference.SVM_BUNDLE_MAGIC + struct.pack("<II", inference.SVM_BUNDLE_VERSION,
+                                                     len(header)) + header + data)
 
 
 class TestInference(unittest.TestCase):
@@ -29,6 +58,24 @@ class TestInference(unittest.TestCase):
     self.assertEqual(result, {"item1": 1})
     mock_model.predict.assert_called_once()
 
+  def test_bert_infer_batched_matches_unbatched(self):
+    '''Test that batched BERT inference runs one predict call and matches per-KF inference.'''
+    logits = {"a": [0.7, 0.2, 0.1], "b": [0.1, 0.3, 0.6], "c": [0.2, 0.5, 0.3]}
+    mock_model = MagicMock()
+    mock_model.predict.side_effect = lambda sentences: np.array([logits[s] for s in sentences])
+
+    input_data = {"1.1": ["a", "b", "b"], "1.2": ["c"], "2.1": ["a", "c"]}
+    batched = inference.bert_infer(mock_model, input_data)
+
+    mock_model.predict.assert_called_once_with(["a", "b", "b", "c", "a", "c"])
+
+    mock_model.predict.reset_mock()
+    unbatched = inference.bert_infer(mock_model, input_data, batched=False)
+
+    self.assertEqual(mock_model.predict.call_count, 3)
+    self.assertEqual(batched, unbatched)
+    self.assertEqual(batched, {"1.1": 2, "1.2": 1, "2.1": 0})
+
   def test_svm_infer_correct_class(self):
     '''Test the SVM inference function with a correct class prediction.'''
     mock_model = MagicMock()
@@ -41,40 +88,240 @@ class TestInference(unittest.TestCase):
     self.assertEqual(result, {"abc": 1})
     mock_model.predict.assert_called_once()
 
-  @patch("tensorflow.keras.models.load_model")
+  def test_bert_infer_many_single_predict(self):
+    '''Test that BERT inference over several responses runs a single predict call.'''
+    mock_model = MagicMock()
+    mock_model.predict.side_effect = lambda sentences: np.array(
+        [[0.9, 0.1] if s == "bad" else [0.1, 0.9] for s in sentences])
+
+    batch = [{"1.1": ["bad", "good"], "1.2": ["bad"]}, {}, {"1.1": ["good"]}]
+    result = inference.bert_infer_many(mock_model, batch)
+
+    mock_model.predict.assert_called_once_with(["bad", "good", "bad", "good"])
+    self.assertEqual(result, [{"1.1": 0, "1.2": 0}, {}, {"1.1": 1}])
+
+  def test_svm_infer_many_groups_by_kf(self):
+    '''Test that SVM inference over several responses calls each model once.'''
+    mock_model = MagicMock()
+    mock_model.predict.side_effect = lambda rows: [int(row[0]) for row in rows]
+
+    models = {"mcq_kf1_1": mock_model}
+    batch = [{"1.1": [True, False]}, {"1.1": [False, True]}]
+
+    result = inference.svm_infer_many(models, batch)
+    self.assertEqual(result, [{"1.1": 1}, {"1.1": 0}])
+    mock_model.predict.assert_called_once_with([[True, False], [False, True]])
+
+  def test_compiled_svm_matches_sklearn(self):
+    '''Test that the compiled SVM models reproduce the one-vs-one predictions of sklearn.'''
+    rng = np.random.default_rng(0)
+    shapes = {"1.1": (5, [0, 1]), "1.2": (7, [0, 1, 3]), "2.1": (4, [0, 1, 2, 3])}
+
+    models = {}
+    for kf, (n_features, classes) in shapes.items():
+      x = rng.integers(0, 2, (80, n_features)).astype(bool)
+      y = rng.choice(classes, 80)
+      models["mcq_kf" + kf.replace(".", "_")] = SVC(kernel='linear').fit(x, y)
+
+    batch = [{kf: rng.integers(0, 2, n_features).astype(bool).tolist()
+              for kf, (n_features, _) in shapes.items() if rng.random() < 0.9}
+             for _ in range(300)]
+
+    compiled = inference.compile_svm_models(models)
+    self.assertEqual(inference.svm_infer_many(compiled, batch),
+                     inference.svm_infer_many(models, batch))
+    self.assertEqual(inference.svm_infer(compiled, batch[0]),
+                     inference.svm_infer(models, batch[0]))
+
+  def test_compiled_svm_matches_sklearn_one_vs_rest(self):
+    '''Test that the compiled models reproduce the predictions of one-vs-rest linear models.'''
+    rng = np.random.default_rng(1)
+    shapes = {"1.1": (5, [0, 1]), "1.2": (7, [0, 1, 3]), "2.1": (4, [0, 1, 2, 3]),
+              "2.2": (6, [1, 2])}
+
+    models = {}
+    for i, (kf, (n_features, classes)) in enumerate(shapes.items()):
+      x = rng.integers(0, 2, (80, n_features)).astype(bool)
+      y = rng.choice(classes, 80)
+      estimator = [SVC(kernel='linear'), LinearSVC(), SGDClassifier(random_state=0)][i % 3]
+      models["mcq_kf" + kf.replace(".", "_")] = estimator.fit(x, y)
+
+    batch = [{kf: rng.integers(0, 2, n_features).astype(bool).tolist()
+              for kf, (n_features, _) in shapes.items()}
+             for _ in range(300)]
+
+    compiled = inference.compile_svm_models(models)
+    self.assertEqual(inference.svm_infer_many(compiled, batch),
+                     inference.svm_infer_many(models, batch))
+
+    with tempfile.TemporaryDirectory() as folder:
+      path = os.path.join(folder, inference.SVM_BUNDLE_NAME)
+      write_svm_bundle(path, models)
+      bundled = inference.pack_svm_layouts(inference.load_svm_bundle(path))
+      self.assertEqual(inference.svm_infer_many(bundled, batch),
+                       inference.svm_infer_many(models, batch))
+      del bundled
+
+  def test_compiled_svm_one_vs_rest_binary_tie(self):
+    '''Test that a binary one-vs-rest model predicts the first class for a decision value of 0.'''
+    model = LinearSVC().fit([[0, 1], [1, 0], [1, 1], [0, 0]], [0, 1, 1, 0])
+    model.coef_ = np.array([[1.0, -1.0]])
+    model.intercept_ = np.array([0.0])
+    batch = [{"1.1": [True, True]}, {"1.1": [True, False]}, {"1.1": [False, True]}]
+
+    compiled = inference.compile_svm_models({"mcq_kf1_1": model})
+    self.assertEqual(inference.svm_infer_many(compiled, batch),
+                     [{"1.1": label} for label in model.predict([[1, 1], [1, 0], [0, 1]])])
+
+  def test_compiled_svm_wrong_feature_count(self):
+    '''Test that the compiled SVM models reject responses with the wrong number of features.'''
+    model = SVC(kernel='linear').fit([[0, 1], [1, 0], [1, 1], [0, 0]], [0, 1, 1, 0])
+    compiled = inference.compile_svm_models({"mcq_kf1_1": model})
+    with self.assertRaises(ValueError):
+      inference.svm_infer_many(compiled, [{"1.1": [True, False, True]}])
+
+  def test_svm_infer_skips_unknown_kf(self):
+    '''Test that a key function without a model is left out instead of failing the batch.'''
+    model = SVC(kernel='linear').fit([[0, 1], [1, 0], [1, 1], [0, 0]], [0, 1, 1, 0])
+    models = {"mcq_kf1_1": model}
+    batch = [{"1.1": [True, False], "9.9": [True]}, {"9.9": [False]}]
+
+    for scorer in [models, inference.compile_svm_models(models)]:
+      self.assertEqual(inference.svm_infer_many(scorer, batch), [{"1.1": 1}, {}])
+      self.assertEqual(inference.svm_infer_many(scorer, batch, cache=cache.InferenceCache()),
+                       [{"1.1": 1}, {}])
+
+    mock_bert = MagicMock()
+    mock_bert.predict.side_effect = lambda sentences: np.array([[0.1, 0.9]] * len(sentences))
+    results = listener.score_responses(
+        [{"1.1": {"bert": ["good"], "svm": [True, False]}, "9.9": {"bert": ["ok"], "svm": [True]}}],
+        mock_bert, models)
+    self.assertEqual(results, [{"1.1": 1.0, "9.9": 1}])
+
+  def test_load_svm_bundle_matches_pickled_models(self):
+    '''Test that a memory-mapped model bundle compiles to the same scorer as the models.'''
+    x = [[0, 1, 1], [1, 0, 0], [1, 1, 0], [0, 0, 1], [1, 1, 1], [0, 1, 0]]
+    models = {"mcq_kf1_1": SVC(kernel='linear').fit(x, [0, 1, 1, 0, 1, 0]),
+              "mcq_kf1_2": SVC(kernel='linear').fit(x, [0, 1, 2, 0, 2, 1])}
+
+    with tempfile.TemporaryDirectory() as folder:
+      path = os.path.join(folder, inference.SVM_BUNDLE_NAME)
+      write_svm_bundle(path, models)
+      layouts = inference.load_svm_bundle(path)
+
+      self.assertEqual(set(layouts), set(models))
+      bundled = inference.pack_svm_layouts(layouts)
+      compiled = inference.compile_svm_models(models)
+      for field in ["weights", "intercepts", "pos_votes", "neg_votes", "classes"]:
+        np.testing.assert_array_equal(getattr(bundled, field), getattr(compiled, field))
+      del layouts, bundled
+
+  def test_load_svm_bundle_bad_magic(self):
+    '''Test that a file that is not a model bundle is rejected.'''
+    with tempfile.TemporaryDirectory() as folder:
+      path = os.path.join(folder, "not-a-bundle")
+      with open(path, "wb") as f:
+        f.write(b"not a bundle at all")
+      with self.assertRaises(ValueError):
+        inference.load_svm_bundle(path)
+
+  @patch("inference.load_svm_models", return_value={})
+  @patch("inference.load_svm_bundle", return_value={})
+  @patch("os.path.exists", return_value=True)
+  def test_load_compiled_svm_models_prefers_bundle(self, mock_exists, mock_load_bundle,
+                                                   mock_load_models):
+    '''Test that the model bundle is used instead of the pickles when it is present.'''
+    inference.load_compiled_svm_models()
+    mock_load_bundle.assert_called_once_with(
+        os.path.join(inference.SVM_MODELS_DIR, inference.SVM_BUNDLE_NAME))
+    mock_load_models.assert_not_called()
+
+  @patch("inference.import_tensorflow")
   @patch("os.path.exists", return_value=True)
-  def test_load_bert_model_success(self, mock_exists, mock_load_model):
+  def test_load_bert_model_success(self, mock_exists, mock_import_tensorflow):
     '''Test loading a BERT model successfully.'''
     mock_model = MagicMock()
+    mock_load_model = mock_import_tensorflow.return_value.keras.models.load_model
     mock_load_model.return_value = mock_model
 
     model = inference.load_bert_model("mock_model_path")
     self.assertEqual(model, mock_model)
     mock_load_model.assert_called_once_with("mock_model_path", compile=False)
 
+  def test_warm_up_bert_model(self):
+    '''Test that the warm-up runs one dummy batch through the model.'''
+    mock_model = MagicMock()
+    inference.warm_up_bert_model(mock_model, batch_size=4)
+    mock_model.predict.assert_called_once()
+    self.assertEqual(len(mock_model.predict.call_args[0][0]), 4)
+
+  @patch("inference.warm_up_bert_model")
+  @patch("inference.load_bert_model")
+  def test_prepare_bert_model_skips_warm_up(self, mock_load, mock_warm_up):
+    '''Test that a warm-up batch size of 0 skips the warm-up.'''
+    self.assertEqual(inference.prepare_bert_model("path", warm_up_batch_size=0),
+                     mock_load.return_value)
+    mock_warm_up.assert_not_called()
+
+  def test_import_does_not_load_tensorflow(self):
+    '''Test that importing the inference module does not import TensorFlow.'''
+    result = subprocess.run(
+        [sys.executable, "-c",
+         "import sys, inference; print('tensorflow' in sys.modules)"],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        capture_output=True, text=True, check=True)
+    self.assertEqual(result.stdout.strip(), "False")
+
   @patch("os.path.exists", return_value=False)
   def test_load_bert_model_file_not_found(self, mock_exists):
     '''Test loading a BERT model when the file does not exist.'''
     with self.assertRaises(FileNotFoundError):
       inference.load_bert_model("nonexistent_path")
 
-  @patch("builtins.open", new_callable=mock_open)
-  @patch("os.makedirs")
-  @patch("os.path.exists", return_value=False)
-  def test_download_svm_models(self, mock_exists, mock_makedirs, mock_file):
+  def test_download_svm_models(self):
     '''Test downloading SVM models from Supabase storage.'''
     mock_bucket = MagicMock()
-    mock_bucket.list.return_value = [{'name': 'model1.pkl'}]
-    mock_bucket.download.return_value = b"mock_pickle_data"
+    mock_bucket.list.return_value = [{'name': 'model1.pkl', 'id': '1',
+                                      'metadata': {'eTag': '"v1"'}},
+                                     {'name': 'model2.pkl', 'id': '2',
+                                      'metadata': {'eTag': '"v1"'}},
+                                     {'name': 'folder', 'id': None}]
+    mock_bucket.download.side_effect = lambda name: f"data of {name}".encode()
 
     mock_supabase = MagicMock()
     mock_supabase.storage.from_.return_value = mock_bucket
 
-    inference.download_svm_models(mock_supabase)
-
-    mock_makedirs.assert_called_once_with("svm-models")
-    mock_file.assert_called_once_with("svm-models/model1.pkl", "wb")
-    mock_file().write.assert_called_once_with(b"mock_pickle_data")
+    with tempfile.TemporaryDirectory() as folder:
+      models_dir = os.path.join(folder, "svm-models")
+      with patch("inference.SVM_MODELS_DIR", models_dir):
+        downloaded = inference.download_svm_models(mock_supabase, max_workers=2)
+
+        self.assertEqual(downloaded, ['model1.pkl', 'model2.pkl'])
+        with open(os.path.join(models_dir, 'model1.pkl'), 'rb') as f:
+          self.assertEqual(f.read(), b"data of model1.pkl")
+        self.assertEqual(sorted(os.listdir(models_dir)),
+                         [inference.SVM_DOWNLOAD_STATE_NAME, 'model1.pkl', 'model2.pkl'])
+
+        # unchanged objects are skipped, changed ones are downloaded again
+        mock_bucket.download.reset_mock()
+        mock_bucket.list.return_value[1]['metadata']['eTag'] = '"v2"'
+        downloaded = inference.download_svm_models(mock_supabase)
+
+        self.assertEqual(downloaded, ['model2.pkl'])
+        mock_bucket.download.assert_called_once_with('model2.pkl')
+
+        # a missing local file is downloaded again even if the ETag matches
+        os.remove(os.path.join(models_dir, 'model1.pkl'))
+        self.assertEqual(inference.download_svm_models(mock_supabase), ['model1.pkl'])
+
+  def test_write_atomic_leaves_no_partial_file(self):
+    '''Test that a failed atomic write leaves neither the target nor a temporary file.'''
+    with tempfile.TemporaryDirectory() as folder:
+      path = os.path.join(folder, "model.pkl")
+      with patch("os.replace", side_effect=OSError("disk full")):
+        with self.assertRaises(OSError):
+          inference.write_atomic(path, b"data")
+      self.assertEqual(os.listdir(folder), [])
 
   @patch("builtins.open", new_callable=mock_open, read_data=pickle.dumps("mock_model"))
   @patch("os.listdir", return_value=["model1.pkl"])
@@ -100,7 +347,8 @@ class TestListener(unittest.TestCase):
                                                       "1.2": {"text": ["Needs improvement."],
                                                               "1.2.1": False, "1.2.2": True}}}}}}}
     self.mock_bert_model = MagicMock()
-    self.mock_bert_model.predict.return_value = np.array([[0.1, 0.9]])
+    self.mock_bert_model.predict.side_effect = lambda sentences: np.array([[0.1, 0.9]] *
+                                                                           len(sentences))
 
     self.mock_svm_models = {
         "mcq_kf1_1": MagicMock(),
@@ -110,28 +358,416 @@ class TestListener(unittest.TestCase):
     self.mock_svm_models["mcq_kf1_2"].predict.return_value = [0]
 
     self.mock_supabase = MagicMock()
-    self.mock_supabase.table.return_value.insert.return_value.execute.return_value = None
-
-  @patch("inference.bert_infer")
-  @patch("inference.svm_infer")
-  def test_handle_new_response(self, mock_svm_infer, mock_bert_infer):
-    '''Test the handle_new_response function in the listener module.'''
-    # Mock inference functions
-    mock_bert_infer.return_value = {"1.1": 1, "1.2": 1}
-    mock_svm_infer.return_value = {"1.1": 1, "1.2": 0}
+    self.mock_supabase.table.return_value.upsert.return_value.execute.return_value = None
 
+  def test_handle_new_response(self):
+    '''Test the handle_new_response function scores with the given models and stores the result.'''
     listener.handle_new_response(self.payload, self.mock_bert_model,
                                  self.mock_svm_models, self.mock_supabase)
 
-    # Check that data was inserted into Supabase
+    self.mock_bert_model.predict.assert_called_once()
+    self.mock_svm_models["mcq_kf1_1"].predict.assert_called_once()
+
+    # Check that data was upserted into Supabase
     self.mock_supabase.table.assert_called_with("form_results")
-    self.mock_supabase.table().insert.assert_called_once()
+    self.mock_supabase.table().upsert.assert_called_once()
+    self.assertEqual(self.mock_supabase.table().upsert.call_args[1], {"on_conflict": "response_id"})
+
+    upserted_data = self.mock_supabase.table().upsert.call_args[0][0]
+    self.assertEqual(upserted_data["response_id"], "abc123")
+    self.assertIn("results", upserted_data)
+    self.assertEqual(upserted_data["results"]["1.1"], 1)
+    self.assertEqual(upserted_data["results"]["1.2"], 0.25)
+
+  def test_process_batch_single_upsert(self):
+    '''Test that a batch is scored in the executor and stored with one async upsert.'''
+    second = {"data": {"record": {"response_id": "def456",
+                                  "response": {"response": {"1": {"1.1": {"text": ["Good."],
+                                                                          "1.1.1": False,
+                                                                          "1.1.2": True}}}}}}}
+    self.mock_svm_models["mcq_kf1_1"].predict.side_effect = lambda rows: [1] * len(rows)
+
+    mock_asupabase = MagicMock()
+    mock_asupabase.table.return_value.upsert.return_value.execute = AsyncMock()
+
+    score = partial(listener.score_responses, bert_model=self.mock_bert_model,
+                    svm_models=self.mock_svm_models)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+      asyncio.run(listener.process_batch([self.payload, second],
+                                         listener.Backend(executor, score), mock_asupabase))
+
+    self.mock_bert_model.predict.assert_called_once()
+    self.mock_svm_models["mcq_kf1_1"].predict.assert_called_once()
+    mock_asupabase.table.assert_called_with("form_results")
+    mock_asupabase.table().upsert.assert_called_once()
+    mock_asupabase.table().upsert.return_value.execute.assert_awaited_once()
+
+    upserted_data = mock_asupabase.table().upsert.call_args[0][0]
+    self.assertEqual([row["response_id"] for row in upserted_data], ["abc123", "def456"])
+    self.assertEqual(upserted_data[1]["results"], {"1.1": 1})
+
+  def test_process_batch_isolates_failures(self):
+    '''Test that malformed and failing responses are skipped and the others are stored.'''
+    def make_payload(response_id, text):
+      return {"data": {"record": {"response_id": response_id,
+                                  "response": {"response": {"1": {"1.1": {"text": [text]}}}}}}}
+
+    def score(flats):
+      if any(flat["1.1"]["bert"] == ["fail"] for flat in flats):
+        raise ValueError("cannot score")
+      return [{"1.1": 1.0}] * len(flats)
+
+    mock_asupabase = MagicMock()
+    mock_asupabase.table.return_value.upsert.return_value.execute = AsyncMock()
+    payloads = [make_payload("r1", "good"), {"data": {"record": {}}},
+                make_payload("r3", "fail"), make_payload("r4", "good")]
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+      asyncio.run(listener.process_batch(payloads, listener.Backend(executor, score),
+                                         mock_asupabase))
+
+    mock_asupabase.table().upsert.assert_called_once_with(
+        [{"response_id": "r1", "results": {"1.1": 1.0}},
+         {"response_id": "r4", "results": {"1.1": 1.0}}], on_conflict="response_id")
+
+  def test_enqueue_payload_drops_when_full(self):
+    '''Test that a payload received while the queue is full is dropped.'''
+    async def run():
+      queue = asyncio.Queue(maxsize=1)
+      return (listener.enqueue_payload(queue, self.payload),
+              listener.enqueue_payload(queue, self.payload), queue.qsize())
+
+    with patch("builtins.print") as mock_print:
+      self.assertEqual(asyncio.run(run()), (True, False, 1))
+    self.assertIn("abc123", mock_print.call_args[0][0])
+
+  def test_batch_worker_bounds_in_flight(self):
+    '''Test that the worker keeps collecting while batches are scoring, up to the bound.'''
+    async def run():
+      queue = asyncio.Queue()
+      release = asyncio.Event()
+      started = []
+
+      async def fake_process_batch(batch, *args):
+        started.append(batch)
+        await release.wait()
+
+      with patch("listener.process_batch", side_effect=fake_process_batch):
+        worker = asyncio.create_task(listener.batch_worker(
+            queue, MagicMock(), None, max_batch_size=1, max_wait=0, max_in_flight=2))
+        for i in range(3):
+          queue.put_nowait(i)
+        await asyncio.sleep(0.05)
+        blocked = list(started)
+        release.set()
+        await asyncio.wait_for(queue.join(), 1)
+        worker.cancel()
+      return blocked, started
+
+    blocked, started = asyncio.run(run())
+    self.assertEqual(blocked, [[0], [1]])
+    self.assertEqual(started, [[0], [1], [2]])
+
+  @patch("listener.time.monotonic")
+  def test_cache_stats_printed_at_interval(self, mock_monotonic):
+    '''Test that the cache statistics are printed at most once per interval.'''
+    caches = listener.create_caches(10, 60, stats_interval=300)
+    printed = listener._cache_stats_printed  # pylint: disable=protected-access
+    with patch.dict(printed, clear=True), patch("builtins.print") as mock_print:
+      for now in [1000, 1100, 1299, 1300]:
+        mock_monotonic.return_value = now
+        listener.print_cache_stats(caches)
+      self.assertEqual(mock_print.call_count, 2)
+
+      mock_print.reset_mock()
+      listener.print_cache_stats(caches._replace(stats_interval=0))
+      mock_print.assert_not_called()
+
+  def test_create_backend_loader_unknown_kind(self):
+    '''Test that an unknown executor kind is rejected.'''
+    with self.assertRaises(ValueError):
+      listener.create_backend_loader("gpu", 1)
+
+  @patch("listener.load_compiled_svm_models")
+  @patch("listener.prepare_bert_model")
+  def test_thread_backend_reload_shares_executor(self, mock_load_bert, mock_load_svm):
+    '''Test that each thread-mode version binds its own models to the shared thread pool.'''
+    load, release = listener.create_backend_loader("thread", 1)
+    first, second = load(), load()
+
+    self.assertIsNone(release)
+    self.assertIs(first.executor, second.executor)
+    self.assertEqual(mock_load_bert.call_count, 2)
+    self.assertEqual(mock_load_svm.call_count, 2)
+    first.executor.shutdown()
+
+  def test_collect_batch_max_size(self):
+    '''Test that a batch is cut off at the maximum batch size.'''
+    async def run():
+      queue = asyncio.Queue()
+      for i in range(5):
+        queue.put_nowait(i)
+      first = await listener.collect_batch(queue, max_batch_size=3, max_wait=1)
+      second = await listener.collect_batch(queue, max_batch_size=3, max_wait=0.01)
+      return first, second
+
+    first, second = asyncio.run(run())
+    self.assertEqual(first, [0, 1, 2])
+    self.assertEqual(second, [3, 4])
+
+  def test_collect_batch_max_wait(self):
+    '''Test that a batch collects items arriving before the maximum wait time.'''
+    async def run():
+      queue = asyncio.Queue()
+      queue.put_nowait("a")
+      asyncio.get_running_loop().call_later(0.01, queue.put_nowait, "b")
+      asyncio.get_running_loop().call_later(0.5, queue.put_nowait, "c")
+      return await listener.collect_batch(queue, max_batch_size=10, max_wait=0.1)
+
+    self.assertEqual(asyncio.run(run()), ["a", "b"])
+
+
+class TestCache(unittest.TestCase):
+  '''Unit tests for the cache module.'''
+
+  def test_lru_eviction_and_stats(self):
+    '''Test that the least recently used entry is evicted and lookups are counted.'''
+    c = cache.InferenceCache(maxsize=2, ttl=60)
+    c.put("a", 1)
+    c.put("b", 2)
+    self.assertEqual(c.get("a"), 1)
+    c.put("c", 3)
+
+    self.assertIsNone(c.get("b"))
+    self.assertEqual(c.get("c"), 3)
+    self.assertEqual(c.stats(), {'hits': 2, 'misses': 1, 'hit_rate': 2 / 3, 'size': 2})
+
+  @patch("cache.time.monotonic")
+  def test_ttl_expiry(self, mock_monotonic):
+    '''Test that entries expire after the time-to-live.'''
+    mock_monotonic.return_value = 100
+    c = cache.InferenceCache(maxsize=10, ttl=5)
+    c.put("a", 1)
+
+    mock_monotonic.return_value = 104
+    self.assertEqual(c.get("a"), 1)
+    mock_monotonic.return_value = 106
+    self.assertIsNone(c.get("a"))
+    self.assertEqual(len(c), 0)
+
+  def test_keys(self):
+    '''Test that keys ignore case and whitespace but not the model version.'''
+    self.assertEqual(cache.text_key("  Meets\texpectations ", 1),
+                     cache.text_key("meets expectations", 1))
+    self.assertNotEqual(cache.text_key("meets expectations", 1),
+                        cache.text_key("meets expectations", 2))
+    self.assertNotEqual(cache.mcq_key("1.1", [True, False], 1),
+                        cache.mcq_key("1.1", [False, True], 1))
+
+  def test_bert_infer_many_cached(self):
+    '''Test that only distinct sentences missing from the cache are run through BERT.'''
+    mock_model = MagicMock()
+    mock_model.predict.side_effect = lambda sentences: np.array(
+        [[0.9, 0.1] if "n/a" in s.lower() else [0.1, 0.9] for s in sentences])
+    c = cache.InferenceCache()
+
+    batch = [{"1.1": ["N/A", "good"]}, {"1.1": ["n/a"], "1.2": ["good"]}]
+    first = inference.bert_infer_many(mock_model, batch, cache=c, model_version=1)
+    mock_model.predict.assert_called_once_with(["N/A", "good"])
+
+    mock_model.predict.reset_mock()
+    second = inference.bert_infer_many(mock_model, batch, cache=c, model_version=1)
+    mock_model.predict.assert_not_called()
 
-    inserted_data = self.mock_supabase.table().insert.call_args[0][0]
-    self.assertEqual(inserted_data["response_id"], "abc123")
-    self.assertIn("results", inserted_data)
-    self.assertEqual(inserted_data["results"]["1.1"], 1)
-    self.assertEqual(inserted_data["results"]["1.2"], 0.25)
+    self.assertEqual(first, second)
+    self.assertEqual(first, inference.bert_infer_many(mock_model, batch))
+
+    inference.bert_infer_many(mock_model, batch, cache=c, model_version=2)
+    self.assertEqual(mock_model.predict.call_count, 2)
+
+  def test_svm_infer_many_cached(self):
+    '''Test that only MCQ answers missing from the cache are scored.'''
+    mock_model = MagicMock()
+    mock_model.predict.side_effect = lambda rows: [int(row[0]) for row in rows]
+    models = {"mcq_kf1_1": mock_model, "mcq_kf1_2": mock_model}
+    c = cache.InferenceCache()
+
+    inference.svm_infer_many(models, [{"1.1": [True, False]}], cache=c, model_version=1)
+    mock_model.predict.reset_mock()
+
+    result = inference.svm_infer_many(models, [{"1.2": [False, True], "1.1": [True, False]}],
+                                      cache=c, model_version=1)
+
+    self.assertEqual(result, [{"1.2": 0, "1.1": 1}])
+    self.assertEqual(list(result[0]), ["1.2", "1.1"])
+    mock_model.predict.assert_called_once_with([[False, True]])
+
+
+class TestRegistry(unittest.TestCase):
+  '''Unit tests for the registry module.'''
+
+  def test_reload_only_when_signature_changes(self):
+    '''Test that models are loaded again only when the signature changes.'''
+    signature = ["v1"]
+    load = MagicMock(side_effect=lambda: f"models {signature[0]}")
+    release = MagicMock()
+    refresh = MagicMock()
+
+    reg = registry.ModelRegistry(load, lambda: signature[0], release=release, refresh=refresh)
+    with self.assertRaises(RuntimeError):
+      reg.current()
+
+    self.assertTrue(reg.reload_if_changed())
+    self.assertFalse(reg.reload_if_changed())
+    self.assertEqual(reg.current(), "models v1")
+    release.assert_not_called()
+
+    # a snapshot taken before the swap keeps the old version
+    snapshot = reg.current()
+    signature[0] = "v2"
+    self.assertTrue(reg.reload_if_changed())
+
+    self.assertEqual(snapshot, "models v1")
+    self.assertEqual(reg.current(), "models v2")
+    self.assertEqual(reg.version, 2)
+    self.assertEqual(load.call_count, 2)
+    self.assertEqual(refresh.call_count, 3)
+    release.assert_called_once_with("models v1")
+
+  def test_held_version_released_by_last_holder(self):
+    '''Test that a version replaced while batches hold it is released when the last one exits.'''
+    signature = ["v1"]
+    release = MagicMock()
+    reg = registry.ModelRegistry(lambda: [signature[0]], lambda: signature[0], release=release)
+    reg.reload_if_changed()
+
+    with reg.acquire() as first, reg.acquire():
+      signature[0] = "v2"
+      reg.reload_if_changed()
+      self.assertEqual(reg.current(), ["v2"])
+      with reg.acquire() as second:
+        self.assertEqual(second, ["v2"])
+      release.assert_not_called()
+    release.assert_called_once_with(first)
+
+    signature[0] = "v3"
+    reg.reload_if_changed()
+    self.assertEqual(release.call_count, 2)
+    release.assert_called_with(["v2"])
+
+  def test_failed_load_keeps_current_version(self):
+    '''Test that a failing load leaves the current version in place.'''
+    signature = ["v1"]
+    reg = registry.ModelRegistry(lambda: signature[0], lambda: signature[0])
+    reg.reload_if_changed()
+
+    signature[0] = "v2"
+    with patch.object(reg, "_load", side_effect=OSError("corrupt model")):
+      with self.assertRaises(OSError):
+        reg.reload_if_changed()
+
+    self.assertEqual(reg.current(), "v1")
+    self.assertEqual(reg.version, 1)
+    self.assertTrue(reg.reload_if_changed())
+    self.assertEqual(reg.current(), "v2")
+
+  def test_files_signature(self):
+    '''Test that the signature changes with the model files but not with hidden files.'''
+    with tempfile.TemporaryDirectory() as folder:
+      with open(os.path.join(folder, "model.bundle"), "wb") as f:
+        f.write(b"v1")
+      before = registry.files_signature(folder, os.path.join(folder, "missing"))
+
+      with open(os.path.join(folder, ".download-state.json"), "wb") as f:
+        f.write(b"{}")
+      self.assertEqual(registry.files_signature(folder), before)
+
+      with open(os.path.join(folder, "model.bundle"), "wb") as f:
+        f.write(b"v2 with a different size")
+      self.assertNotEqual(registry.files_signature(folder), before)
+
+
+class TestRescore(unittest.TestCase):
+  '''
+  Unit tests for the rescore module.
+  '''
+
+  @staticmethod
+  def make_row(response_id, text="good"):
+    return {'response_id': response_id,
+            'response': {'response': {'epa1': {'kf1': {'text': [text], 'kf1.1': True}}}}}
+
+  def test_fetch_page_keyset(self):
+    '''Test that pages after the first filter on the last response id.'''
+    supabase = MagicMock()
+    query = supabase.table.return_value.select.return_value.order.return_value.limit.return_value
+    query.execute.return_value.data = ["first"]
+    query.gt.return_value.execute.return_value.data = ["next"]
+
+    self.assertEqual(rescore.fetch_page(supabase, None, 10), ["first"])
+    query.gt.assert_not_called()
+    self.assertEqual(rescore.fetch_page(supabase, "r2", 10), ["next"])
+    query.gt.assert_called_once_with("response_id", "r2")
+    supabase.table.return_value.select.return_value.order.return_value.limit.assert_called_with(10)
+
+  def test_score_page_skips_malformed(self):
+    '''Test that a page is scored as one batch, upserted once, and malformed rows are skipped.'''
+    supabase = MagicMock()
+    score = MagicMock(side_effect=lambda flats: [{'epa1': 1.0}] * len(flats))
+    rows = [self.make_row("r1"), {'response_id': "bad", 'response': None}, self.make_row("r3")]
+
+    self.assertEqual(rescore.score_page(supabase, rows, score), 2)
+    score.assert_called_once_with([{'kf1': {'bert': ['good'], 'svm': [True]}}] * 2)
+    upsert = supabase.table.return_value.upsert
+    upsert.assert_called_once_with(
+        [{'response_id': "r1", 'results': {'epa1': 1.0}},
+         {'response_id': "r3", 'results': {'epa1': 1.0}}],
+        on_conflict="response_id")
+
+  def test_score_page_missing_constraint(self):
+    '''Test that an upsert without the unique constraint on response_id fails clearly.'''
+    supabase = MagicMock()
+    supabase.table.return_value.upsert.return_value.execute.side_effect = rescore.APIError(
+        {'code': rescore.NO_UNIQUE_CONSTRAINT, 'message': "no unique constraint"})
+    score = MagicMock(side_effect=lambda flats: [{}] * len(flats))
+
+    with self.assertRaisesRegex(RuntimeError, "form_results.response_id"):
+      rescore.score_page(supabase, [self.make_row("r1")], score)
+
+  def test_rescore_checkpoint_resume(self):
+    '''Test that the checkpoint records progress and that a second run resumes after it.'''
+    supabase = MagicMock()
+    score = MagicMock(side_effect=lambda flats: [{}] * len(flats))
+    pages = {None: [self.make_row("r1"), self.make_row("r2")],
+             "r2": [self.make_row("r3"), self.make_row("r4")],
+             "r4": [self.make_row("r5")]}
+
+    with tempfile.TemporaryDirectory() as folder:
+      checkpoint = os.path.join(folder, "checkpoint.json")
+      with patch('rescore.fetch_page', side_effect=lambda _, after, __: pages[after]) as fetch:
+        scored = rescore.rescore(supabase, score, page_size=2, concurrency=2,
+                                 checkpoint=checkpoint)
+      self.assertEqual(scored, 5)
+      self.assertEqual([c.args[1] for c in fetch.call_args_list], [None, "r2", "r4"])
+      with open(checkpoint, encoding='utf-8') as f:
+        self.assertEqual(json.load(f), {'last_response_id': "r5", 'scored': 5})
+
+      with patch('rescore.fetch_page', return_value=[]) as fetch:
+        self.assertEqual(rescore.rescore(supabase, score, checkpoint=checkpoint), 0)
+      self.assertEqual(fetch.call_args.args[1], "r5")
+
+  def test_rescore_dry_run(self):
+    '''Test that a dry run neither stores results nor writes a checkpoint.'''
+    supabase = MagicMock()
+    score = MagicMock(side_effect=lambda flats: [{}] * len(flats))
+
+    with tempfile.TemporaryDirectory() as folder:
+      checkpoint = os.path.join(folder, "checkpoint.json")
+      with patch('rescore.fetch_page', return_value=[self.make_row("r1")]):
+        self.assertEqual(rescore.rescore(supabase, score, page_size=2, checkpoint=checkpoint,
+                                         dry_run=True), 1)
+      self.assertFalse(os.path.exists(checkpoint))
+    supabase.table.return_value.upsert.assert_not_called()
 
 
 if __name__ == "__main__":
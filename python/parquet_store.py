@@ -0,0 +1,336 @@
+'''
+The local Parquet store of the training tables fetched from Supabase, shared by the SVM scripts in
+svm/ and the BERT scripts in bert/.
+
+Each table is stored as a folder of Parquet files named "part-<n>.parquet", in id order: the first
+file holds the rows of the last full download and each next file the rows added after the
+previous files. Columns have compact types: the types of :data:`COLUMN_TYPES`, and booleans for
+the MCQ features. The highest id and the number of rows stored from each table are recorded in the
+sync state, a JSON file in the store folder.
+'''
+
+import glob
+import json
+import os
+import shutil
+import tempfile
+from typing import Callable, Iterable, Iterator
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+
+SYNC_STATE_NAME = '.sync-state.json'
+
+# columns with a fixed type; the other columns keep the type of their values, which are the
+# booleans of the MCQ features
+COLUMN_TYPES = {
+    'id': pa.int64(),
+    'created_at': pa.timestamp('us', tz='UTC'),
+    'dev_level': pa.int8(),
+    'user_id': pa.string(),
+    'text': pa.string(),
+}
+METADATA_COLUMNS = ('id', 'created_at', 'user_id')
+
+
+class SchemaChangedError(ValueError):
+  '''
+  Raised when rows added to a table have columns that the stored files do not, for example after a
+  column was added to the table in Supabase. The table has to be downloaded again in full.
+  '''
+
+
+def store_schema(inferred: pa.Schema) -> pa.Schema:
+  '''
+  Returns the storage schema of a table from the schema inferred from its first page.
+
+  :param inferred: The schema inferred from the rows.
+  :type inferred: pa.Schema
+
+  :return: The schema with the types of :data:`COLUMN_TYPES`, and booleans for the other columns
+    without any values on the first page.
+  :rtype: pa.Schema
+  '''
+  fields = []
+  for field in inferred:
+    if field.name in COLUMN_TYPES:
+      fields.append(pa.field(field.name, COLUMN_TYPES[field.name]))
+    elif pa.types.is_null(field.type):
+      fields.append(pa.field(field.name, pa.bool_()))
+    else:
+      fields.append(field)
+  return pa.schema(fields)
+
+
+def to_store_table(pages: list[pa.Table]) -> pa.Table | None:
+  '''
+  Joins pages of rows fetched from Supabase into one Arrow table with the column types of the
+  store. The rows are copied once, whatever the number of pages.
+
+  :param pages: The pages of rows.
+  :type pages: list[pa.Table]
+
+  :return: The Arrow table, or None if there are no pages.
+  :rtype: pa.Table | None
+  '''
+  if not pages:
+    return None
+  # a column without any value on a page has the null type, which is promoted to the type of the
+  # other pages
+  table = pa.concat_tables(pages, promote_options='default').combine_chunks()
+  schema = pa.schema([pa.field(f.name, COLUMN_TYPES.get(f.name, f.type)) for f in table.schema])
+  return table.cast(schema)
+
+
+def list_parts(path: str) -> list[str]:
+  '''
+  Returns the Parquet files of a table, in the order they were added.
+
+  :param path: The path of the table folder.
+  :type path: str
+
+  :return: The paths of the files.
+  :rtype: list[str]
+  '''
+  return sorted(glob.glob(os.path.join(path, 'part-*.parquet')))
+
+
+def write_part(
+    path: str,
+    pages: Iterable[pa.Table],
+    schema: pa.Schema | None = None
+) -> tuple[int, int | None]:
+  '''
+  Writes pages of rows to a Parquet file of the store, one row group per page. The file is only
+  created if there is at least one row.
+
+  :param path: The path of the file.
+  :type path: str
+
+  :param pages: The pages of rows, in id order.
+  :type pages: Iterable[pa.Table]
+
+  :param schema: The schema of the file. Defaults to the :func:`store_schema` of the first page.
+  :type schema: pa.Schema | None
+
+  :return: The number of rows written and the highest id written.
+  :rtype: tuple[int, int | None]
+
+  :raises SchemaChangedError: If ``schema`` is given and a page has a column it does not have.
+  '''
+  writer = None
+  rows = 0
+  last_id = None
+  try:
+    for page in pages:
+      table = to_store_table([page])
+      if schema is None:
+        schema = store_schema(table.schema)
+      elif added := set(table.column_names) - set(schema.names):
+        raise SchemaChangedError(f"The columns {sorted(added)} are not in the stored table")
+      if writer is None:
+        writer = pq.ParquetWriter(path, schema)
+
+      # pick the columns in schema order; a column missing from the page is stored as null
+      columns = [table.column(name) if name in table.column_names else pa.nulls(len(table))
+                 for name in schema.names]
+      writer.write_table(pa.Table.from_arrays(columns, names=schema.names).cast(schema))
+      rows += len(table)
+      last_id = table['id'][-1].as_py()
+  finally:
+    if writer is not None:
+      writer.close()
+  return rows, last_id
+
+
+def append_part(path: str, pages: Iterable[pa.Table]) -> tuple[int, int | None]:
+  '''
+  Adds rows to a table as a new Parquet file with the schema of the stored files, writing the pages
+  as they come. No file is added if there are no rows, and a file is only added once every page
+  has been written.
+
+  :param path: The path of the table folder.
+  :type path: str
+
+  :param pages: The pages of rows to add, in id order.
+  :type pages: Iterable[pa.Table]
+
+  :return: The number of rows added and the highest id added.
+  :rtype: tuple[int, int | None]
+
+  :raises SchemaChangedError: If the rows have a column that the stored files do not. Nothing is
+    added, and the table should be replaced with :func:`replace_table`.
+  '''
+  parts = list_parts(path)
+  schema = pq.read_schema(parts[0]) if parts else None
+
+  fd, tmp_path = tempfile.mkstemp(dir=path, prefix='.tmp-')
+  os.close(fd)
+  try:
+    rows, last_id = write_part(tmp_path, pages, schema)
+    if rows:
+      os.replace(tmp_path, os.path.join(path, f'part-{len(parts):05d}.parquet'))
+    else:
+      os.remove(tmp_path)
+  except BaseException:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+    raise
+  return rows, last_id
+
+
+def replace_table(path: str, pages: Iterable[pa.Table]) -> tuple[int, int | None]:
+  '''
+  Replaces a table with a single Parquet file holding the given rows, writing the pages as they
+  come. The previous table is kept until every page has been written.
+
+  :param path: The path of the table folder.
+  :type path: str
+
+  :param pages: The pages of rows of the table, in id order.
+  :type pages: Iterable[pa.Table]
+
+  :return: The number of rows written and the highest id written.
+  :rtype: tuple[int, int | None]
+  '''
+  parent = os.path.dirname(path) or '.'
+  tmp_dir = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+  try:
+    rows, last_id = write_part(os.path.join(tmp_dir, 'part-00000.parquet'), pages)
+    if os.path.exists(path):
+      # a folder cannot be replaced in one step, so move the old one out of the way first
+      old_dir = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+      os.replace(path, os.path.join(old_dir, 'old'))
+      os.replace(tmp_dir, path)
+      shutil.rmtree(old_dir)
+    else:
+      os.replace(tmp_dir, path)
+  except BaseException:
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    raise
+  return rows, last_id
+
+
+def read_table(
+    path: str,
+    columns: list[str] | None = None,
+    exclude: Iterable[str] = ()
+) -> pd.DataFrame:
+  '''
+  Reads a table from the store, loading only the columns requested.
+
+  :param path: The path of the table folder.
+  :type path: str
+
+  :param columns: The columns to read, in order. Defaults to every column.
+  :type columns: list[str] | None
+
+  :param exclude: Columns to leave out, such as :data:`METADATA_COLUMNS`.
+  :type exclude: Iterable[str]
+
+  :return: The rows of the table.
+  :rtype: pd.DataFrame
+  '''
+  parts = list_parts(path)
+  if not parts:
+    return pd.DataFrame(columns=columns)
+
+  if columns is None:
+    # every file has the columns of the first, see append_part
+    columns = pq.read_schema(parts[0]).names
+  columns = [column for column in columns if column not in set(exclude)]
+  return pd.read_parquet(parts, columns=columns)
+
+
+def iter_table(
+    path: str,
+    columns: list[str] | None = None,
+    batch_size: int = 1000
+) -> Iterator[pa.RecordBatch]:
+  '''
+  Reads a table from the store in record batches, in id order, holding one batch in memory at a
+  time.
+
+  Rows stored again by a run that stopped before recording its sync state are skipped.
+
+  :param path: The path of the table folder.
+  :type path: str
+
+  :param columns: The columns to read. Defaults to every column.
+  :type columns: list[str] | None
+
+  :param batch_size: The maximum number of rows per batch. Defaults to 1000.
+  :type batch_size: int
+
+  :return: An iterator over the record batches.
+  :rtype: Iterator[pa.RecordBatch]
+  '''
+  last_id = None
+  for part in list_parts(path):
+    parquet = pq.ParquetFile(part)
+    names = columns if columns is not None else parquet.schema_arrow.names
+    for batch in parquet.iter_batches(batch_size=batch_size, columns=list({*names, 'id'})):
+      if last_id is not None:
+        # each file is in id order and holds the rows added after the previous files
+        batch = batch.filter(pc.greater(batch.column('id'), last_id))
+      if batch.num_rows:
+        last_id = batch.column('id')[-1].as_py()
+        yield batch.select(names)
+
+
+def read_sync_state(folder: str) -> dict:
+  '''
+  Reads the sync state of the store.
+
+  :param folder: The folder of the store.
+  :type folder: str
+
+  :return: A dictionary mapping table names to dictionaries with the highest ``'id'`` and the
+    number of ``'rows'`` stored, and any other entry written by the caller.
+  :rtype: dict
+  '''
+  path = os.path.join(folder, SYNC_STATE_NAME)
+  if not os.path.exists(path):
+    return {}
+  with open(path, 'r', encoding='utf-8') as f:
+    return json.load(f)
+
+
+def write_sync_state(folder: str, state: dict) -> None:
+  '''
+  Writes the sync state, replacing the previous one atomically.
+
+  :param folder: The folder of the store.
+  :type folder: str
+
+  :param state: A dictionary mapping table names to dictionaries with the ``'id'`` and ``'rows'``.
+  :type state: dict
+  '''
+  def write(path: str) -> None:
+    with open(path, 'w', encoding='utf-8') as f:
+      json.dump(state, f, indent=2)
+
+  write_atomic(os.path.join(folder, SYNC_STATE_NAME), write)
+
+
+def write_atomic(path: str, write: Callable[[str], None]) -> None:
+  '''
+  Writes a file through a temporary file in the same folder, so readers never see a partial file.
+
+  :param path: The path of the file.
+  :type path: str
+
+  :param write: A function writing the content to the path it is given.
+  :type write: Callable[[str], None]
+  '''
+  fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.tmp-')
+  os.close(fd)
+  try:
+    write(tmp_path)
+    os.replace(tmp_path, path)
+  except BaseException:
+    os.remove(tmp_path)
+    raise
@@ -0,0 +1,119 @@
+"""
+benchmark.py
+
+This script compares the solvers of train.py on the data in the local store. For each key
+function it fits every solver on the same training split and prints the fit time and test
+accuracy side by side. The rows can be replicated with --scale to see how the fit time of each
+solver grows with the size of the dataset.
+"""
+
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import train_test_split
+
+from fetch_data import METADATA_COLUMNS, read_table
+from util import SOLVERS, make_estimator
+
+
+def benchmark_kf(
+    df: pd.DataFrame,
+    solvers: list[str],
+    scale: int = 1,
+    train_proportion: float = 0.8
+) -> list[dict]:
+  """
+  Fits each solver on the same split of a key function's data.
+
+  :param df: The features and label of the key function, the label last.
+  :type df: pd.DataFrame
+  :param solvers: The solvers to compare, see :func:`util.make_estimator`.
+  :type solvers: list[str]
+  :param scale: The number of times each row is repeated (default is 1).
+  :type scale: int
+  :param train_proportion: The proportion of the data to use for training (default is 0.8).
+  :type train_proportion: float
+  :return: A list with the ``'solver'``, ``'estimator'``, ``'rows'``, ``'fit_time'`` and
+    ``'accuracy'`` of each solver.
+  :rtype: list[dict]
+  """
+  df = df.dropna()
+  x = np.tile(df.iloc[:, :-1].to_numpy(dtype=np.float64), (scale, 1))
+  y = np.tile(df.iloc[:, -1].to_numpy(), scale)
+
+  x_train, x_test, y_train, y_test = train_test_split(
+      x, y, train_size=train_proportion, stratify=y, random_state=42)
+
+  results = []
+  for solver in solvers:
+    model = make_estimator(solver, len(x_train))
+    start = time.perf_counter()
+    model.fit(x_train, y_train)
+    fit_time = time.perf_counter() - start
+    results.append({'solver': solver, 'estimator': type(model).__name__, 'rows': len(x_train),
+                    'fit_time': fit_time, 'accuracy': model.score(x_test, y_test)})
+  return results
+
+
+def main(args: argparse.Namespace) -> None:
+  """
+  Benchmarks the solvers on every key function in the local store.
+  """
+  folders = sorted(glob.glob('data/mcq_kf*/'))
+  if args.kf:
+    folders = [f for f in folders if os.path.basename(os.path.normpath(f)) in args.kf]
+  if not folders:
+    print("No data found in the 'data' directory. Run train.py to fetch it first.")
+    return
+
+  print(f"{'Key function':14} {'Rows':>8} {'Solver':8} {'Estimator':14} {'Fit (s)':>9} "
+        f"{'Accuracy':>9}")
+
+  totals = {solver: [0.0, []] for solver in args.solvers}
+  for folder in folders:
+    kf = os.path.basename(os.path.normpath(folder))
+    df = read_table(folder, exclude=METADATA_COLUMNS)
+    if len(df) < args.length_threshold:
+      continue
+
+    try:
+      results = benchmark_kf(df, args.solvers, scale=args.scale,
+                             train_proportion=args.train_proportion)
+    except ValueError as e:
+      print(f"{kf:14} skipped: {e}")
+      continue
+
+    for result in results:
+      print(f"{kf:14} {result['rows']:8} {result['solver']:8} {result['estimator']:14} "
+            f"{result['fit_time']:9.3f} {result['accuracy'] * 100:8.2f}%")
+      totals[result['solver']][0] += result['fit_time']
+      totals[result['solver']][1].append(result['accuracy'])
+
+  print()
+  for solver, (fit_time, accuracies) in totals.items():
+    if accuracies:
+      print(f"{solver:8} total fit {fit_time:9.3f}s, "
+            f"mean accuracy {np.mean(accuracies) * 100:6.2f}%")
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+      description="Compare the fit time and accuracy of the SVM solvers on the local data.")
+
+  parser.add_argument('--kf', nargs='+', default=None,
+                      help="Only benchmark these tables, e.g. mcq_kf1_1 (default: all).")
+  parser.add_argument('--length-threshold', type=int, default=20,
+                      help="Minimum number of rows required to benchmark a table (default: 20).")
+  parser.add_argument('--scale', type=int, default=1,
+                      help="Number of times to repeat each row, to simulate more data "
+                           "(default: 1).")
+  parser.add_argument('--solvers', nargs='+', choices=SOLVERS[1:], default=list(SOLVERS[1:]),
+                      help="Solvers to compare (default: svc linear sgd).")
+  parser.add_argument('--train-proportion', type=float, default=0.8,
+                      help="Proportion of data to use for training (default: 0.8).")
+
+  main(parser.parse_args())
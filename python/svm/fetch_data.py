@@ -1,8 +1,23 @@
 """
 fetch_data.py
 
-This script fetches data from a Supabase database and exports it to CSV files.
+This script fetches data from a Supabase database and stores it in a local Parquet store.
 It uses the Supabase client to connect to the database and retrieve data from specified tables.
+Each table is read in pages ordered by id, with a keyset cursor on the last id of the previous
+page, so tables larger than the PostgREST row limit are fetched in full. Pages are written to the
+store as they arrive and several tables are fetched at once.
+
+Each table is stored as a folder "data/<table>" of Parquet files with compact column types:
+booleans for the MCQ features and an 8-bit integer for the development level. The store is the
+one of python/parquet_store.py, which the BERT scripts also use. Read the tables back with
+:func:`parquet_store.read_table`, selecting only the columns needed.
+
+The highest id fetched from each table is recorded in "data/.sync-state.json", and later runs only
+fetch the rows added after it and add them to the table folder as a new Parquet file. A table
+whose new rows have a column the stored files do not is downloaded again in full. Rows are
+assumed to be immutable once inserted; pass ``full_refresh=True`` (``--full-refresh`` in
+train.py) to download every table again after rows were edited or deleted.
+
 The script requires the following environment variables to be set:
 - SUPABASE_URL: The URL of the Supabase database.
 - SUPABASE_SERVICE_ROLE_KEY: The service role key for accessing the Supabase database.
@@ -11,21 +26,49 @@ Dependencies:
 - dotenv
 - os
 - pandas
+- pyarrow
 - re
 - supabase
 """
 
 import os
 import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
 
-import pandas as pd
+import pyarrow as pa
 from dotenv import load_dotenv
 from supabase import Client, create_client
 
+# the Parquet store is shared with the BERT scripts, see python/parquet_store.py
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# pylint: disable=wrong-import-position,import-error,unused-import
+from parquet_store import (METADATA_COLUMNS, SchemaChangedError, append_part, read_sync_state,
+                           read_table, replace_table, write_sync_state)
+# pylint: enable=wrong-import-position,import-error,unused-import
+
+
+PAGE_SIZE = 1000
 
-def fetch_data() -> None:
+
+def fetch_data(
+    max_workers: int = 4,
+    page_size: int = PAGE_SIZE,
+    full_refresh: bool = False
+) -> None:
   """
-  Main function to fetch data from Supabase and export it to CSV files.
+  Main function to fetch data from Supabase and store it in the local Parquet store.
+
+  :param max_workers: The maximum number of tables fetched at once.
+  :type max_workers: int
+
+  :param page_size: The number of rows fetched per request.
+  :type page_size: int
+
+  :param full_refresh: If True, ignore the sync state and download every table again.
+  :type full_refresh: bool
 
   :raises ValueError: If the required environment variables are not set.
   """
@@ -58,14 +101,127 @@ def fetch_data() -> None:
   kf_descriptions = response.data["kf_descriptions"]
   table_names = ['mcq_kf' + re.sub(r'\.', '_', kf) for kf in [*kf_descriptions.keys()]]
 
-  for table in table_names:
-    data = query_supabase(supabase, table)
-    print(f"Fetched {len(data)} rows from table {table}")
-    df = pd.DataFrame(data)
-    df.to_csv(f"{folder}/{table}.csv", index=False)
+  state = {} if full_refresh else read_sync_state(folder)
+  state_lock = threading.Lock()
+  errors = []
+
+  def sync_table(table: str, path: str, after: int | None) -> tuple[int, int]:
+    try:
+      rows, last_id = export_table(supabase, table, path, page_size, after)
+    except SchemaChangedError as e:
+      print(f"{e}, fetching table {table} again")
+      after = None
+      rows, last_id = export_table(supabase, table, path, page_size)
+    # record each table as soon as it is stored, so an interrupted run never fetches it twice
+    with state_lock:
+      total = rows + (state[table]['rows'] if after is not None else 0)
+      state[table] = {'id': last_id, 'rows': total}
+      write_sync_state(folder, state)
+    return rows, total
+
+  with ThreadPoolExecutor(max_workers=max_workers) as pool:
+    futures = {}
+    for table in table_names:
+      path = f"{folder}/{table}"
+      # a table whose folder has gone missing is fetched again from the start
+      after = state[table]['id'] if table in state and os.path.isdir(path) else None
+      futures[table] = pool.submit(sync_table, table, path, after)
+
+    for table, future in futures.items():
+      try:
+        rows, total = future.result()
+      except Exception as e:  # pylint: disable=broad-exception-caught
+        errors.append(e)
+        print(f"Error fetching table {table}: {e}")
+        continue
+      print(f"Fetched {rows} new rows from table {table} ({total} total)")
+
+  if errors:
+    raise errors[0]
+
+
+def export_table(
+    supabase: Client,
+    table: str,
+    path: str,
+    page_size: int = PAGE_SIZE,
+    after: int | None = None
+) -> tuple[int, int | None]:
+  """
+  Streams the rows of a table into a Parquet file in the table folder, one page per row group.
+
+  :param supabase: The Supabase client object.
+  :type supabase: Client
+
+  :param table: The name of the table in the \"trainingdata\" schema.
+  :type table: str
+
+  :param path: The path of the table folder.
+  :type path: str
+
+  :param page_size: The number of rows fetched per request.
+  :type page_size: int
 
+  :param after:
+    If set, only rows with a greater id are fetched and added to the existing folder at ``path``
+    as a new file. Otherwise the whole table is fetched into a new folder that replaces ``path``
+    once every page has been fetched.
+  :type after: int | None
 
-def query_supabase(supabase: Client, table: str) -> list:
+  :returns: The number of rows written and the highest id written, or ``after`` if no rows were.
+  :rtype: tuple[int, int | None]
+
+  :raises SchemaChangedError: If ``after`` is set and the new rows have a column that the stored
+    files do not.
+  """
+  pages = (pa.Table.from_pylist(page) for page in iter_pages(supabase, table, page_size, after))
+
+  if after is not None:
+    rows, last_id = append_part(path, pages)
+    return rows, last_id if rows else after
+  return replace_table(path, pages)
+
+
+def iter_pages(
+    supabase: Client,
+    table: str,
+    page_size: int = PAGE_SIZE,
+    after: int | None = None
+) -> Iterator[list]:
+  """
+  Yields the rows of a table in pages ordered by id, using the last id of each page as the cursor
+  for the next one. Pages are fetched until one comes back empty, so that no rows are lost when
+  ``page_size`` is above the row limit of the server (the PostgREST ``max-rows``, 1000 by default).
+
+  :param supabase: The Supabase client object.
+  :type supabase: Client
+
+  :param table: The name of the table in the \"trainingdata\" schema.
+  :type table: str
+
+  :param page_size: The number of rows fetched per request.
+  :type page_size: int
+
+  :param after: If set, only rows with a greater id are fetched.
+  :type after: int | None
+
+  :returns: An iterator over lists of dictionaries, one per row.
+  :rtype: Iterator[list]
+  """
+  last_id = after
+  while True:
+    query = supabase.schema("trainingdata").table(table).select("*").order("id").limit(page_size)
+    if last_id is not None:
+      query = query.gt("id", last_id)
+    page = query.execute().data
+    # a short page does not end the table, since the server caps pages at its own row limit
+    if not page:
+      return
+    yield page
+    last_id = page[-1]["id"]
+
+
+def query_supabase(supabase: Client, table: str, page_size: int = PAGE_SIZE) -> list:
   """
   Fetches all data from a specified table in the Supabase database.
 
@@ -77,8 +233,10 @@ def query_supabase(supabase: Client, table: str) -> list:
     schema.
   :type table: str
 
+  :param page_size: The number of rows fetched per request.
+  :type page_size: int
+
   :returns: A list of dictionaries containing the data from the specified table.
   :rtype: list
   """
-  response = supabase.schema("trainingdata").table(table).select("*").execute()
-  return response.data
+  return [row for page in iter_pages(supabase, table, page_size) for row in page]
@@ -0,0 +1,249 @@
+"""
+search.py
+
+Hyperparameter search for the SVM models. Each key function is evaluated with stratified k-fold
+cross-validation over a grid of C values and class weights, and the candidate with the highest
+mean accuracy is kept, ties going to the candidate that comes first in the grid.
+
+The cleaned feature arrays and the fold assignment of each key function are cached in
+"cache/folds", keyed by a fingerprint of its training data, so repeated searches on unchanged
+data skip the preprocessing. The folds of every candidate are evaluated in parallel when a
+process pool is given, and the search of a key function stops at its deadline, keeping the best
+candidate evaluated so far.
+"""
+
+import itertools
+import os
+import tempfile
+import time
+from concurrent.futures import Executor, TimeoutError as FutureTimeoutError
+
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import StratifiedKFold
+
+from util import SOLVER_THRESHOLD, frame_fingerprint, make_estimator, oversample_minority
+
+CACHE_DIR = os.path.join('cache', 'folds')
+GRID_C = (0.01, 0.1, 1.0, 10.0, 100.0)
+CLASS_WEIGHTS = (None, 'balanced')
+
+
+def prepare_folds(
+    kf: str,
+    df: pd.DataFrame,
+    n_splits: int = 5,
+    cache_dir: str | None = CACHE_DIR
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+  """
+  Returns the features and labels of a key function with the rows that have missing values
+  dropped, along with the test fold of every row, from the cache if possible.
+
+  :param kf: The key function, used to name the cache file.
+  :type kf: str
+  :param df: The features and label of the key function, the label last.
+  :type df: pd.DataFrame
+  :param n_splits: The number of folds (default is 5).
+  :type n_splits: int
+  :param cache_dir: The folder of the cache, or None to disable it (default is 'cache/folds').
+  :type cache_dir: str | None
+  :return: The features, the labels and the test fold of every row.
+  :rtype: tuple[np.ndarray, np.ndarray, np.ndarray]
+  """
+  path = None
+  if cache_dir is not None:
+    path = os.path.join(cache_dir, f"{kf}-{frame_fingerprint(df)}-k{n_splits}.npz")
+    if os.path.exists(path):
+      with np.load(path) as cached:
+        return cached['x'], cached['y'], cached['folds']
+
+  df = df.dropna()
+  x = df.iloc[:, :-1].to_numpy(dtype=np.float64)
+  y = df.iloc[:, -1].to_numpy()
+
+  folds = np.zeros(len(y), dtype=np.int8)
+  splitter = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=42)
+  for fold, (_, test_index) in enumerate(splitter.split(x, y)):
+    folds[test_index] = fold
+
+  if path is not None:
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.tmp-', suffix='.npz')
+    with os.fdopen(fd, 'wb') as f:
+      np.savez(f, x=x, y=y, folds=folds)
+    os.replace(tmp_path, path)
+
+  return x, y, folds
+
+
+def evaluate_fold(
+    x: np.ndarray,
+    y: np.ndarray,
+    folds: np.ndarray,
+    fold: int,
+    solver: str,
+    C: float,
+    class_weight: str | None,
+    oversample: bool = False,
+    solver_threshold: int = SOLVER_THRESHOLD
+) -> float:
+  """
+  Fits a candidate on every fold but one and returns its accuracy on the remaining fold.
+
+  :param x: The features.
+  :type x: np.ndarray
+  :param y: The labels.
+  :type y: np.ndarray
+  :param folds: The test fold of every row.
+  :type folds: np.ndarray
+  :param fold: The fold to test on.
+  :type fold: int
+  :param solver: The solver, see :func:`util.make_estimator`.
+  :type solver: str
+  :param C: The regularization parameter.
+  :type C: float
+  :param class_weight: The class weights, None or ``'balanced'``.
+  :type class_weight: str | None
+  :param oversample: If True, oversamples the minority classes of the training folds.
+  :type oversample: bool
+  :param solver_threshold: The number of rows above which ``'auto'`` picks ``'linear'``.
+  :type solver_threshold: int
+  :return: The accuracy on the test fold.
+  :rtype: float
+  """
+  x_train, y_train = x[folds != fold], y[folds != fold]
+  if oversample:
+    x_train, y_train = oversample_minority(x_train, y_train)
+
+  model = make_estimator(solver, len(x_train), solver_threshold, C=C, class_weight=class_weight)
+  model.fit(x_train, y_train)
+  return model.score(x[folds == fold], y[folds == fold])
+
+
+def search_kf(
+    kf: str,
+    df: pd.DataFrame,
+    solver: str = 'svc',
+    solver_threshold: int = SOLVER_THRESHOLD,
+    grid_c: tuple[float, ...] = GRID_C,
+    class_weights: tuple[str | None, ...] = CLASS_WEIGHTS,
+    n_splits: int = 5,
+    oversample: bool = False,
+    pool: Executor | None = None,
+    deadline: float | None = None,
+    cache_dir: str | None = CACHE_DIR
+) -> dict | None:
+  """
+  Searches the C values and class weights of a key function with stratified k-fold
+  cross-validation.
+
+  :param kf: The key function.
+  :type kf: str
+  :param df: The features and label of the key function, the label last.
+  :type df: pd.DataFrame
+  :param solver: The solver, see :func:`util.make_estimator` (default is 'svc').
+  :type solver: str
+  :param solver_threshold: The number of rows above which ``'auto'`` picks ``'linear'``.
+  :type solver_threshold: int
+  :param grid_c: The C values to try (default is :data:`GRID_C`).
+  :type grid_c: tuple[float, ...]
+  :param class_weights: The class weights to try (default is :data:`CLASS_WEIGHTS`).
+  :type class_weights: tuple[str | None, ...]
+  :param n_splits: The number of folds (default is 5).
+  :type n_splits: int
+  :param oversample: If True, oversamples the minority classes of the training folds.
+  :type oversample: bool
+  :param pool: A process pool to evaluate the folds in, or None to evaluate them in turn.
+  :type pool: Executor | None
+  :param deadline: The ``time.monotonic()`` after which no more candidates are evaluated, or None.
+  :type deadline: float | None
+  :param cache_dir: The folder of the fold cache, or None to disable it (default is 'cache/folds').
+  :type cache_dir: str | None
+  :return: A dictionary with the ``'C'``, ``'class_weight'``, mean ``'cv_accuracy'`` and
+    ``'cv_std'`` of the best candidate, the number of candidates ``'evaluated'`` and in the
+    ``'grid'``, and the ``'time'`` taken; or None if no candidate could be evaluated.
+  :rtype: dict | None
+  """
+  start = time.monotonic()
+  x, y, folds = prepare_folds(kf, df, n_splits=n_splits, cache_dir=cache_dir)
+  candidates = list(itertools.product(grid_c, class_weights))
+
+  def evaluate(fold: int, C: float, class_weight: str | None):
+    args = (x, y, folds, fold, solver, C, class_weight, oversample, solver_threshold)
+    return pool.submit(evaluate_fold, *args) if pool is not None else evaluate_fold(*args)
+
+  # with a pool, every fold of every candidate is queued up front and the ones that have not
+  # started by the deadline are cancelled
+  pending = [[evaluate(fold, C, class_weight) for fold in range(n_splits)]
+             for C, class_weight in candidates] if pool is not None else None
+
+  scores = []
+  for i, (C, class_weight) in enumerate(candidates):
+    if pending is None:
+      if deadline is not None and time.monotonic() > deadline:
+        break
+      accuracies = [evaluate(fold, C, class_weight) for fold in range(n_splits)]
+    else:
+      try:
+        timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+        accuracies = [future.result(timeout=timeout) for future in pending[i]]
+      except FutureTimeoutError:
+        for future in itertools.chain.from_iterable(pending[i:]):
+          future.cancel()
+        break
+    scores.append((float(np.mean(accuracies)), float(np.std(accuracies)), C, class_weight))
+
+  if not scores:
+    return None
+
+  best = max(scores, key=lambda score: score[0])
+  return {'C': best[2], 'class_weight': best[3], 'cv_accuracy': best[0], 'cv_std': best[1],
+          'evaluated': len(scores), 'grid': len(candidates), 'time': time.monotonic() - start}
+
+
+def search_all(
+    data: dict[str, pd.DataFrame],
+    time_budget: float | None = None,
+    pool: Executor | None = None,
+    **options
+) -> dict[str, dict]:
+  """
+  Searches the hyperparameters of every key function and prints a summary table. The time budget
+  is shared out evenly between the key functions that have not been searched yet, so time left
+  over by a fast key function goes to the following ones.
+
+  :param data: A dictionary where keys are key functions and values are their training data.
+  :type data: dict[str, pd.DataFrame]
+  :param time_budget: The total time of the search in seconds, or None for no limit.
+  :type time_budget: float | None
+  :param pool: A process pool to evaluate the folds in, or None to evaluate them in turn.
+  :type pool: Executor | None
+  :param options: Keyword arguments passed to :func:`search_kf`.
+  :return: A dictionary with the result of :func:`search_kf` for each key function that could be
+    searched.
+  :rtype: dict[str, dict]
+  """
+  end = None if time_budget is None else time.monotonic() + time_budget
+
+  print(f"{'Key function':14} {'Rows':>6} {'C':>8} {'Class weight':>12} {'CV accuracy':>16} "
+        f"{'Evaluated':>9} {'Time (s)':>8}")
+
+  results = {}
+  for i, (kf, df) in enumerate(data.items()):
+    deadline = None
+    if end is not None:
+      deadline = time.monotonic() + (end - time.monotonic()) / (len(data) - i)
+    try:
+      result = search_kf(kf, df, pool=pool, deadline=deadline, **options)
+    except ValueError as e:
+      print(f"{kf:14} {len(df):6} skipped: {e}")
+      continue
+    if result is None:
+      print(f"{kf:14} {len(df):6} skipped: out of time")
+      continue
+
+    results[kf] = result
+    print(f"{kf:14} {len(df):6} {result['C']:8g} {str(result['class_weight']):>12} "
+          f"{result['cv_accuracy'] * 100:8.2f}% ±{result['cv_std'] * 100:5.2f} "
+          f"{result['evaluated']:>4}/{result['grid']:<4} {result['time']:8.2f}")
+  return results
@@ -2,15 +2,29 @@
 
 '''Test cases for the SVM folder.'''
 
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import struct
+import tempfile
 import unittest
-from unittest.mock import call, patch, MagicMock
+from concurrent.futures import ProcessPoolExecutor
+from unittest.mock import patch, MagicMock
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from postgrest.base_request_builder import SingleAPIResponse
-from sklearn.svm import SVC
+from sklearn.linear_model import SGDClassifier
+from sklearn.svm import SVC, LinearSVC
 
+import benchmark  # pylint: disable=import-error
 import fetch_data  # pylint: disable=import-error
+import search  # pylint: disable=import-error
 import train  # pylint: disable=import-error
 import util  # pylint: disable=import-error
 
@@ -87,10 +101,12 @@ class TestFetchData(unittest.TestCase):
   @patch("fetch_data.create_client")
   @patch("fetch_data.os.makedirs")
   @patch("fetch_data.os.environ.get")
-  @patch("fetch_data.query_supabase", return_value=[{"id": 1, "value": "test"}])
-  @patch("fetch_data.pd.DataFrame.to_csv")
+  @patch("fetch_data.export_table", return_value=(1, 1))
+  @patch("fetch_data.read_sync_state", return_value={})
+  @patch("fetch_data.write_sync_state")
   def test_fetch_data_success(
-          self, mock_to_csv, mock_query_supabase, mock_get, mock_makedirs, mock_create_client
+          self, mock_write_state, mock_read_state, mock_export_table, mock_get, mock_makedirs,
+          mock_create_client
   ):
     """Test fetch_data successfully fetches and saves data."""
 
@@ -106,21 +122,166 @@ class TestFetchData(unittest.TestCase):
     fetch_data.fetch_data()
 
     mock_create_client.assert_called_once_with("mock_url", "mock_key")
-    mock_to_csv.assert_called()
+    self.assertEqual(sorted(c.args[1:3] for c in mock_export_table.call_args_list),
+                     [("mcq_kf1_1", "data/mcq_kf1_1"), ("mcq_kf2_1", "data/mcq_kf2_1")])
+    self.assertEqual(mock_write_state.call_count, 2)
+    mock_write_state.assert_called_with("data", {"mcq_kf1_1": {"id": 1, "rows": 1},
+                                                 "mcq_kf2_1": {"id": 1, "rows": 1}})
 
   @patch("fetch_data.create_client")
-  def test_query_supabase(self, mock_create_client):
-    """Test query_supabase fetches data correctly."""
+  @patch("fetch_data.load_dotenv")
+  @patch("fetch_data.os.environ.get", side_effect=lambda key, default="": "dummy")
+  def test_fetch_data_delta_sync(self, mock_get, mock_dotenv, mock_create_client):
+    """Test a second fetch_data run only fetches and appends rows added since the first."""
 
-    mock_supabase = MagicMock()
+    rows = [{"id": i, "c1": i % 2 == 0} for i in range(1, 4)]
+    mock_supabase = self.mock_paged_supabase(rows)
+    mock_response = MagicMock(spec=SingleAPIResponse)
+    mock_response.data = {"kf_descriptions": {"1.1": "desc1"}}
+    mock_response.error = None
+    mock_supabase.schema.return_value.table.return_value.select.return_value.single.return_value \
+        .execute.return_value = mock_response
     mock_create_client.return_value = mock_supabase
+    builder = mock_supabase.schema.return_value.table.return_value.select.return_value
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+      os.chdir(folder)
+      try:
+        fetch_data.fetch_data(page_size=2)
+        # the short page is followed by an empty one that ends the table
+        self.assertEqual([c.args for c in builder.gt.call_args_list], [("id", 2), ("id", 3)])
+
+        rows.extend({"id": i, "c1": i % 2 == 0} for i in range(4, 6))
+        builder.gt.reset_mock()
+        fetch_data.fetch_data(page_size=2)
+        builder.gt.assert_any_call("id", 3)
+        pd.testing.assert_frame_equal(fetch_data.read_table("data/mcq_kf1_1"), pd.DataFrame(rows))
+        self.assertEqual(len(os.listdir("data/mcq_kf1_1")), 2)
+        self.assertEqual(fetch_data.read_sync_state("data"),
+                         {"mcq_kf1_1": {"id": 5, "rows": 5}})
+
+        builder.gt.reset_mock()
+        fetch_data.fetch_data(page_size=2, full_refresh=True)
+        self.assertEqual(builder.gt.call_args_list[0].args, ("id", 2))
+        pd.testing.assert_frame_equal(fetch_data.read_table("data/mcq_kf1_1"), pd.DataFrame(rows))
+        self.assertEqual(os.listdir("data/mcq_kf1_1"), ["part-00000.parquet"])
+      finally:
+        os.chdir(cwd)
 
+  @patch("fetch_data.create_client")
+  @patch("fetch_data.load_dotenv")
+  @patch("fetch_data.os.environ.get", side_effect=lambda key, default="": "dummy")
+  def test_fetch_data_new_column_refetches_table(self, mock_get, mock_dotenv, mock_create_client):
+    """Test a column added to a table after the first fetch downloads the table again."""
+
+    rows = [{"id": i, "c1": i % 2 == 0} for i in range(1, 4)]
+    mock_supabase = self.mock_paged_supabase(rows)
     mock_response = MagicMock(spec=SingleAPIResponse)
-    mock_response.data = [{"id": 1, "value": "test"}]
-    mock_supabase.schema().table().select().execute.return_value = mock_response
+    mock_response.data = {"kf_descriptions": {"1.1": "desc1"}}
+    mock_response.error = None
+    mock_supabase.schema.return_value.table.return_value.select.return_value.single.return_value \
+        .execute.return_value = mock_response
+    mock_create_client.return_value = mock_supabase
 
-    result = fetch_data.query_supabase(mock_supabase, "mock_table")
-    self.assertEqual(result, [{"id": 1, "value": "test"}])
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder, contextlib.redirect_stdout(io.StringIO()):
+      os.chdir(folder)
+      try:
+        fetch_data.fetch_data(page_size=2)
+
+        for row in rows:
+          row["c2"] = None
+        rows.extend({"id": i, "c1": True, "c2": False} for i in range(4, 6))
+        fetch_data.fetch_data(page_size=2)
+
+        pd.testing.assert_frame_equal(fetch_data.read_table("data/mcq_kf1_1"), pd.DataFrame(rows))
+        self.assertEqual(os.listdir("data/mcq_kf1_1"), ["part-00000.parquet"])
+        self.assertEqual(fetch_data.read_sync_state("data"), {"mcq_kf1_1": {"id": 5, "rows": 5}})
+      finally:
+        os.chdir(cwd)
+
+  @staticmethod
+  def mock_paged_supabase(rows, max_rows=None):
+    """Returns a mock Supabase client serving rows ordered by id with keyset pagination, with at
+    most ``max_rows`` rows per page like the row limit of PostgREST."""
+    query = {}
+    mock_supabase = MagicMock()
+    builder = mock_supabase.schema.return_value.table.return_value.select.return_value
+    builder.order.return_value = builder
+    builder.limit.side_effect = lambda size: query.update(
+        size=min(size, max_rows or size), after=None) or builder
+    builder.gt.side_effect = lambda column, value: query.update(after=value) or builder
+    builder.execute.side_effect = lambda: MagicMock(data=[
+        r for r in rows if query["after"] is None or r["id"] > query["after"]][:query["size"]])
+    return mock_supabase
+
+  def test_query_supabase(self):
+    """Test query_supabase fetches every page of a table."""
+
+    rows = [{"id": i, "value": f"v{i}"} for i in range(1, 8)]
+    mock_supabase = self.mock_paged_supabase(rows)
+
+    result = fetch_data.query_supabase(mock_supabase, "mock_table", page_size=3)
+    self.assertEqual(result, rows)
+    mock_supabase.schema.assert_called_with("trainingdata")
+
+  def test_iter_pages_exact_multiple(self):
+    """Test iter_pages stops after an empty page when the row count is a multiple of the size."""
+
+    rows = [{"id": i} for i in range(1, 7)]
+    pages = list(fetch_data.iter_pages(self.mock_paged_supabase(rows), "mock_table", page_size=3))
+    self.assertEqual(pages, [rows[:3], rows[3:]])
+
+  def test_iter_pages_above_server_limit(self):
+    """Test pages cut short by the row limit of the server do not end the table."""
+
+    rows = [{"id": i} for i in range(1, 8)]
+    pages = list(fetch_data.iter_pages(self.mock_paged_supabase(rows, max_rows=3), "mock_table",
+                                       page_size=5))
+    self.assertEqual(pages, [rows[:3], rows[3:6], rows[6:]])
+
+  def test_export_table_streams_pages(self):
+    """Test export_table writes every page to one Parquet file with compact column types."""
+
+    rows = [{"id": i, "c1_1": None if i == 1 else i % 2 == 0, "dev_level": i % 4,
+             "created_at": "2025-03-01T12:00:00+00:00", "user_id": None} for i in range(1, 6)]
+    with tempfile.TemporaryDirectory() as folder:
+      path = os.path.join(folder, "mock_table")
+      count, last_id = fetch_data.export_table(self.mock_paged_supabase(rows), "mock_table", path,
+                                               page_size=2)
+
+      self.assertEqual((count, last_id), (5, 5))
+      self.assertEqual(os.listdir(folder), ["mock_table"])
+      schema = pq.read_schema(os.path.join(path, "part-00000.parquet"))
+      self.assertEqual(schema.field("c1_1").type, pa.bool_())
+      self.assertEqual(schema.field("dev_level").type, pa.int8())
+      self.assertEqual(schema.field("user_id").type, pa.string())
+
+      df = fetch_data.read_table(path, exclude=fetch_data.METADATA_COLUMNS)
+      self.assertEqual(list(df.columns), ["c1_1", "dev_level"])
+      self.assertEqual(df["dev_level"].tolist(), [1, 2, 3, 0, 1])
+      self.assertEqual(df["c1_1"].tolist()[1:], [True, False, True, False])
+
+  def test_export_table_keeps_old_table_on_error(self):
+    """Test export_table leaves the previous table folder in place when a page fails."""
+
+    rows = [{"id": 1, "c1_1": True}]
+    with tempfile.TemporaryDirectory() as folder:
+      path = os.path.join(folder, "mock_table")
+      fetch_data.export_table(self.mock_paged_supabase(rows), "mock_table", path)
+
+      mock_supabase = MagicMock()
+      limited = mock_supabase.schema().table().select().order().limit()
+      limited.execute.side_effect = RuntimeError("Simulated error")
+      limited.gt().execute.side_effect = RuntimeError("Simulated error")
+      for after in [None, 1]:
+        with self.assertRaises(RuntimeError):
+          fetch_data.export_table(mock_supabase, "mock_table", path, after=after)
+
+      self.assertEqual(os.listdir(folder), ["mock_table"])
+      self.assertEqual(os.listdir(path), ["part-00000.parquet"])
+      pd.testing.assert_frame_equal(fetch_data.read_table(path), pd.DataFrame(rows))
 
 
 class TestUtil(unittest.TestCase):
@@ -137,30 +298,187 @@ class TestUtil(unittest.TestCase):
     util.log(False, "Test Message")
     mock_print.assert_not_called()
 
-  @patch("util.pickle.dump")
+  def test_serialize_model_bundle(self):
+    """Test serialize_model_bundle writes aligned raw arrays indexed by the header."""
+    x = np.array([[0, 1], [1, 0], [1, 1], [0, 0], [1, 1], [0, 1]])
+    models = {"mcq_kf1_2": SVC(kernel='linear').fit(x, [0, 1, 2, 0, 2, 1]),
+              "mcq_kf1_1": SVC(kernel='linear').fit(x, [0, 1, 1, 0, 1, 0]),
+              "mcq_kf2_1": LinearSVC().fit(x, [0, 1, 2, 0, 2, 1])}
+
+    bundle = util.serialize_model_bundle(models)
+
+    self.assertEqual(bundle[:8], util.BUNDLE_MAGIC)
+    version, header_length = struct.unpack_from('<II', bundle, 8)
+    self.assertEqual(version, util.BUNDLE_VERSION)
+    data_start = 16 + header_length
+    self.assertEqual(data_start % util.BUNDLE_ALIGNMENT, 0)
+
+    header = json.loads(bundle[16:data_start])
+    self.assertEqual(list(header['models']), ["mcq_kf1_1", "mcq_kf1_2", "mcq_kf2_1"])
+    self.assertEqual([entry['scheme'] for entry in header['models'].values()],
+                     ["ovo", "ovo", "ovr"])
+    for name, model in models.items():
+      for key, expected in [('coef', model.coef_), ('intercept', model.intercept_),
+                            ('classes', model.classes_)]:
+        entry = header['models'][name][key]
+        self.assertEqual(entry['offset'] % util.BUNDLE_ALIGNMENT, 0)
+        array = np.frombuffer(bundle, dtype=entry['dtype'], count=int(np.prod(entry['shape'])),
+                              offset=data_start + entry['offset']).reshape(entry['shape'])
+        np.testing.assert_array_equal(array, expected)
+
+  @patch("util.write_digest")
   @patch("builtins.open", new_callable=unittest.mock.mock_open)
   @patch("util.os.makedirs")
-  @patch("fetch_data.create_client")
-  def test_export_upload_model(
-      self, mock_create_client, mock_makedirs, mock_open, mock_pickle_dump
-  ):
-    """Test export_upload_model exports and uploads a model correctly."""
+  def test_export_upload_bundle(self, mock_makedirs, mock_open, mock_write_digest):
+    """Test export_upload_bundle writes and uploads a single bundle file."""
 
     mock_supabase = MagicMock()
-    mock_create_client.return_value = mock_supabase
-
-    model = SVC()
+    model = SVC(kernel='linear').fit([[0, 1], [1, 0], [1, 1], [0, 0]], [0, 1, 1, 0])
 
-    util.export_upload_model(model, "test_kf", supabase=mock_supabase)
+    util.export_upload_bundle({"test_kf": model}, supabase=mock_supabase)
 
+    bundle = util.serialize_model_bundle({"test_kf": model})
     mock_makedirs.assert_called_once_with("models", exist_ok=True)
-    mock_open.assert_has_calls([
-        call("models/test_kf.pkl", 'wb'),
-        call("models/test_kf.pkl", 'rb')
-    ], any_order=True)
-    mock_pickle_dump.assert_called_once()
+    mock_open.assert_called_once_with(f"models/{util.BUNDLE_NAME}", 'wb')
+    mock_open().write.assert_called_once_with(bundle)
     mock_supabase.storage.from_.assert_called_once_with("svm-models")
-    mock_supabase.storage.from_().update.assert_called_once()
+    mock_supabase.storage.from_().upload.assert_called_once_with(
+        util.BUNDLE_NAME, bundle, {'upsert': 'true'})
+    mock_write_digest.assert_called_once_with(f"models/{util.BUNDLE_NAME}",
+                                              hashlib.sha256(bundle).hexdigest())
+
+  def test_export_upload_bundle_skips_unchanged(self):
+    """Test a bundle is only written and uploaded again when its bytes change."""
+    mock_supabase = MagicMock()
+    model = SVC(kernel='linear').fit([[0, 1], [1, 0], [1, 1], [0, 0]], [0, 1, 1, 0])
+    other = SVC(kernel='linear').fit([[0, 1], [1, 0], [1, 1], [0, 0]], [0, 1, 0, 1])
+
+    with tempfile.TemporaryDirectory() as folder, contextlib.redirect_stdout(io.StringIO()):
+      util.export_upload_bundle({"kf": model}, foldername=folder, supabase=mock_supabase)
+      util.export_upload_bundle({"kf": model}, foldername=folder, supabase=mock_supabase)
+      self.assertEqual(mock_supabase.storage.from_().upload.call_count, 1)
+
+      with util.Uploader(mock_supabase) as uploader:
+        util.export_upload_bundle({"kf": other}, foldername=folder, uploader=uploader)
+      util.export_upload_bundle({"kf": other}, foldername=folder, supabase=mock_supabase)
+      self.assertEqual(mock_supabase.storage.from_().upload.call_count, 2)
+
+  def test_export_upload_bundle_requires_models(self):
+    """Test export_upload_bundle refuses to export an empty bundle."""
+    with patch("util.os.makedirs"):
+      with self.assertRaises(ValueError):
+        util.export_upload_bundle({}, supabase=MagicMock())
+
+  def test_uploader_uploads_files(self):
+    """Test the uploader uploads each file to its bucket."""
+    mock_supabase = MagicMock()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+      with util.Uploader(mock_supabase, bucketname="bucket") as uploader:
+        uploader.upload("a", b"1")
+        uploader.upload("b", b"2")
+
+    mock_supabase.storage.from_.assert_called_with("bucket")
+    self.assertEqual([c.args for c in mock_supabase.storage.from_().upload.call_args_list],
+                     [("a", b"1", {'upsert': 'true'}), ("b", b"2", {'upsert': 'true'})])
+
+  def test_uploader_raises_upload_error(self):
+    """Test a failed upload raises its error once the retries are exhausted."""
+    mock_supabase = MagicMock()
+    mock_supabase.storage.from_().upload.side_effect = RuntimeError("Simulated error")
+
+    uploader = util.Uploader(mock_supabase, retries=2)
+    with patch("util.time.sleep") as mock_sleep, contextlib.redirect_stdout(io.StringIO()):
+      with self.assertRaises(RuntimeError):
+        uploader.upload("a", b"1")
+    self.assertEqual(mock_supabase.storage.from_().upload.call_count, 3)
+    self.assertEqual([c.args[0] for c in mock_sleep.call_args_list], [1.0, 2.0])
+
+  def test_uploader_retries_and_writes_manifest(self):
+    """Test a failed upload is retried and the manifest lists the hash of each file uploaded."""
+    mock_supabase = MagicMock()
+    upload = mock_supabase.storage.from_().upload
+    upload.side_effect = [RuntimeError("Simulated error"), None, None, None]
+    mock_supabase.storage.from_().download.return_value = json.dumps({"objects": {
+        "a": {"size": 5, "sha256": "old"}, "c": {"size": 3, "sha256": "kept"}}}).encode()
+
+    with patch("util.time.sleep"), contextlib.redirect_stdout(io.StringIO()):
+      with util.Uploader(mock_supabase, manifest="manifest.json") as uploader:
+        uploader.upload("a", b"1")
+        uploader.upload("b", b"22")
+
+    name, data, _ = upload.call_args_list[-1].args
+    self.assertEqual(name, "manifest.json")
+    self.assertEqual(json.loads(data), {"objects": {
+        "a": {"size": 1, "sha256": hashlib.sha256(b"1").hexdigest()},
+        "b": {"size": 2, "sha256": hashlib.sha256(b"22").hexdigest()},
+        "c": {"size": 3, "sha256": "kept"},
+    }})
+    self.assertEqual(upload.call_count, 4)
+
+  def test_uploader_skips_manifest_after_failed_upload(self):
+    """Test the manifest is neither read nor replaced when an upload failed."""
+    mock_supabase = MagicMock()
+    upload = mock_supabase.storage.from_().upload
+
+    def put(name, *_):
+      if name != "a":
+        raise RuntimeError("Simulated error")
+    upload.side_effect = put
+
+    with contextlib.redirect_stdout(io.StringIO()):
+      with self.assertRaises(RuntimeError):
+        with util.Uploader(mock_supabase, retries=0, manifest="manifest.json") as uploader:
+          uploader.upload("a", b"1")
+          uploader.upload("b", b"2")
+
+      # a failure the caller recovered from still leaves the manifest as it is
+      with util.Uploader(mock_supabase, retries=0, manifest="manifest.json") as uploader:
+        uploader.upload("a", b"1")
+        with self.assertRaises(RuntimeError):
+          uploader.upload("b", b"2")
+
+    self.assertNotIn("manifest.json", [c.args[0] for c in upload.call_args_list])
+    mock_supabase.storage.from_().download.assert_not_called()
+
+  def test_uploader_retries_transient_errors_only(self):
+    """Test client errors such as a rejected key are not retried, unlike server errors."""
+    def storage_error(status):
+      error = RuntimeError(f"Simulated {status} error")
+      error.status = status
+      return error
+
+    self.assertTrue(util.is_transient_error(RuntimeError("Connection reset")))
+    self.assertTrue(util.is_transient_error(storage_error("503")))
+    self.assertTrue(util.is_transient_error(storage_error(429)))
+    self.assertFalse(util.is_transient_error(storage_error(403)))
+
+    mock_supabase = MagicMock()
+    mock_supabase.storage.from_().upload.side_effect = storage_error(403)
+    uploader = util.Uploader(mock_supabase, retries=3)
+    with patch("util.time.sleep") as mock_sleep:
+      with self.assertRaises(RuntimeError):
+        uploader.upload("a", b"1")
+    self.assertEqual(mock_supabase.storage.from_().upload.call_count, 1)
+    mock_sleep.assert_not_called()
+
+  @patch("util.write_digest")
+  @patch("builtins.open", new_callable=unittest.mock.mock_open)
+  @patch("util.os.makedirs")
+  def test_export_upload_bundle_with_uploader(self, mock_makedirs, mock_file, mock_write_digest):
+    """Test export_upload_bundle uploads the bundle with the uploader."""
+    uploader = MagicMock(bucketname="svm-models")
+    model = SVC(kernel='linear').fit([[0, 1], [1, 0], [1, 1], [0, 0]], [0, 1, 1, 0])
+
+    util.export_upload_bundle({"test_kf": model}, uploader=uploader)
+
+    bundle = util.serialize_model_bundle({"test_kf": model})
+    uploader.upload.assert_called_once_with(util.BUNDLE_NAME, bundle)
+    mock_write_digest.assert_called_once_with(f"models/{util.BUNDLE_NAME}",
+                                              hashlib.sha256(bundle).hexdigest())
+
+    with self.assertRaises(ValueError):
+      util.export_upload_bundle({"test_kf": model}, bucketname="other", uploader=uploader)
 
 
 class TestTrainSVM(unittest.TestCase):
@@ -196,6 +514,232 @@ class TestTrainSVM(unittest.TestCase):
     self.assertIsInstance(accuracy, float)
     self.assertIsInstance(model, SVC)
 
+  def test_train_svm_linear_solver(self):
+    """Test SVM training with the liblinear solver."""
+    accuracy, model = train.train_svm("linear_kf", self.df, solver='linear')
+    self.assertIsInstance(accuracy, float)
+    self.assertIsInstance(model, LinearSVC)
+
+  def test_make_estimator(self):
+    """Test the solvers and the row threshold of the 'auto' solver."""
+    self.assertIsInstance(train.make_estimator('svc', 10**6), SVC)
+    self.assertIsInstance(train.make_estimator('sgd', 10), SGDClassifier)
+    self.assertIsInstance(train.make_estimator('auto', 100, solver_threshold=100), SVC)
+    self.assertIsInstance(train.make_estimator('auto', 101, solver_threshold=100), LinearSVC)
+    with self.assertRaises(ValueError):
+      train.make_estimator('unknown', 10)
+
+  def test_benchmark_kf(self):
+    """Test the benchmark fits every solver on the same split."""
+    results = benchmark.benchmark_kf(self.df, ['svc', 'linear', 'sgd'], scale=2)
+    self.assertEqual([r['estimator'] for r in results], ['SVC', 'LinearSVC', 'SGDClassifier'])
+    for result in results:
+      self.assertEqual(result['rows'], 40)
+      self.assertGreaterEqual(result['fit_time'], 0)
+      self.assertTrue(0 <= result['accuracy'] <= 1)
+
+  def test_train_all_parallel_matches_sequential(self):
+    """Test training in a process pool returns the same results, in order, as sequentially."""
+    data = {"kf_b": self.df, "kf_short": self.df.head(5), "kf_a": self.df.iloc[::-1]}
+
+    sequential = train.train_all(data, jobs=1)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+      parallel = train.train_all(data, jobs=2)
+
+    self.assertEqual(list(parallel), ["kf_b", "kf_short", "kf_a"])
+    for kf, (accuracy, model) in sequential.items():
+      self.assertEqual(parallel[kf][0], accuracy)
+      if model is None:
+        self.assertIsNone(parallel[kf][1])
+      else:
+        np.testing.assert_array_equal(parallel[kf][1].coef_, model.coef_)
+    lines = output.getvalue().splitlines()
+    self.assertEqual([line.split()[2] for line in lines], ["kf_b", "kf_short", "kf_a"])
+
+
+class TestTrainChanged(unittest.TestCase):
+  '''Test cases for skipping unchanged key functions in train module.'''
+
+  def setUp(self):
+    self.df = pd.DataFrame({  # pylint: disable=attribute-defined-outside-init
+        'feature1': np.random.rand(25),
+        'feature2': np.random.rand(25),
+        'label': [0, 1] * 12 + [0]
+    })
+
+  def test_train_changed_only_retrains_changed(self):
+    """Test a key function is trained again only when its data or hyperparameters change."""
+    data = {"kf_a": self.df, "kf_b": self.df.iloc[::-1], "kf_short": self.df.head(5)}
+    with tempfile.TemporaryDirectory() as folder, contextlib.redirect_stdout(io.StringIO()):
+      first = train.train_changed(data, foldername=folder)
+
+      with patch("train.train_svm", wraps=train.train_svm) as mock_train:
+        second = train.train_changed(data, foldername=folder, verbose=True)
+      mock_train.assert_not_called()
+      self.assertEqual(list(second), ["kf_a", "kf_b", "kf_short"])
+      self.assertEqual(second["kf_a"][0], first["kf_a"][0])
+      np.testing.assert_array_equal(second["kf_a"][1].coef_, first["kf_a"][1].coef_)
+      self.assertEqual(second["kf_short"], (None, None))
+
+      changed = {**data, "kf_b": self.df.head(24)}
+      with patch("train.train_svm", wraps=train.train_svm) as mock_train:
+        train.train_changed(changed, foldername=folder, params={"kf_a": {"C": 10.0}})
+      self.assertEqual(sorted(c.args[0] for c in mock_train.call_args_list), ["kf_a", "kf_b"])
+
+      with patch("train.train_svm", wraps=train.train_svm) as mock_train:
+        train.train_changed(data, foldername=folder, force=True)
+      self.assertEqual(mock_train.call_count, 3)
+
+  def test_search_changed_reuses_saved_configs(self):
+    """Test only key functions whose data changed are searched, the others reusing their config."""
+    def search_all(data, **_):
+      return {kf: {'C': float(len(df)), 'class_weight': None} for kf, df in data.items()}
+
+    data = {"kf_a": self.df, "kf_b": self.df.iloc[::-1]}
+    with tempfile.TemporaryDirectory() as folder, contextlib.redirect_stdout(io.StringIO()):
+      with patch("train.search_all", side_effect=search_all) as mock_search:
+        first = train.search_changed(data, foldername=folder, solver='svc')
+        second = train.search_changed(data, foldername=folder, solver='svc')
+      self.assertEqual(mock_search.call_count, 1)
+      self.assertEqual(first, second)
+      self.assertEqual(first["kf_a"], {'C': 25.0, 'class_weight': None})
+
+      changed = {**data, "kf_b": self.df.head(24)}
+      with patch("train.search_all", side_effect=search_all) as mock_search:
+        third = train.search_changed(changed, foldername=folder, solver='svc')
+      self.assertEqual(list(mock_search.call_args.args[0]), ["kf_b"])
+      self.assertEqual(third["kf_b"], {'C': 24.0, 'class_weight': None})
+
+      # a key function whose search ran out of time keeps its saved config
+      with patch("train.search_all", return_value={}) as mock_search:
+        fourth = train.search_changed(data, foldername=folder, solver='linear')
+      self.assertEqual(list(mock_search.call_args.args[0]), ["kf_a", "kf_b"])
+      self.assertEqual(fourth, third)
+
+
+class TestSearch(unittest.TestCase):
+  '''Test cases for the hyperparameter search in search module.'''
+
+  def setUp(self):
+    rng = np.random.default_rng(0)
+    x = rng.random((60, 2))
+    self.df = pd.DataFrame({  # pylint: disable=attribute-defined-outside-init
+        'feature1': x[:, 0],
+        'feature2': x[:, 1],
+        'label': (x[:, 0] > 0.5).astype(int)
+    })
+
+  def test_prepare_folds_cached(self):
+    """Test the folds are stratified, cached, and recomputed when the data changes."""
+    with tempfile.TemporaryDirectory() as cache_dir:
+      x, y, folds = search.prepare_folds("kf", self.df, n_splits=3, cache_dir=cache_dir)
+      self.assertEqual(x.shape, (60, 2))
+      self.assertEqual(sorted(np.bincount(folds)), [20, 20, 20])
+      self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+      with patch("search.StratifiedKFold") as mock_splitter:
+        _, _, cached = search.prepare_folds("kf", self.df, n_splits=3, cache_dir=cache_dir)
+      mock_splitter.assert_not_called()
+      np.testing.assert_array_equal(cached, folds)
+
+      changed = self.df.copy()
+      changed.loc[0, 'feature1'] = 2.0
+      search.prepare_folds("kf", changed, n_splits=3, cache_dir=cache_dir)
+      self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+  def test_search_kf_picks_best(self):
+    """Test the search keeps the best candidate, sequentially or in a pool."""
+    options = {'grid_c': (0.0001, 100.0), 'class_weights': (None,), 'n_splits': 3,
+               'cache_dir': None}
+    result = search.search_kf("kf", self.df, **options)
+    self.assertEqual(result['C'], 100.0)
+    self.assertEqual(result['evaluated'], 2)
+
+    with ProcessPoolExecutor(max_workers=2) as pool:
+      pooled = search.search_kf("kf", self.df, pool=pool, **options)
+    self.assertEqual(pooled['C'], result['C'])
+    self.assertAlmostEqual(pooled['cv_accuracy'], result['cv_accuracy'])
+
+  def test_search_kf_deadline(self):
+    """Test the search stops at its deadline."""
+    self.assertIsNone(search.search_kf("kf", self.df, cache_dir=None, deadline=0))
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+      results = search.search_all({"kf_a": self.df, "kf_b": self.df}, time_budget=0,
+                                  cache_dir=None)
+    self.assertEqual(results, {})
+    self.assertIn("out of time", output.getvalue())
+
+
+class TestIncremental(unittest.TestCase):
+  '''Test cases for the incremental update in train module.'''
+
+  def setUp(self):
+    rng = np.random.default_rng(0)
+    x = rng.random((200, 2))
+    self.df = pd.DataFrame({  # pylint: disable=attribute-defined-outside-init
+        'id': np.arange(1, 201),
+        'feature1': x[:, 0],
+        'feature2': x[:, 1],
+        'label': (x[:, 0] > 0.5).astype(int)
+    })
+
+  def update(self, folder, df, **options):
+    '''Runs update_all on one key function without printing.'''
+    with contextlib.redirect_stdout(io.StringIO()):
+      return train.update_all({"kf": df}, foldername=folder, **options)["kf"]
+
+  def test_holdout_mask_is_stable(self):
+    """Test a row stays held out as rows are added."""
+    mask = util.holdout_mask(np.arange(1000), 0.2)
+    self.assertTrue(0.15 < mask.mean() < 0.25)
+    np.testing.assert_array_equal(util.holdout_mask(np.arange(2000), 0.2)[:1000], mask)
+
+  def test_update_trains_new_rows_only(self):
+    """Test the saved model is only updated with the rows added since it was trained."""
+    with tempfile.TemporaryDirectory() as folder:
+      accuracy, model = self.update(folder, self.df.head(150))
+      self.assertIsInstance(model, SGDClassifier)
+      self.assertTrue(0 <= accuracy <= 1)
+      state = util.read_train_state(folder, incremental=True)
+      trained = (~util.holdout_mask(np.arange(1, 151), 0.2)).sum()
+      self.assertEqual(state, {"kf": {"id": 150, "rows": int(trained)}})
+      # the state and models of full training runs are left alone
+      self.assertEqual(util.read_train_state(folder), {})
+      self.assertIsNone(util.load_model(folder, "kf"))
+
+      with patch("train.make_estimator") as mock_make:
+        _, unchanged = self.update(folder, self.df.head(150))
+      mock_make.assert_not_called()
+      np.testing.assert_array_equal(unchanged.coef_, model.coef_)
+
+      with patch("train.make_estimator") as mock_make, \
+           patch.object(SGDClassifier, "partial_fit", autospec=True,
+                        side_effect=SGDClassifier.partial_fit) as mock_partial_fit:
+        _, updated = self.update(folder, self.df, max_accuracy_drop=1.0)
+      mock_make.assert_not_called()
+      new_ids = np.arange(151, 201)
+      new_ids = new_ids[~util.holdout_mask(new_ids, 0.2)]
+      self.assertEqual(len(mock_partial_fit.call_args.args[1]), len(new_ids))
+      self.assertEqual(util.read_train_state(folder, incremental=True)["kf"],
+                       {"id": 200, "rows": int(trained) + len(new_ids)})
+      np.testing.assert_array_equal(util.load_model(folder, "kf", incremental=True).coef_,
+                                    updated.coef_)
+      self.assertEqual(updated.alpha, 1 / (int(trained) + len(new_ids)))
+
+  def test_update_refits_on_new_class(self):
+    """Test the model is fitted again when the new rows have a new class."""
+    df = self.df.copy()
+    df.loc[df['id'] > 150, 'label'] = 2
+    with tempfile.TemporaryDirectory() as folder:
+      self.update(folder, df.head(150))
+      _, model = self.update(folder, df)
+      self.assertEqual(list(model.classes_), [0, 1, 2])
+      self.assertEqual(util.read_train_state(folder, incremental=True)["kf"]["rows"],
+                       int((~util.holdout_mask(np.arange(1, 201), 0.2)).sum()))
+
 
 class TestMainTrain(unittest.TestCase):
   '''Test cases for the main function in train module.'''
@@ -203,19 +747,23 @@ class TestMainTrain(unittest.TestCase):
   @patch("train.load_dotenv")
   @patch("train.create_client")
   @patch("train.fetch_data")
-  @patch("train.glob.glob", return_value=["data/mock.csv"])
-  @patch("train.pd.read_csv")
-  @patch("train.export_upload_model")
+  @patch("train.glob.glob", return_value=["data/mcq_kf1_1/"])
+  @patch("train.read_table")
+  @patch("train.export_upload_bundle")
   @patch("train.os.environ.get")
   @patch("train.os.path.exists", return_value=False)
   @patch("train.os.makedirs")
+  @patch("train.read_train_state", return_value={})
+  @patch("train.write_train_state")
+  @patch("train.save_model")
   def test_main_success(
-      self, mock_makedirs, mock_exists, mock_environ_get, mock_export,
-      mock_read_csv, mock_glob, mock_fetch, mock_create_client, mock_dotenv
+      self, mock_save_model, mock_write_state, mock_read_state, mock_makedirs, mock_exists,
+      mock_environ_get, mock_export, mock_read_table, mock_glob, mock_fetch, mock_create_client,
+      mock_dotenv
   ):
     """Test the main function in train module runs successfully."""
     mock_environ_get.side_effect = lambda key, default=None: "mock"  # Mock env vars
-    mock_read_csv.return_value = pd.DataFrame({
+    mock_read_table.return_value = pd.DataFrame({
         'feature1': np.random.rand(25),
         'feature2': np.random.rand(25),
         'label': [0, 1] * 12 + [0]
@@ -224,6 +772,16 @@ class TestMainTrain(unittest.TestCase):
     class Args:
       '''Mock command-line arguments for the main function.'''
       no_fetch = False
+      force = False
+      full_refresh = False
+      jobs = 1
+      incremental = False
+      max_accuracy_drop = 0.02
+      search = False
+      folds = 5
+      time_budget = None
+      solver = 'svc'
+      solver_threshold = 5000
       train_proportion = 0.8
       length_threshold = 20
       oversample = False
@@ -233,6 +791,35 @@ class TestMainTrain(unittest.TestCase):
 
     mock_fetch.assert_called_once()
     mock_export.assert_called_once()
+    mock_save_model.assert_called_once()
+
+  @patch("train.load_dotenv")
+  @patch("train.create_client")
+  @patch("train.Uploader")
+  @patch("train.glob.glob", return_value=["data/mcq_kf1_1/", "data/mcq_kf1_2/"])
+  @patch("train.read_table", return_value=pd.DataFrame({'feature1': [0.5], 'label': [1]}))
+  @patch("train.export_upload_bundle")
+  @patch("train.load_model", return_value="previous model")
+  @patch("train.train_changed")
+  @patch.dict(os.environ, {"SUPABASE_URL": "url", "SUPABASE_SERVICE_ROLE_KEY": "key"})
+  def test_main_keeps_previous_model_of_failed_kf(
+      self, mock_train_changed, mock_load_model, mock_export, *mocks
+  ):
+    """Test that a key function whose training failed keeps its previous model in the bundle."""
+    mock_train_changed.return_value = {'mcq_kf1_1': (None, None),
+                                       'mcq_kf1_2': (0.9, "new model")}
+    args = argparse.Namespace(no_fetch=True, incremental=False, search=False, force=False,
+                              jobs=1, train_proportion=0.8, length_threshold=20,
+                              oversample=False, verbose=False, solver='svc',
+                              solver_threshold=5000)
+
+    with tempfile.TemporaryDirectory() as folder, contextlib.chdir(folder), \
+         contextlib.redirect_stdout(io.StringIO()):
+      train.main(args)
+
+    mock_load_model.assert_called_once_with('models', 'mcq_kf1_1', incremental=False)
+    self.assertEqual(mock_export.call_args.kwargs['models'],
+                     {'mcq_kf1_1': "previous model", 'mcq_kf1_2': "new model"})
 
 
 if __name__ == "__main__":
@@ -2,24 +2,44 @@
 train.py
 
 This script trains a Support Vector Machine (SVM) model on the data in the data directory.
-It reads the data from CSV files, preprocesses it, and trains the model.
+It reads the data from the local Parquet store, preprocesses it, and trains the model.
 The trained model is then saved to a file in the models directory.
 The script also evaluates the model on a test set and prints the accuracy.
+
+With --incremental, the models are SGD classifiers saved as "models/<kf>.incremental.joblib" and
+each run only updates them with the rows added since they were last trained, tracked per key
+function in "models/.incremental-state.json", apart from the models and state of full training
+runs. Every update is validated on a fixed held-out set of rows, and a model whose accuracy drops
+by more than --max-accuracy-drop is fitted again on every training row.
+
+Otherwise, a fingerprint of the data and hyperparameters of each key function is recorded with its
+model, and only the key functions whose fingerprint changed are trained again; use --force to
+train every model. Likewise, --search only searches the key functions whose data changed since
+their config was written in "models/<kf>.config.json", and reuses that config for the others.
 """
 
 import argparse
+import contextlib
+import copy
 import glob
+import io
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 from dotenv import load_dotenv
-from imblearn.over_sampling import RandomOverSampler
+import numpy as np
 from sklearn import svm
+from sklearn.linear_model import SGDClassifier
 from sklearn.model_selection import train_test_split
 import pandas as pd
 from supabase import Client, create_client
 
-from fetch_data import fetch_data
-from util import export_upload_model, log, percent_bar
+from fetch_data import METADATA_COLUMNS, fetch_data, read_table
+from search import search_all
+from util import (MANIFEST_NAME, SOLVER_THRESHOLD, SOLVERS, Uploader, export_upload_bundle,
+                  frame_fingerprint, holdout_mask, load_model, log, make_estimator,
+                  oversample_minority, percent_bar, read_model_config, read_train_state,
+                  save_model, sgd_alpha, write_model_config, write_train_state)
 
 
 def main(args) -> None:
@@ -42,15 +62,17 @@ def main(args) -> None:
   supabase: Client = create_client(url, key)
 
   if not args.no_fetch:
-    fetch_data()
+    fetch_data(full_refresh=args.full_refresh)
 
   data = {}
 
-  for file in glob.glob('data/*.csv'):
-    table_name = file.split('/')[-1].removesuffix('.csv')
-    df = pd.read_csv(file)  # Read the CSV file into a DataFrame
-    # drop metadata columns
-    df = df.loc[:, ~df.columns.isin(['id', 'created_at', 'user_id'])]
+  # the incremental update needs the row ids to find the new rows
+  exclude = [c for c in METADATA_COLUMNS if c != 'id'] if args.incremental else METADATA_COLUMNS
+
+  for folder in sorted(glob.glob('data/mcq_kf*/')):
+    table_name = os.path.basename(os.path.normpath(folder))
+    # read the features and label only, leaving out the metadata columns
+    df = read_table(folder, exclude=exclude)
 
     data.update({table_name: df})
 
@@ -63,26 +85,62 @@ def main(args) -> None:
     os.makedirs('models')
 
   accuracies = {}
-
-  for kf, df in data.items():
-    if df.empty:
-      print(f"Skipping {kf} because it has no data.")
-      continue
-
-    accuracy, model = train_svm(kf, df,
-                                train_proportion=args.train_proportion,
-                                length_threshold=args.length_threshold,
-                                oversample=args.oversample,
-                                verbose=args.verbose)
+  models = {}
+
+  for kf in [kf for kf, df in data.items() if df.empty]:
+    print(f"Skipping {kf} because it has no data.")
+    del data[kf]
+
+  params = {}
+  if args.search:
+    params = search_changed({kf: df for kf, df in data.items() if len(df) >= args.length_threshold},
+                            foldername='models',
+                            force=args.force,
+                            jobs=args.jobs,
+                            time_budget=args.time_budget,
+                            solver=args.solver,
+                            solver_threshold=args.solver_threshold,
+                            n_splits=args.folds,
+                            oversample=args.oversample)
+
+  if args.incremental:
+    results = update_all(data,
+                         foldername='models',
+                         train_proportion=args.train_proportion,
+                         length_threshold=args.length_threshold,
+                         oversample=args.oversample,
+                         verbose=args.verbose,
+                         max_accuracy_drop=args.max_accuracy_drop)
+  else:
+    results = train_changed(data,
+                            foldername='models',
+                            force=args.force,
+                            jobs=args.jobs,
+                            params=params,
+                            train_proportion=args.train_proportion,
+                            length_threshold=args.length_threshold,
+                            oversample=args.oversample,
+                            verbose=args.verbose,
+                            solver=args.solver,
+                            solver_threshold=args.solver_threshold)
+  for kf, (accuracy, model) in results.items():
     if model is not None:
       accuracies[kf] = accuracy
-      # Save the trained model to a file
-      export_upload_model(
-          model=model,
-          kf=kf,
+      models[kf] = model
+    elif (model := load_model('models', kf, incremental=args.incremental)) is not None:
+      # keep the model of the last successful run in the bundle rather than dropping it
+      print(f"Keeping the previous model of {kf} in the bundle")
+      models[kf] = model
+
+  if models:
+    # Save the trained models to a single bundle file and upload it with the manifest. The bundle
+    # holds every model, so it is uploaded once training is done rather than alongside it.
+    with Uploader(supabase, bucketname='svm-models', manifest=MANIFEST_NAME) as uploader:
+      export_upload_bundle(
+          models=models,
           foldername='models',
           bucketname='svm-models',
-          supabase=supabase
+          uploader=uploader
       )
 
   if accuracies:
@@ -90,13 +148,181 @@ def main(args) -> None:
           f"{percent_bar(sum(accuracies.values()) / len(accuracies), 45)}")
 
 
+def search_changed(
+    data: dict[str, pd.DataFrame],
+    foldername: str = 'models',
+    force: bool = False,
+    jobs: int = 1,
+    time_budget: float | None = None,
+    **options
+) -> dict[str, dict]:
+  '''
+  Searches the hyperparameters of the key functions whose data or search options changed since
+  their config was written, and reuses the config of the others.
+
+  The fingerprint of the data and of the options of each key function is written in its config
+  with :func:`util.write_model_config`. A key function whose search does not finish, for example
+  when ``time_budget`` runs out, keeps its previous config, so that the hyperparameters it is
+  trained with, and the fingerprint of :func:`train_changed`, only change with a new search.
+
+  :param data: A dictionary where keys are key functions and values are their training data.
+  :type data: dict[str, pd.DataFrame]
+  :param foldername: The local folder of the models (default is 'models').
+  :type foldername: str
+  :param force: If True, searches every key function.
+  :type force: bool
+  :param jobs: The number of processes to evaluate the folds in (default is 1).
+  :type jobs: int
+  :param time_budget: The total time of the search in seconds, or None for no limit.
+  :type time_budget: float | None
+  :param options: Keyword arguments passed to :func:`search.search_all`.
+  :return: The ``C`` and ``class_weight`` of each key function that has a config, as the
+    ``params`` of :func:`train_changed`.
+  :rtype: dict[str, dict]
+  '''
+  fingerprints = {kf: frame_fingerprint(df, **options) for kf, df in data.items()}
+  configs = {kf: config for kf in data if (config := read_model_config(foldername, kf)) is not None}
+
+  changed = {}
+  for kf, df in data.items():
+    if force or configs.get(kf, {}).get('fingerprint') != fingerprints[kf]:
+      changed[kf] = df
+    else:
+      print(f"Skipping the search of {kf:10} because its data has not changed")
+
+  if changed:
+    with (ProcessPoolExecutor(max_workers=jobs) if jobs > 1
+          else contextlib.nullcontext()) as pool:
+      searched = search_all(changed, time_budget=time_budget, pool=pool, **options)
+    for kf, result in searched.items():
+      configs[kf] = {**options, **result, 'fingerprint': fingerprints[kf]}
+      write_model_config(foldername, kf, configs[kf])
+
+  return {kf: {'C': config['C'], 'class_weight': config['class_weight']}
+          for kf, config in configs.items()}
+
+
+def train_changed(
+    data: dict[str, pd.DataFrame],
+    foldername: str = 'models',
+    force: bool = False,
+    params: dict[str, dict] | None = None,
+    **options
+) -> dict[str, tuple[float, svm.SVC]]:
+  '''
+  Trains the key functions whose data or hyperparameters changed since their model was saved, and
+  loads the saved models of the others.
+
+  The fingerprint of the data and of the options of each key function is recorded with its
+  accuracy in the train state, and the models are saved with :func:`util.save_model`.
+
+  :param data: A dictionary where keys are key functions and values are their training data.
+  :type data: dict[str, pd.DataFrame]
+  :param foldername: The local folder of the models (default is 'models').
+  :type foldername: str
+  :param force: If True, trains every key function.
+  :type force: bool
+  :param params: Keyword arguments of :func:`train_svm` for some key functions, see
+    :func:`train_all`.
+  :type params: dict[str, dict] | None
+  :param options: Keyword arguments passed to :func:`train_all`.
+  :return: A dictionary with the accuracy and model of each key function, in the order of
+    ``data``.
+  :rtype: dict[str, tuple[float, svm.SVC]]
+  '''
+  params = params or {}
+  state = read_train_state(foldername)
+
+  fingerprints = {}
+  saved = {}
+  for kf, df in data.items():
+    # the verbosity and the number of processes do not change the model
+    hyperparameters = {k: v for k, v in options.items() if k not in ('verbose', 'jobs')}
+    fingerprints[kf] = frame_fingerprint(df, **{**hyperparameters, **params.get(kf, {})})
+    entry = state.get(kf, {})
+    if force or entry.get('fingerprint') != fingerprints[kf]:
+      continue
+    # a key function that was skipped for lack of rows has no model to load
+    model = load_model(foldername, kf) if entry['accuracy'] is not None else None
+    if entry['accuracy'] is None or model is not None:
+      print(f"Skipping {kf:10} because its data and hyperparameters have not changed")
+      saved[kf] = (entry['accuracy'], model)
+
+  trained = train_all({kf: df for kf, df in data.items() if kf not in saved},
+                      params=params, **options)
+
+  for kf, (accuracy, model) in trained.items():
+    if model is not None:
+      save_model(foldername, kf, model)
+    state[kf] = {'fingerprint': fingerprints[kf], 'accuracy': accuracy}
+  if trained:
+    write_train_state(foldername, state)
+
+  return {kf: saved[kf] if kf in saved else trained[kf] for kf in data}
+
+
+def train_all(
+    data: dict[str, pd.DataFrame],
+    jobs: int = 1,
+    params: dict[str, dict] | None = None,
+    **options
+) -> dict[str, tuple[float, svm.SVC]]:
+  '''
+  Trains a model for each key function, in a pool of ``jobs`` processes if ``jobs`` is above 1.
+  In a pool, the output of each key function is collected and printed once it is done, in the
+  order of ``data``.
+
+  :param data: A dictionary where keys are key functions and values are their training data.
+  :type data: dict[str, pd.DataFrame]
+  :param jobs: The number of processes to train in (default is 1).
+  :type jobs: int
+  :param params: Keyword arguments of :func:`train_svm` for some key functions, such as the
+    ``C`` and ``class_weight`` found by :func:`search.search_all`, overriding ``options``.
+  :type params: dict[str, dict] | None
+  :param options: Keyword arguments passed to :func:`train_svm`.
+  :return: A dictionary with the accuracy and model returned by :func:`train_svm` for each key
+    function, in the order of ``data``.
+  :rtype: dict[str, tuple[float, svm.SVC]]
+  '''
+  params = params or {}
+  if jobs <= 1:
+    return {kf: train_svm(kf, df, **{**options, **params.get(kf, {})}) for kf, df in data.items()}
+
+  results = {}
+  with ProcessPoolExecutor(max_workers=jobs) as pool:
+    futures = {kf: pool.submit(train_svm_captured, kf, df, **{**options, **params.get(kf, {})})
+               for kf, df in data.items()}
+    for kf, future in futures.items():
+      accuracy, model, output = future.result()
+      print(output, end="")
+      results[kf] = (accuracy, model)
+  return results
+
+
+def train_svm_captured(kf: str, df: pd.DataFrame, **options) -> tuple[float, svm.SVC, str]:
+  '''
+  Runs :func:`train_svm` and captures what it prints, so that parallel runs do not interleave.
+
+  :return: The accuracy, the model and the output of :func:`train_svm`.
+  :rtype: tuple[float, svm.SVC, str]
+  '''
+  output = io.StringIO()
+  with contextlib.redirect_stdout(output):
+    accuracy, model = train_svm(kf, df, **options)
+  return accuracy, model, output.getvalue()
+
+
 def train_svm(
     kf: str,
     df: pd.DataFrame,
     train_proportion=0.8,
     length_threshold=20,
     oversample: bool = False,
-    verbose: bool = False
+    verbose: bool = False,
+    solver: str = 'svc',
+    solver_threshold: int = SOLVER_THRESHOLD,
+    C: float = 1.0,
+    class_weight: str | None = None
 ) -> tuple[float, svm.SVC]:
   '''
   Trains an SVM model on the given DataFrame and evaluates its accuracy.
@@ -113,6 +339,17 @@ def train_svm(
   :type oversample: bool
   :param verbose: If True, enables verbose logging for debugging.
   :type verbose: bool
+  :param solver: The solver to fit the model with, see :func:`util.make_estimator`
+    (default is 'svc').
+  :type solver: str
+  :param solver_threshold: The number of training rows above which the 'auto' solver switches
+    from ``SVC`` to ``LinearSVC`` (default is 5000).
+  :type solver_threshold: int
+  :param C: The regularization parameter (default is 1.0).
+  :type C: float
+  :param class_weight: ``'balanced'`` to weight classes inversely to their frequency
+    (default is None).
+  :type class_weight: str | None
 
   :return: A tuple containing the accuracy of the model and the trained model itself.
   :rtype: tuple[float, svm.SVC]
@@ -126,11 +363,7 @@ def train_svm(
 
   if oversample:
     log(verbose, f"Oversampling minority classes in {kf}...", end=" ")
-    class_counts = df.iloc[:, -1].value_counts().to_dict()
-    sampling_strategy = {cls: max(count, 4)  # Ensure at least 2 samples per class
-                         for cls, count in class_counts.items()}
-    ros = RandomOverSampler(sampling_strategy=sampling_strategy, random_state=42)
-    x, y = ros.fit_resample(x, y)
+    x, y = oversample_minority(x, y)
     log(verbose, f"Done oversampling: {len(y)} samples after oversampling.")
     log(verbose, f"{'->':>40}", end=" ")
 
@@ -150,7 +383,8 @@ def train_svm(
     return None, None
 
   # Create and train the SVM model
-  model = svm.SVC(kernel='linear', C=1.0)
+  model = make_estimator(solver, len(x_train), solver_threshold, C=C, class_weight=class_weight)
+  log(verbose, f"Fitting {type(model).__name__} on {len(x_train)} rows...", end=" ")
   model.fit(x_train, y_train)
 
   # Evaluate the model
@@ -161,6 +395,152 @@ def train_svm(
   return accuracy, model
 
 
+def update_all(
+    data: dict[str, pd.DataFrame],
+    foldername: str = 'models',
+    **options
+) -> dict[str, tuple[float, SGDClassifier]]:
+  '''
+  Updates the saved model of each key function with :func:`update_svm`, then saves the updated
+  models and the train state. The models and the state are kept apart from those of
+  :func:`train_changed`, see :func:`util.model_path`.
+
+  :param data: A dictionary where keys are key functions and values are their training data,
+    with the ``id`` column.
+  :type data: dict[str, pd.DataFrame]
+  :param foldername: The local folder of the models (default is 'models').
+  :type foldername: str
+  :param options: Keyword arguments passed to :func:`update_svm`.
+  :return: A dictionary with the accuracy and model returned by :func:`update_svm` for each key
+    function, in the order of ``data``.
+  :rtype: dict[str, tuple[float, SGDClassifier]]
+  '''
+  state = read_train_state(foldername, incremental=True)
+
+  results = {}
+  for kf, df in data.items():
+    trained = state.get(kf)
+    model = load_model(foldername, kf, incremental=True) if trained is not None else None
+    if model is None:
+      trained = None
+
+    accuracy, model, updated = update_svm(kf, df, model, trained, **options)
+    results[kf] = (accuracy, model)
+
+    if updated is not None and updated != trained:
+      save_model(foldername, kf, model, incremental=True)
+      state[kf] = updated
+      write_train_state(foldername, state, incremental=True)
+  return results
+
+
+def update_svm(
+    kf: str,
+    df: pd.DataFrame,
+    model: SGDClassifier | None = None,
+    trained: dict | None = None,
+    train_proportion=0.8,
+    length_threshold=20,
+    oversample: bool = False,
+    verbose: bool = False,
+    max_accuracy_drop: float = 0.02
+) -> tuple[float, SGDClassifier, dict]:
+  '''
+  Updates an SGD model with the rows added since it was last trained, or fits a new one.
+
+  The rows are split into training and held-out rows by :func:`util.holdout_mask`, so a row is
+  never trained on once it was held out. The previous model is updated with one pass of
+  ``partial_fit`` over the new training rows and both are scored on the held-out rows. The model is
+  fitted again on every training row when there is no previous model, when the new rows have a
+  class the previous model does not know, or when the update loses more than
+  ``max_accuracy_drop`` of accuracy.
+
+  Before an update, ``alpha`` is set again from the total number of rows trained on, see
+  :func:`util.sgd_alpha`, so that the regularization keeps matching a linear SVM with ``C`` of 1
+  as the training set grows.
+
+  :param kf: The keyframe name (used for logging).
+  :type kf: str
+  :param df: The DataFrame containing the training data, with the ``id`` column.
+  :type df: pd.DataFrame
+  :param model: The model to update, or None to fit a new one.
+  :type model: SGDClassifier | None
+  :param trained: The highest ``'id'`` and the number of ``'rows'`` the model was trained on.
+  :type trained: dict | None
+  :param train_proportion: The proportion of the rows to train on (default is 0.8).
+  :type train_proportion: float
+  :param length_threshold: The minimum number of rows required to train the model (default is 20).
+  :type length_threshold: int
+  :param oversample: If True, oversamples the minority classes when the model is fitted again.
+  :type oversample: bool
+  :param verbose: If True, enables verbose logging for debugging.
+  :type verbose: bool
+  :param max_accuracy_drop: The largest loss of held-out accuracy accepted from an update
+    (default is 0.02).
+  :type max_accuracy_drop: float
+
+  :return: The held-out accuracy, the model, and the highest ``'id'`` and number of ``'rows'`` it
+    was trained on; or None for each if the key function was skipped.
+  :rtype: tuple[float, SGDClassifier, dict]
+  '''
+  print(f"Updating {kf:10} with {len(df):3} rows", end=" --> ")
+
+  df = df.dropna()  # Drop rows with any NaN values
+
+  ids = df.pop('id').to_numpy()
+  x = df.iloc[:, :-1].to_numpy(dtype=np.float64)
+  y = df.iloc[:, -1].to_numpy()
+
+  holdout = holdout_mask(ids, 1 - train_proportion)
+  if len(x) < length_threshold or holdout.all() or not holdout.any():
+    print(f"Skipping {kf} because it has less than {length_threshold} rows")
+    return None, None, None
+
+  x_test, y_test = x[holdout], y[holdout]
+  last_id = int(ids.max())
+
+  if model is not None:
+    new = ~holdout & (ids > trained['id'])
+    previous = model.score(x_test, y_test)
+
+    if not new.any():
+      log(verbose, "No new rows...", end=" ")
+      print(f"Accuracy: {percent_bar(previous, 30)}")
+      return previous, model, {'id': max(trained['id'], last_id), 'rows': trained['rows']}
+
+    if np.isin(y[new], model.classes_).all():
+      updated = copy.deepcopy(model)
+      updated.set_params(alpha=sgd_alpha(1.0, trained['rows'] + int(new.sum())))
+      updated.partial_fit(x[new], y[new])
+      accuracy = updated.score(x_test, y_test)
+
+      if accuracy >= previous - max_accuracy_drop:
+        log(verbose, f"Updated with {new.sum()} new rows...", end=" ")
+        print(f"Accuracy: {percent_bar(accuracy, 30)}")
+        return accuracy, updated, {'id': last_id, 'rows': trained['rows'] + int(new.sum())}
+
+      log(verbose, f"Accuracy dropped from {previous:.2%} to {accuracy:.2%}, refitting...",
+          end=" ")
+    else:
+      log(verbose, "New classes in the new rows, refitting...", end=" ")
+
+  x_train, y_train = x[~holdout], y[~holdout]
+  if oversample:
+    x_train, y_train = oversample_minority(x_train, y_train)
+
+  model = make_estimator('sgd', len(x_train))
+  try:
+    model.fit(x_train, y_train)
+  except ValueError as e:
+    print(f"Error fitting {kf}: {e}")
+    return None, None, None
+
+  accuracy = model.score(x_test, y_test)
+  print(f"Accuracy: {percent_bar(accuracy, 30)}")
+
+  return accuracy, model, {'id': last_id, 'rows': int((~holdout).sum())}
+
+
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(
       description="Train an SVM model on the data in the data directory.")
@@ -168,14 +548,46 @@ if __name__ == "__main__":
   parser.add_argument('-v', '--verbose', action='store_true',
                       help="Enable verbose output for debugging.")
 
+  parser.add_argument('--folds', type=int, default=5,
+                      help="Number of cross-validation folds of --search (default: 5).")
+  parser.add_argument('--force', action='store_true',
+                      help="Train and --search every model, even if its data and "
+                           "hyperparameters have not changed.")
+  parser.add_argument('--full-refresh', action='store_true',
+                      help="Download every table again instead of only the new rows.")
+  parser.add_argument('--incremental', action='store_true',
+                      help="Update the saved SGD models with the rows added since they were "
+                           "last trained instead of training new models.")
+  parser.add_argument('--jobs', type=int, default=1,
+                      help="Number of processes to train the models in (default: 1).")
   parser.add_argument('--length-threshold', type=int, default=20,
                       help="Minimum number of rows required to train the model (default: 20).")
+  parser.add_argument('--max-accuracy-drop', type=float, default=0.02,
+                      help="Largest loss of held-out accuracy accepted from an --incremental "
+                           "update before the model is fitted again (default: 0.02).")
   parser.add_argument('--no-fetch', action='store_true',
                       help="Skip fetching data from Supabase and use existing data.")
   parser.add_argument('--oversample', action='store_true',
                       help="Enable oversampling of the minority classes.")
+  parser.add_argument('--search', action='store_true',
+                      help="Search the C value and class weights of each model with "
+                           "cross-validation before training it.")
+  parser.add_argument('--solver', choices=SOLVERS, default='svc',
+                      help="Solver to fit the models with: 'svc' (libsvm), 'linear' (liblinear), "
+                           "'sgd' (stochastic gradient descent), or 'auto' to use 'linear' above "
+                           "--solver-threshold training rows (default: svc).")
+  parser.add_argument('--solver-threshold', type=int, default=SOLVER_THRESHOLD,
+                      help=f"Training rows above which the 'auto' solver uses 'linear' "
+                           f"(default: {SOLVER_THRESHOLD}).")
+  parser.add_argument('--time-budget', type=float, default=None,
+                      help="Maximum number of seconds spent by --search, shared between the "
+                           "models (default: no limit).")
   parser.add_argument('--train-proportion', type=float, default=0.8,
                       help="Proportion of data to use for training (default: 0.8). "
                            "Must be between 0.0 and 1.0.")
 
-  main(parser.parse_args())
+  arguments = parser.parse_args()
+  if arguments.incremental and arguments.search:
+    parser.error("--search cannot be used with --incremental.")
+
+  main(arguments)
@@ -2,12 +2,34 @@
 Utility functions for SVM model training and exporting.
 '''
 
+import hashlib
+import json
 import os
-import pickle
+import struct
+import tempfile
+import time
 
-from sklearn.svm import SVC
+import joblib
+import numpy as np
+import pandas as pd
+from imblearn.over_sampling import RandomOverSampler
+from sklearn.linear_model import SGDClassifier
+from sklearn.svm import SVC, LinearSVC
 from supabase import Client
 
+# Must match the reader in infer/inference.py
+BUNDLE_NAME = 'svm-models.bundle'
+BUNDLE_MAGIC = b'CCCSVMB\0'
+BUNDLE_VERSION = 2
+BUNDLE_ALIGNMENT = 64
+
+MANIFEST_NAME = 'manifest.json'
+TRAIN_STATE_NAME = '.train-state.json'
+INCREMENTAL_STATE_NAME = '.incremental-state.json'
+
+SOLVERS = ('auto', 'svc', 'linear', 'sgd')
+SOLVER_THRESHOLD = 5000
+
 
 def percent_bar(percent: float, width: int) -> str:
   '''
@@ -53,43 +75,531 @@ def log(verbose: bool, string: str, end='\n') -> None:
     print(string, end=end)
 
 
-def export_upload_model(
-    model: SVC, kf: str,
+def make_estimator(
+    solver: str,
+    n_rows: int,
+    solver_threshold: int = SOLVER_THRESHOLD,
+    C: float = 1.0,
+    class_weight: str | None = None
+):
+  '''
+  Creates the linear SVM estimator for a solver.
+
+  ``'svc'`` is libsvm's ``SVC``, whose fit time grows at least quadratically with the number of
+  rows. ``'linear'`` is liblinear's ``LinearSVC`` and ``'sgd'`` an ``SGDClassifier`` with the hinge
+  loss, which both scale linearly. ``'auto'`` picks ``'svc'`` up to ``solver_threshold`` rows and
+  ``'linear'`` above. All of them can be bundled for the inference service.
+
+  :param solver: One of :data:`SOLVERS`.
+  :type solver: str
+  :param n_rows: The number of training rows, after oversampling.
+  :type n_rows: int
+  :param solver_threshold: The number of rows above which ``'auto'`` picks ``'linear'``.
+  :type solver_threshold: int
+  :param C: The regularization parameter; for ``'sgd'`` it sets ``alpha`` to ``1 / (C * n_rows)``,
+    which minimizes the same objective (default is 1.0).
+  :type C: float
+  :param class_weight: ``'balanced'`` to weight classes inversely to their frequency
+    (default is None).
+  :type class_weight: str | None
+  :return: The unfitted estimator.
+  :rtype: SVC | LinearSVC | SGDClassifier
+
+  :raises ValueError: If the solver is unknown.
+  '''
+  if solver == 'auto':
+    solver = 'svc' if n_rows <= solver_threshold else 'linear'
+
+  if solver == 'svc':
+    return SVC(kernel='linear', C=C, class_weight=class_weight)
+  if solver == 'linear':
+    return LinearSVC(C=C, class_weight=class_weight, random_state=42)
+  if solver == 'sgd':
+    return SGDClassifier(loss='hinge', alpha=sgd_alpha(C, n_rows), class_weight=class_weight,
+                         random_state=42)
+  raise ValueError(f"Unknown solver '{solver}', expected one of {', '.join(SOLVERS)}.")
+
+
+def sgd_alpha(C: float, n_rows: int) -> float:
+  '''
+  Returns the regularization strength of an ``SGDClassifier`` that minimizes the same objective as
+  a linear SVM with parameter ``C`` trained on ``n_rows`` rows.
+
+  :param C: The regularization parameter of the SVM.
+  :type C: float
+  :param n_rows: The number of training rows.
+  :type n_rows: int
+  :return: The ``alpha`` of the ``SGDClassifier``.
+  :rtype: float
+  '''
+  return 1 / (C * max(n_rows, 1))
+
+
+def oversample_minority(x: np.ndarray, y: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+  '''
+  Oversamples the classes with fewer than 4 samples up to 4 samples.
+
+  :param x: The features.
+  :type x: np.ndarray
+  :param y: The labels.
+  :type y: np.ndarray
+  :return: The oversampled features and labels.
+  :rtype: tuple[np.ndarray, np.ndarray]
+  '''
+  classes, counts = np.unique(y, return_counts=True)
+  sampling_strategy = {cls: max(count, 4)  # Ensure at least 2 samples per class
+                       for cls, count in zip(classes.tolist(), counts.tolist())}
+  ros = RandomOverSampler(sampling_strategy=sampling_strategy, random_state=42)
+  return ros.fit_resample(x, y)
+
+
+def serialize_model_bundle(models: dict[str, SVC]) -> bytes:
+  """
+  Serializes the trained SVM models into a single versioned bundle.
+
+  The bundle starts with a magic string, a version and a JSON header that maps each model name to
+  its scheme, ``'ovo'`` for an ``SVC`` and ``'ovr'`` for a one-vs-rest linear model such as
+  ``LinearSVC`` or ``SGDClassifier``, and to the offset, dtype and shape of its ``coef_``,
+  ``intercept_`` and ``classes_`` arrays. The raw arrays follow the header, each aligned to
+  :data:`BUNDLE_ALIGNMENT` bytes so that they can be memory-mapped by the inference service
+  without copying.
+
+  :param models: A dictionary where keys are model names and values are the trained SVM models.
+  :type models: dict[str, SVC | LinearSVC | SGDClassifier]
+  :return: The serialized bundle.
+  :rtype: bytes
+  """
+  arrays = {name: {'coef': np.ascontiguousarray(model.coef_, dtype='<f8'),
+                   'intercept': np.ascontiguousarray(model.intercept_, dtype='<f8'),
+                   'classes': np.ascontiguousarray(model.classes_, dtype='<i8')}
+            for name, model in sorted(models.items())}
+
+  def align(offset: int) -> int:
+    return -(-offset // BUNDLE_ALIGNMENT) * BUNDLE_ALIGNMENT
+
+  # Array offsets are relative to the start of the data section, right after the header
+  entries, data_length = {}, 0
+  for name, model_arrays in arrays.items():
+    entries[name] = {'scheme': 'ovo' if isinstance(models[name], SVC) else 'ovr'}
+    for key, array in model_arrays.items():
+      data_length = align(data_length)
+      entries[name][key] = {'offset': data_length, 'dtype': array.dtype.str, 'shape': array.shape}
+      data_length += array.nbytes
+
+  # The header is padded with spaces so that the data section starts aligned
+  prefix = len(BUNDLE_MAGIC) + struct.calcsize('<II')
+  header = json.dumps({'models': entries}).encode()
+  header += b' ' * (align(prefix + len(header)) - prefix - len(header))
+
+  buffer = bytearray(prefix + len(header) + data_length)
+  buffer[:prefix] = BUNDLE_MAGIC + struct.pack('<II', BUNDLE_VERSION, len(header))
+  buffer[prefix:prefix + len(header)] = header
+  for name, model_arrays in arrays.items():
+    for key, array in model_arrays.items():
+      start = prefix + len(header) + entries[name][key]['offset']
+      buffer[start:start + array.nbytes] = array.tobytes()
+
+  return bytes(buffer)
+
+
+class Uploader:
+  """
+  Uploads files to a storage bucket from memory. An upload that failed for a transient reason, see
+  :func:`is_transient_error`, is retried ``retries`` times, waiting ``backoff`` seconds before the
+  first retry and twice as long before each next one.
+
+  If ``manifest`` is set, :meth:`close` uploads a JSON manifest under that name, listing the size
+  and SHA-256 digest of every file uploaded, merged with the manifest already in the bucket. The
+  manifest is left as it is if any upload failed.
+
+  :param supabase: The Supabase client.
+  :type supabase: Client
+  :param bucketname: The name of the bucket to upload to (default is 'svm-models').
+  :type bucketname: str
+  :param retries: The number of times a failed upload is retried (default is 3).
+  :type retries: int
+  :param backoff: The number of seconds before the first retry (default is 1.0).
+  :type backoff: float
+  :param manifest: The name of the manifest in the bucket, or None for no manifest.
+  :type manifest: str | None
+  """
+
+  def __init__(
+      self,
+      supabase: Client,
+      bucketname='svm-models',
+      retries: int = 3,
+      backoff: float = 1.0,
+      manifest: str | None = None
+  ) -> None:
+    if supabase is None:
+      raise ValueError("Supabase client is not initialized. Cannot upload the models.")
+
+    self.supabase = supabase
+    self.bucketname = bucketname
+    self.retries = retries
+    self.backoff = backoff
+    self.manifest_name = manifest
+    self.manifest: dict[str, dict] = {}
+    self.failed = 0
+
+  def __enter__(self) -> 'Uploader':
+    return self
+
+  def __exit__(self, exc_type, exc, tb) -> None:
+    # the manifest is only uploaded if every file was
+    if exc_type is None:
+      self.close()
+
+  def upload(self, name: str, data: bytes) -> None:
+    """
+    Uploads a file and records it in the manifest.
+
+    :param name: The name of the object in the bucket.
+    :type name: str
+    :param data: The content of the file.
+    :type data: bytes
+    :raises Exception: The error of the last attempt if the upload failed.
+    """
+    try:
+      self._put(name, data)
+    except Exception:
+      self.failed += 1
+      raise
+    self.manifest[name] = {'size': len(data), 'sha256': hashlib.sha256(data).hexdigest()}
+
+  def _put(self, name: str, data: bytes) -> None:
+    for attempt in range(self.retries + 1):
+      try:
+        self.supabase.storage.from_(self.bucketname).upload(name, data, {'upsert': 'true'})
+        break
+      except Exception as e:  # pylint: disable=broad-exception-caught
+        if attempt == self.retries or not is_transient_error(e):
+          raise
+        delay = self.backoff * 2 ** attempt
+        print(f"Error uploading {name} ({e}), retrying in {delay:g}s...")
+        time.sleep(delay)
+    print(f"Uploaded {name} to bucket '{self.bucketname}'.")
+
+  def close(self) -> None:
+    """
+    Uploads the manifest of the files uploaded, unless an upload failed.
+    """
+    if self.manifest_name is None or not self.manifest:
+      return
+    if self.failed:
+      print(f"{self.failed} uploads failed, leaving {self.manifest_name} as it is.")
+      return
+
+    objects = {**self._read_manifest().get('objects', {}), **self.manifest}
+    manifest = {'objects': dict(sorted(objects.items()))}
+    self._put(self.manifest_name, json.dumps(manifest, indent=2).encode())
+
+  def _read_manifest(self) -> dict:
+    try:
+      data = self.supabase.storage.from_(self.bucketname).download(self.manifest_name)
+    except Exception as e:  # pylint: disable=broad-exception-caught
+      # Supabase Storage reports a missing object as 400 or 404
+      if error_status(e) in (400, 404):
+        return {}
+      raise
+    return json.loads(data)
+
+
+def error_status(error: Exception) -> int | None:
+  '''
+  Returns the HTTP status of a failed storage request.
+
+  :param error: The error raised by the request.
+  :type error: Exception
+  :return: The HTTP status, or None if the request got no response.
+  :rtype: int | None
+  '''
+  status = getattr(error, 'status', None)
+  if status is None:
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+  try:
+    return int(status) if status is not None else None
+  except (TypeError, ValueError):
+    return None
+
+
+def is_transient_error(error: Exception) -> bool:
+  '''
+  Tells whether a failed storage request is worth retrying: requests that got no response, timed
+  out, were rate limited or hit a server error are, while other client errors, such as a rejected
+  key or a missing bucket, fail the same way every time.
+
+  :param error: The error raised by the request.
+  :type error: Exception
+  :return: True if the request may succeed when retried.
+  :rtype: bool
+  '''
+  status = error_status(error)
+  return status is None or status in (408, 429) or status >= 500
+
+
+def export_upload_bundle(
+    models: dict[str, SVC],
     foldername='models',
     bucketname='svm-models',
-    supabase: Client = None
+    supabase: Client = None,
+    uploader: Uploader | None = None
 ) -> None:
   """
-  Exports the trained SVM model to a file and uploads it to a specified bucket.
+  Exports the trained SVM models to a single bundle file and uploads it to a specified bucket.
+  The SHA-256 digest of the last bundle uploaded is kept next to it, and a bundle with the same
+  bytes is neither written nor uploaded again.
 
-  :param model: The trained SVM model to export.
-  :type model: SVC
-  :param kf: The keyframe name (used for naming the model file).
-  :type kf: str
-  :param foldername: The local folder to save the model file (default is 'models').
+  :param models: A dictionary where keys are model names and values are the trained SVM models.
+  :type models: dict[str, SVC]
+  :param foldername: The local folder to save the bundle file (default is 'models').
   :type foldername: str
-  :param bucketname: The name of the bucket to upload the model file (default is 'svm-models').
+  :param bucketname: The name of the bucket to upload the bundle file (default is 'svm-models').
   :type bucketname: str
+  :param supabase: The Supabase client, used when no uploader is given.
+  :type supabase: Client
+  :param uploader: If given, the bundle is uploaded with this uploader, with its retries and
+    manifest, instead of directly.
+  :type uploader: Uploader | None
+
+  :raises ValueError: If there are no models, no client or uploader, or the uploader uploads to
+    another bucket than ``bucketname``.
   """
 
   # Ensure the folder exists
   os.makedirs(foldername, exist_ok=True)
 
-  if model is None:
-    raise ValueError("The model is None. Cannot export a None model.")
+  if not models:
+    raise ValueError("No models to export.")
+
+  if supabase is None and uploader is None:
+    raise ValueError("Supabase client is not initialized. Cannot upload the models.")
+
+  if uploader is not None and uploader.bucketname != bucketname:
+    raise ValueError(f"The uploader uploads to bucket '{uploader.bucketname}', not to bucket "
+                     f"'{bucketname}'.")
+
+  print(f"Exporting {len(models)} models to {foldername}...", end=" ")
 
-  if supabase is None:
-    raise ValueError("Supabase client is not initialized. Cannot upload the model.")
+  bundle = serialize_model_bundle(models)
 
-  print(f"Exporting model for {kf} to {foldername}...", end=" ")
+  bundle_path = os.path.join(foldername, BUNDLE_NAME)
+  digest = hashlib.sha256(bundle).hexdigest()
+  if read_digest(bundle_path) == digest:
+    print(f"{BUNDLE_NAME} has not changed since it was last uploaded, skipping the upload.")
+    return
 
-  # Save the model to a file
-  model_path = os.path.join(foldername, f"{kf}.pkl")
-  with open(model_path, 'wb') as f:
-    pickle.dump(model, f)
+  # Save the bundle to a file
+  with open(bundle_path, 'wb') as f:
+    f.write(bundle)
 
   # Upload to Supabase bucket
-  print(f"Uploading model to bucket '{bucketname}'...")
+  print(f"Uploading {BUNDLE_NAME} to bucket '{bucketname}'...")
+
+  if uploader is not None:
+    uploader.upload(BUNDLE_NAME, bundle)
+  else:
+    supabase.storage.from_(bucketname).upload(BUNDLE_NAME, bundle, {'upsert': 'true'})
+  # the digest is only recorded once the upload succeeded, so a failed upload is retried
+  write_digest(bundle_path, digest)
+
+
+def read_digest(path: str) -> str | None:
+  '''
+  Reads the digest recorded for a file by :func:`write_digest`.
+
+  :param path: The path of the file.
+  :type path: str
+  :return: The hexadecimal digest, or None if none was recorded.
+  :rtype: str | None
+  '''
+  if not os.path.exists(path + '.sha256'):
+    return None
+  with open(path + '.sha256', 'r', encoding='utf-8') as f:
+    return f.read().strip()
+
+
+def write_digest(path: str, digest: str) -> None:
+  '''
+  Records the digest of a file in "<path>.sha256", replacing the previous one atomically.
+
+  :param path: The path of the file.
+  :type path: str
+  :param digest: The hexadecimal digest.
+  :type digest: str
+  '''
+  fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.sha256-')
+  with os.fdopen(fd, 'w', encoding='utf-8') as f:
+    f.write(digest)
+  os.replace(tmp_path, path + '.sha256')
+
+
+def write_model_config(foldername: str, kf: str, config: dict) -> str:
+  '''
+  Writes the hyperparameters chosen for a key function next to its model, as
+  "<foldername>/<kf>.config.json".
+
+  :param foldername: The local folder of the models.
+  :type foldername: str
+  :param kf: The key function.
+  :type kf: str
+  :param config: The hyperparameters and their cross-validation scores.
+  :type config: dict
+  :return: The path of the file written.
+  :rtype: str
+  '''
+  os.makedirs(foldername, exist_ok=True)
+  path = os.path.join(foldername, f'{kf}.config.json')
+  with open(path, 'w', encoding='utf-8') as f:
+    json.dump(config, f, indent=2)
+  return path
+
+
+def read_model_config(foldername: str, kf: str) -> dict | None:
+  '''
+  Reads the hyperparameters written for a key function by :func:`write_model_config`.
+
+  :param foldername: The local folder of the models.
+  :type foldername: str
+  :param kf: The key function.
+  :type kf: str
+  :return: The hyperparameters and their cross-validation scores, or None if none were written.
+  :rtype: dict | None
+  '''
+  path = os.path.join(foldername, f'{kf}.config.json')
+  if not os.path.exists(path):
+    return None
+  with open(path, 'r', encoding='utf-8') as f:
+    return json.load(f)
+
+
+def frame_fingerprint(df: pd.DataFrame, **params) -> str:
+  '''
+  Returns a fingerprint of the content, column names and dtypes of a DataFrame, and of the
+  keyword arguments given.
+
+  :param df: The DataFrame.
+  :type df: pd.DataFrame
+  :param params: Values to fingerprint with the DataFrame, such as hyperparameters; they must be
+    JSON serializable.
+  :return: A hexadecimal digest that changes whenever the DataFrame or the values change.
+  :rtype: str
+  '''
+  digest = hashlib.blake2b(digest_size=16)
+  digest.update(repr([(str(c), str(t)) for c, t in df.dtypes.items()]).encode())
+  digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+  if params:
+    digest.update(json.dumps(params, sort_keys=True).encode())
+  return digest.hexdigest()
+
+
+def holdout_mask(ids: np.ndarray, proportion: float) -> np.ndarray:
+  '''
+  Selects a fixed held-out set from the row ids. A row is held out depending on the hash of its id
+  only, so it stays held out, and is never trained on, as new rows are added to the table.
+
+  :param ids: The ids of the rows.
+  :type ids: np.ndarray
+  :param proportion: The proportion of the rows to hold out.
+  :type proportion: float
+  :return: A boolean array, True for the held-out rows.
+  :rtype: np.ndarray
+  '''
+  return pd.util.hash_array(np.asarray(ids, dtype=np.int64)) % 1000 < round(proportion * 1000)
+
+
+def model_path(foldername: str, kf: str, incremental: bool = False) -> str:
+  '''
+  Returns the path of the estimator of a key function: "<foldername>/<kf>.joblib" for a full
+  training run and "<foldername>/<kf>.incremental.joblib" for an incremental update, so that the
+  two modes never load each other's models.
+
+  :param foldername: The local folder of the models.
+  :type foldername: str
+  :param kf: The key function.
+  :type kf: str
+  :param incremental: If True, the path of the incrementally updated model.
+  :type incremental: bool
+  :return: The path of the model file.
+  :rtype: str
+  '''
+  return os.path.join(foldername, f'{kf}.incremental.joblib' if incremental else f'{kf}.joblib')
+
+
+def save_model(foldername: str, kf: str, model, incremental: bool = False) -> None:
+  '''
+  Saves the fitted estimator of a key function at :func:`model_path`, so that it can be reused or
+  updated by the next run.
+
+  :param foldername: The local folder of the models.
+  :type foldername: str
+  :param kf: The key function.
+  :type kf: str
+  :param model: The fitted estimator.
+  :type model: SVC | LinearSVC | SGDClassifier
+  :param incremental: If True, saves the incrementally updated model.
+  :type incremental: bool
+  '''
+  fd, tmp_path = tempfile.mkstemp(dir=foldername, prefix=f'.{kf}.')
+  with os.fdopen(fd, 'wb') as f:
+    joblib.dump(model, f)
+  os.replace(tmp_path, model_path(foldername, kf, incremental))
+
 
-  with open(model_path, 'rb') as f:
-    supabase.storage.from_(bucketname).update(f"{kf}.pkl", f)
+def load_model(foldername: str, kf: str, incremental: bool = False):
+  '''
+  Loads the estimator saved by :func:`save_model`.
+
+  :param foldername: The local folder of the models.
+  :type foldername: str
+  :param kf: The key function.
+  :type kf: str
+  :param incremental: If True, loads the incrementally updated model.
+  :type incremental: bool
+  :return: The fitted estimator, or None if none was saved.
+  :rtype: SVC | LinearSVC | SGDClassifier | None
+  '''
+  path = model_path(foldername, kf, incremental)
+  if not os.path.exists(path):
+    return None
+  return joblib.load(path)
+
+
+def read_train_state(foldername: str, incremental: bool = False) -> dict:
+  '''
+  Reads the train state of the saved models. A full training run records the ``'fingerprint'``
+  and ``'accuracy'`` of each key function in :data:`TRAIN_STATE_NAME`, and an incremental update
+  the highest row ``'id'`` and the number of ``'rows'`` trained on in
+  :data:`INCREMENTAL_STATE_NAME`.
+
+  :param foldername: The local folder of the models.
+  :type foldername: str
+  :param incremental: If True, reads the state of the incremental updates.
+  :type incremental: bool
+  :return: A dictionary mapping key functions to their state.
+  :rtype: dict
+  '''
+  path = os.path.join(foldername, INCREMENTAL_STATE_NAME if incremental else TRAIN_STATE_NAME)
+  if not os.path.exists(path):
+    return {}
+  with open(path, 'r', encoding='utf-8') as f:
+    return json.load(f)
+
+
+def write_train_state(foldername: str, state: dict, incremental: bool = False) -> None:
+  '''
+  Writes the train state read by :func:`read_train_state`, replacing the previous one atomically.
+
+  :param foldername: The local folder of the models.
+  :type foldername: str
+  :param state: A dictionary mapping key functions to their state.
+  :type state: dict
+  :param incremental: If True, writes the state of the incremental updates.
+  :type incremental: bool
+  '''
+  name = INCREMENTAL_STATE_NAME if incremental else TRAIN_STATE_NAME
+  fd, tmp_path = tempfile.mkstemp(dir=foldername, prefix=name)
+  with os.fdopen(fd, 'w', encoding='utf-8') as f:
+    json.dump(state, f, indent=2)
+  os.replace(tmp_path, os.path.join(foldername, name))